@@ -1,7 +1,7 @@
 """Similarity matching of sentences and related functions."""
 
 
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 from scipy.signal.windows import triang
 
@@ -137,7 +137,9 @@ def match_similarity(
         all_i.append(i)
         all_max_flattened.append(int(last_max))
 
-    fig, ax = plt.subplots()
+    # not tracked by pyplot, it is freed when the caller drops it
+    fig = Figure()
+    ax = fig.subplots()
     ax.scatter(all_good_i, all_good_max, s=0.1)
     ax.plot([0, sent_num_src], [0, sent_num_dst], linewidth=0.3)
     fit_y = fit_func([0, sent_num_src])
@@ -8,7 +8,7 @@ from typing import IO, Optional
 import zipfile
 
 from flask import redirect, render_template, request, url_for
-from matplotlib import pyplot as plt
+from matplotlib.figure import Figure
 import numpy as np
 import pandas as pd
 from sklearn.metrics.pairwise import cosine_similarity
@@ -349,7 +349,8 @@ def epub_align():
             sim = cosine_similarity(enc_orig_src, enc_tran_dst)
 
             # plot it for fun
-            fig, ax = plt.subplots()
+            fig = Figure()
+            ax = fig.subplots()
             ax.imshow(sim)
             ax.set_title(f"Similarity *en* vs *fr_translated*")
             ax.set_ylabel("en")
@@ -674,7 +675,8 @@ def epub_align_cache(btn=-99, btn2=-90):
             sim = cosine_similarity(enc_orig_src, enc_tran_dst)
 
             # plot it for fun
-            fig, ax = plt.subplots()
+            fig = Figure()
+            ax = fig.subplots()
             ax.imshow(sim)
             ax.set_title(f"Similarity *en* vs *fr_translated*")
             ax.set_ylabel("en")
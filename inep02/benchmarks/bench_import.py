@@ -0,0 +1,64 @@
+"""Benchmark the time to import the flask app, the cold start of the server.
+
+Run with::
+
+    python benchmarks/bench_import.py
+
+Each import runs in a fresh interpreter.
+The heavy libraries must not be imported until a model is needed.
+"""
+
+import subprocess
+import sys
+
+HEAVY_MODULES = [
+    "torch",
+    "transformers",
+    "sentence_transformers",
+    "spacy",
+    "sklearn",
+    "pandas",
+    "scipy",
+    "matplotlib",
+]
+
+IMPORT_CODE = f"""
+import sys
+from timeit import default_timer
+t0 = default_timer()
+import interleave_epub.flask_app
+elapsed = default_timer() - t0
+heavy = [m for m in {HEAVY_MODULES!r} if m in sys.modules]
+print(elapsed, ",".join(heavy))
+"""
+
+
+def time_import() -> tuple[float, list[str]]:
+    """Import the app in a new interpreter.
+
+    Returns:
+        tuple[float, list[str]]: The import time and the heavy modules imported.
+    """
+    res = subprocess.run(
+        [sys.executable, "-c", IMPORT_CODE],
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    elapsed_str, _, heavy = res.stdout.strip().partition(" ")
+    return float(elapsed_str), [m for m in heavy.split(",") if m != ""]
+
+
+def main() -> None:
+    """Time a few imports of the app."""
+    times = []
+    for _ in range(5):
+        elapsed, heavy = time_import()
+        times.append(elapsed)
+        if len(heavy) > 0:
+            print(f"heavy modules imported: {heavy}")
+    print(f"import interleave_epub.flask_app: {min(times):.3f}s (best of 5)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,172 @@
+"""Benchmark the coarse-to-fine pyramid alignment on synthetic long chapters.
+
+Run with::
+
+    python benchmarks/bench_pyramid.py
+
+The dst chapter is built from the src one, with some sentences split or dropped,
+so that the true matching drifts away from the diagonal.
+
+Each path is timed end to end, the similarity and then the engine,
+and the script exits with an error if the pyramid is not fast enough
+on the chapters long enough to use it.
+"""
+
+import sys
+from timeit import default_timer
+from typing import Callable
+
+from loguru import logger
+import numpy as np
+from sklearn.metrics.pairwise import cosine_similarity
+
+from interleave_epub.interleave.constants import pyramid_min_sent_num
+from interleave_epub.interleave.engine import (
+    AlignResult,
+    ChapterFeatures,
+    SimilaritySource,
+    build_engine,
+)
+from interleave_epub.interleave.pyramid import BandSimilarity, pyramid_similarity
+
+BLOCK_SIZE = 16
+# the timings are the best of this many runs
+REPEATS = 3
+# the pyramid must be at least this much faster on the chapters it is used for
+MIN_SPEEDUP = 2.0
+
+
+def build_synthetic_chapters(
+    sent_num_src: int,
+    emb_dim: int = 384,
+    noise: float = 0.6,
+    seed: int = 42,
+) -> tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Build src and dst sentence embeddings and the true src to dst matching."""
+    rng = np.random.default_rng(seed)
+    enc_src = rng.normal(size=(sent_num_src, emb_dim)).astype(np.float32)
+
+    enc_dst_l = []
+    true_dst = np.empty(sent_num_src, dtype=np.int64)
+    for id_src in range(sent_num_src):
+        true_dst[id_src] = len(enc_dst_l)
+        # sometimes the translator splits a sentence in two
+        num_copies = 2 if rng.random() < 0.15 else 1
+        for _ in range(num_copies):
+            enc_noise = rng.normal(size=emb_dim) * noise
+            enc_dst_l.append(enc_src[id_src] + enc_noise)
+    enc_dst = np.array(enc_dst_l, dtype=np.float32)
+
+    return enc_src, enc_dst, true_dst
+
+
+def build_features(sent_num: int) -> ChapterFeatures:
+    """Build chapter features with one long sentence per paragraph."""
+    return ChapterFeatures(
+        sents_text=[""] * sent_num,
+        sents_len=[10] * sent_num,
+        sents_par_id=list(range(sent_num)),
+        par_num=sent_num,
+    )
+
+
+def run_engine(
+    engine_name: str, sim: np.ndarray | BandSimilarity, **kwargs
+) -> AlignResult:
+    """Align with a registered engine."""
+    engine = build_engine(engine_name, **kwargs)
+    feat_src = build_features(sim.shape[0])
+    feat_dst = build_features(sim.shape[1])
+    return engine.align(feat_src, feat_dst, SimilaritySource(sim))
+
+
+def full_similarity(enc_src: np.ndarray, enc_dst: np.ndarray) -> np.ndarray:
+    """Compare all the sentences."""
+    return cosine_similarity(enc_src, enc_dst)
+
+
+def band_similarity(enc_src: np.ndarray, enc_dst: np.ndarray) -> BandSimilarity:
+    """Compare the sentences only in the corridor of the coarse path."""
+    return pyramid_similarity(enc_src, enc_dst, BLOCK_SIZE)
+
+
+def time_path(
+    enc_src: np.ndarray,
+    enc_dst: np.ndarray,
+    compute_sim: Callable[[np.ndarray, np.ndarray], np.ndarray | BandSimilarity],
+    engine_name: str,
+    **kwargs,
+) -> tuple[float, float, AlignResult]:
+    """Time the similarity and the engine, keeping the best of ``REPEATS`` runs.
+
+    Returns:
+        tuple[float, float, AlignResult]: The time of the similarity,
+            the time of the engine, and the alignment.
+    """
+    t_sim = t_align = float("inf")
+    for _ in range(REPEATS):
+        t0 = default_timer()
+        sim = compute_sim(enc_src, enc_dst)
+        t1 = default_timer()
+        result = run_engine(engine_name, sim, **kwargs)
+        t2 = default_timer()
+        t_sim = min(t_sim, t1 - t0)
+        t_align = min(t_align, t2 - t1)
+    return t_sim, t_align, result
+
+
+def main() -> int:
+    """Time the two alignments on chapters of growing length.
+
+    The speedup compares the similarity and the engine together,
+    as the pyramid engine runs only on chapters that long.
+
+    Returns:
+        int: 1 if the pyramid is not ``MIN_SPEEDUP`` times faster
+            on a chapter long enough to use it.
+    """
+    # load the lazy imports of the engines before timing
+    enc_src, enc_dst, _ = build_synthetic_chapters(200)
+    time_path(enc_src, enc_dst, full_similarity, "greedy_triangle")
+    time_path(enc_src, enc_dst, band_similarity, "pyramid", block_size=BLOCK_SIZE)
+
+    print(
+        f"{'sents':>6} {'full sim':>9} {'full eng':>9} {'full s':>7}"
+        f" {'pyr sim':>8} {'pyr eng':>8} {'pyr s':>6} {'speedup':>8}"
+        f" {'full ok':>8} {'pyr ok':>7}"
+    )
+    is_slow = False
+    for sent_num_src in [1000, 2000, 4000, 8000]:
+        enc_src, enc_dst, true_dst = build_synthetic_chapters(sent_num_src)
+
+        t_sim_full, t_eng_full, al_full = time_path(
+            enc_src, enc_dst, full_similarity, "greedy_triangle"
+        )
+        t_sim_pyr, t_eng_pyr, al_pyr = time_path(
+            enc_src, enc_dst, band_similarity, "pyramid", block_size=BLOCK_SIZE
+        )
+        t_full = t_sim_full + t_eng_full
+        t_pyr = t_sim_pyr + t_eng_pyr
+        speedup = t_full / t_pyr
+
+        ok_full = np.mean(np.array(al_full.ids_dst_max) == true_dst)
+        ok_pyr = np.mean(np.array(al_pyr.ids_dst_max) == true_dst)
+        flag = ""
+        if sent_num_src >= pyramid_min_sent_num and speedup < MIN_SPEEDUP:
+            flag = " SLOW"
+            is_slow = True
+        print(
+            f"{sent_num_src:6d} {t_sim_full:9.3f} {t_eng_full:9.3f} {t_full:7.3f}"
+            f" {t_sim_pyr:8.3f} {t_eng_pyr:8.3f} {t_pyr:6.3f} {speedup:8.1f}"
+            f" {ok_full:8.3f} {ok_pyr:7.3f}{flag}"
+        )
+
+    if is_slow:
+        print(f"The pyramid is less than {MIN_SPEEDUP}x faster on long chapters.")
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    logger.remove()
+    sys.exit(main())
@@ -1,15 +1,19 @@
 """Chapter class."""
-from typing import Literal, get_args
+from __future__ import annotations
+
+from typing import TYPE_CHECKING, Iterable, Literal, get_args
 
 from bs4 import BeautifulSoup
 from loguru import logger as lg
-from spacy.language import Language
-from spacy.tokens import Doc, Span
 
 from interleave_epub.epub.paragraph import Paragraph
 from interleave_epub.nlp.cached_pipe import TranslationPipelineCache
 from interleave_epub.utils import orig_or_trad
 
+if TYPE_CHECKING:
+    from spacy.language import Language
+    from spacy.tokens import Doc, Span
+
 
 class Chapter:
     """Chapter class.
@@ -26,8 +30,13 @@ class Chapter:
         lang: dict[str, str],
         nlp: dict[str, Language],
         pipe: dict[str, TranslationPipelineCache],
+        defer_trad: bool = False,
     ) -> None:
-        """Initialize a chapter."""
+        """Initialize a chapter.
+
+        If ``defer_trad`` is True the sentences are translated only when requested
+        with ``translate_sents``.
+        """
         # save and extract misc info
         self.chap_file_name = chap_file_name
         self.lang = lang
@@ -61,12 +70,16 @@ class Chapter:
                 self.lang,
                 self.nlp,
                 self.pipe,
+                defer_trad,
             )
             if new_par.is_empty:
                 lg.warning(f"Skipping empty paragraph {p_tag}")
                 continue
             self.paragraphs.append(new_par)
 
+        # the character length of the paragraphs, enough for a first alignment
+        self.pars_len = [len(par.get_text()) for par in self.paragraphs]
+
         self.build_flat_sents()
         self.build_index()
 
@@ -87,6 +100,10 @@ class Chapter:
         self.sents_psid: dict[str, list[tuple[int, int]]] = {}
         self.sents_len: dict[str, list[int]] = {}
         self.sents_num: dict[str, int] = {}
+        # mark which sentences have an actual translation
+        self.sents_is_trad: list[bool] = [
+            is_trad for par in self.paragraphs for is_trad in par.is_trad
+        ]
 
         # https://github.com/python/mypy/issues/9230#issuecomment-789230275
         for which_sent in get_args(orig_or_trad):
@@ -101,6 +118,21 @@ class Chapter:
                 self.sents_len[which_sent].append(len(sent))
             self.sents_num[which_sent] = len(self.sents_text[which_sent])
 
+    def translate_sents(self, cs_ids: Iterable[int]) -> None:
+        """Translate some sentences of the chapter, indexed as ``sent_in_chap_id``.
+
+        The flat lists of translated sentences are updated in place.
+        """
+        for cs_id in cs_ids:
+            if self.sents_is_trad[cs_id]:
+                continue
+            p_id, sp_id = self.cs_to_ps[cs_id]
+            sent_tran = self.paragraphs[p_id].translate_sent(sp_id)
+            self.sents_text["trad"][cs_id] = sent_tran.text
+            self.sents_doc["trad"][cs_id] = sent_tran
+            self.sents_len["trad"][cs_id] = len(sent_tran)
+            self.sents_is_trad[cs_id] = True
+
     def build_index(self):
         """Build maps to go from ``sent_in_chap_id`` to ``(par_id, sent_in_par_id)`` and vice-versa."""
         self.ps_to_cs = {}
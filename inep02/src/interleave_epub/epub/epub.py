@@ -1,19 +1,23 @@
 """EPub class."""
 
+from __future__ import annotations
+
 from collections import Counter
 from pathlib import Path
 import re
-from typing import IO, Union
+from typing import IO, TYPE_CHECKING, Callable, Union
 import zipfile
 
 from loguru import logger as lg
-from spacy.language import Language
 from tqdm import tqdm
 
 from interleave_epub.epub.chapter import Chapter
 from interleave_epub.epub.utils import VALID_CHAP_EXT
 from interleave_epub.nlp.cached_pipe import TranslationPipelineCache
 
+if TYPE_CHECKING:
+    from spacy.language import Language
+
 
 class EPub:
     """EPub class."""
@@ -28,8 +32,15 @@ class EPub:
         nlp: dict[str, Language],
         pipe: dict[str, TranslationPipelineCache],
         chap_id_first: int = 0,
+        defer_trad: bool = False,
+        progress: Callable[[int, int], None] | None = None,
     ) -> None:
-        """Initialize an epub."""
+        """Initialize an epub.
+
+        If ``defer_trad`` is True the sentences are translated only when needed.
+
+        ``progress`` is called with the number of chapters loaded and the total.
+        """
         # load the file in memory
         self.zipped_file = zipped_file
         self.input_zip = zipfile.ZipFile(self.zipped_file)
@@ -70,7 +81,10 @@ class EPub:
                 self.lang,
                 self.nlp,
                 self.pipe,
+                defer_trad,
             )
+            if progress is not None:
+                progress(chap_id + 1, len(self.chap_file_names[:2]))
 
         # TODO: compute an actual valid chap num
         self.chap_num = len(self.chapters)
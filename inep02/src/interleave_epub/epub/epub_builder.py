@@ -1,7 +1,13 @@
-"""Class to build an epub."""
+"""Class to build an epub.
+
+The files are written straight into the zip archive, no folder is staged on disk.
+The ``mimetype`` file is the first in the archive and is not compressed,
+as the EPub OCF spec requires.
+"""
 
 from pathlib import Path
-from shutil import copyfile, make_archive, rmtree
+from typing import IO
+from zipfile import ZIP_DEFLATED, ZIP_STORED, ZipFile
 
 
 class EpubBuilder:
@@ -46,35 +52,37 @@ class EpubBuilder:
         self.book_name_full = book_name_full
         self.lang_alpha2_tag = lang_alpha2_tag
 
-    def do_build(self) -> None:
+    def do_build(self, epub_out: Path | IO[bytes] | None = None) -> None:
         """Build the EPub.
 
         1. load the templates
+        1. open the zip and write the mimetype
         1. fill the dynamic files
         1. copy the static files
-        1. make the zip and the epub
+
+        Args:
+            epub_out (Path | IO[bytes] | None): Where to write the epub,
+                a file path or a binary buffer like ``io.BytesIO``.
+                If None, ``{clean_title}.epub`` in the output folder,
+                the path is saved in ``epub_file_path``.
         """
         self._clean_title()
 
-        # the base folder for the epub to work in
-        if not self.epub_out_folder.exists():  # pragma: nocover
-            self.epub_out_folder.mkdir(parents=True, exist_ok=True)
-
-        # the folder that holds all the files that will be packed in the zip
-        self._epub_files_folder = self.epub_out_folder / "epub_data"
-        # if there is an old one remove it, or some previous files could be zipped
-        if self._epub_files_folder.exists():  # pragma: nocover
-            rmtree(self._epub_files_folder)
-        # create the fresh one
-        self._epub_files_folder.mkdir(parents=True, exist_ok=True)
+        if epub_out is None:
+            # the base folder for the epub
+            if not self.epub_out_folder.exists():  # pragma: nocover
+                self.epub_out_folder.mkdir(parents=True, exist_ok=True)
+            self.epub_file_path = self.epub_out_folder / f"{self.clean_title}.epub"
+            epub_out = self.epub_file_path
 
         self._load_templates()
 
-        self._build_dynamic()
+        with ZipFile(epub_out, "w", compression=ZIP_DEFLATED) as epub_zip:
+            self._write_mimetype(epub_zip)
 
-        self._copy_static()
+            self._build_dynamic(epub_zip)
 
-        self._create_epub_file()
+            self._copy_static(epub_zip)
 
     def _clean_title(self) -> None:
         """Create a name to use for the file, starting from the book title."""
@@ -135,7 +143,12 @@ class EpubBuilder:
         self._tmpl_toc_nav = toc_nav_path.read_text()
         # logg.debug(f">>>>>> self._tmpl_toc_nav:\n{self._tmpl_toc_nav}")
 
-    def _build_dynamic(self) -> None:
+    def _write_mimetype(self, epub_zip: ZipFile) -> None:
+        """Write the mimetype first in the archive, uncompressed."""
+        mimetype = (self._tmpl_folder / "mimetype").read_bytes()
+        epub_zip.writestr("mimetype", mimetype, compress_type=ZIP_STORED)
+
+    def _build_dynamic(self, epub_zip: ZipFile) -> None:
         r"""Fill the templates to assemble the book.
 
         Keys to fill
@@ -196,8 +209,7 @@ class EpubBuilder:
         preface_filled = self._tmpl_preface.format(
             title=self.book_name_full, author=self.author_name_full
         )
-        preface_path = self._epub_files_folder / preface_name
-        preface_path.write_text(preface_filled)
+        epub_zip.writestr(preface_name, preface_filled)
 
         ###############################################################
         # add every chapter to navpoints/manifest/spine
@@ -209,10 +221,8 @@ class EpubBuilder:
             composed_chapter_name = f"ch_{chapter_index:04d}.xhtml"
             # the location of the composed chapter
             composed_chapter_path = self._composed_folder / composed_chapter_name
-            # the location of the chapter for the ebook
-            epub_chapter_path = self._epub_files_folder / composed_chapter_name
-            # copy the chapter
-            copyfile(composed_chapter_path, epub_chapter_path)
+            # stream the chapter in the ebook
+            epub_zip.write(composed_chapter_path, composed_chapter_name)
 
             # the title of the chapter (for the navpoint)
             chapter_title = f"Chapter {chapter_index}"
@@ -252,8 +262,7 @@ class EpubBuilder:
             all_spine=all_spine,
             lang_alpha2_tag=self.lang_alpha2_tag,
         )
-        content_path = self._epub_files_folder / "content.opf"
-        content_path.write_text(content_filled)
+        epub_zip.writestr("content.opf", content_filled)
 
         ###############################################################
         # build the toc.ncx
@@ -262,54 +271,14 @@ class EpubBuilder:
         toc_filled = self._tmpl_toc.format(
             title=self.book_name_full, all_navpoints=all_navpoints
         )
-        toc_path = self._epub_files_folder / "toc.ncx"
-        toc_path.write_text(toc_filled)
-
-    def _copy_static(self) -> None:
-        r"""Copy the static files of the EPub."""
-        meta_inf_folder = self._epub_files_folder / "META-INF"
-        if not meta_inf_folder.exists():  # pragma: nocover
-            meta_inf_folder.mkdir(parents=True, exist_ok=True)
+        epub_zip.writestr("toc.ncx", toc_filled)
 
+    def _copy_static(self, epub_zip: ZipFile) -> None:
+        r"""Copy the static files of the EPub, the mimetype is already there."""
         for file_name in [
             "META-INF/container.xml",
-            "mimetype",
             "page_styles.css",
             "stylesheet.css",
         ]:
             orig_file_path = self._tmpl_folder / file_name
-            new_file_path = self._epub_files_folder / file_name
-            copyfile(orig_file_path, new_file_path)
-
-    def _create_epub_file(self) -> None:
-        r"""Compress the generated files and assemble the EPub."""
-        # the epub final name
-        epub_file_name = self.clean_title + ".epub"
-        self.epub_file_path = self.epub_out_folder / epub_file_name
-        if self.epub_file_path.exists():  # pragma: nocover
-            self.epub_file_path.unlink()
-        # logg.info(f"self.epub_file_path: {self.epub_file_path}")
-
-        # the zip archive name
-        zip_file_name = self.clean_title + ".zip"
-        self.zip_file_path = self.epub_out_folder / zip_file_name
-        # logg.debug(f"self.zip_file_path: {self.zip_file_path}")
-
-        # the zip base name must be a string
-        # and without the extension
-        zip_file_base_name = self.clean_title
-        self.zip_file_base_path = self.epub_out_folder / zip_file_base_name
-        # logg.debug(f"self.zip_file_base_path: {self.zip_file_base_path}")
-        base_name_zip = str(self.zip_file_base_path)
-
-        # create the archive
-        make_archive(
-            base_name=base_name_zip,
-            format="zip",
-            root_dir=self._epub_files_folder,
-            # dry_run=True,
-            # logger=logg,
-        )
-
-        # rename it to epub
-        self.zip_file_path.rename(self.epub_file_path)
+            epub_zip.write(orig_file_path, file_name)
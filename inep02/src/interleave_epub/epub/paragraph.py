@@ -1,12 +1,18 @@
 """Paragraph class."""
 
+from __future__ import annotations
+
+from typing import TYPE_CHECKING
+
 from bs4 import Tag
 from loguru import logger as lg
-from spacy.language import Language
-from spacy.tokens import Doc, Span
 
 from interleave_epub.nlp.cached_pipe import TranslationPipelineCache
 
+if TYPE_CHECKING:
+    from spacy.language import Language
+    from spacy.tokens import Doc, Span
+
 
 class Paragraph:
     """Paragraph class."""
@@ -17,8 +23,13 @@ class Paragraph:
         lang: dict[str, str],
         nlp: dict[str, Language],
         pipe: dict[str, TranslationPipelineCache],
+        defer_trad: bool = False,
     ) -> None:
-        """Initialize a paragraph."""
+        """Initialize a paragraph.
+
+        If ``defer_trad`` is True the sentences are not translated now,
+        the original ones are used as placeholders until ``translate_sent`` is called.
+        """
         # save the tag
         self.p_tag = p_tag
 
@@ -56,11 +67,21 @@ class Paragraph:
         self.sents["orig"] = list(self.par_doc.sents)
 
         # translate the sentences
-        self.sents["trad"] = []
-        for sent in self.sents["orig"]:
-            str_tran = self.pipe[self.lang["ot_pair_h"]](sent.text)
-            sent_tran = self.nlp[self.lang["trad"]](str_tran)
-            self.sents["trad"].append(sent_tran)
+        self.sents["trad"] = list(self.sents["orig"])
+        self.is_trad = [False] * len(self.sents["orig"])
+        if defer_trad:
+            return
+        for sent_id in range(len(self.sents["orig"])):
+            self.translate_sent(sent_id)
+
+    def translate_sent(self, sent_id: int) -> Doc | Span:
+        """Translate a sentence of the paragraph, if it was not done already."""
+        if not self.is_trad[sent_id]:
+            str_orig = self.sents["orig"][sent_id].text
+            str_tran = self.pipe[self.lang["ot_pair_h"]](str_orig)
+            self.sents["trad"][sent_id] = self.nlp[self.lang["trad"]](str_tran)
+            self.is_trad[sent_id] = True
+        return self.sents["trad"][sent_id]
 
     def __repr__(self) -> str:
         """Repr of the paragraph."""
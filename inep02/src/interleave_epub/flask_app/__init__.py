@@ -1,5 +1,6 @@
 """Initialize app package."""
 
+import os
 from typing import Any
 
 from flask import Flask
@@ -9,8 +10,20 @@ app = Flask(__name__)
 # https://github.com/lepture/python-livereload/issues/144#issuecomment-256277989
 app.config["TEMPLATES_AUTO_RELOAD"] = True
 
-from interleave_epub.interleave.interactive import InterleaverInteractive
+from interleave_epub.flask_app.sessions import SessionStore
+from interleave_epub.flask_app.utils import load_secret_key
+from interleave_epub.interleave.constants import session_memory_budget_mb
+from interleave_epub.utils import get_package_fol
 
-ii = InterleaverInteractive()
+session_cache_fol = get_package_fol("session_cache")
+
+# sign the session cookie that identifies the user
+# the key is kept on disk, so the sessions can be restored after a restart
+app.secret_key = os.environ.get("INTERLEAVE_SECRET_KEY") or load_secret_key(
+    session_cache_fol / "secret_key"
+)
+
+# one interleaver for each browser session
+sessions = SessionStore(session_memory_budget_mb, session_cache_fol)
 
 from interleave_epub.flask_app import routes
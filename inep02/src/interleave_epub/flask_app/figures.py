@@ -0,0 +1,237 @@
+"""Plot the alignment figures, and cache them.
+
+The figures are standalone ``Figure`` objects drawn on an Agg canvas:
+pyplot keeps a reference to every figure it creates until it is closed,
+so a long running server would grow with each click.
+``new_figure`` clears the figure when the plot is rendered.
+
+Rasterizing a big similarity matrix takes a while,
+and the figures only change when the alignment does:
+each figure is kept with the state version of the aligner it was drawn from,
+and drawn again only when the version changes.
+The cache holds the aligners weakly, an evicted aligner takes its figures with it.
+
+The figures are PNG images served from their own URL,
+the version of the figure is in the URL and in the ETag,
+so the browser caches them and the page stays small.
+"""
+
+from collections import OrderedDict
+from contextlib import contextmanager
+import io
+from secrets import token_hex
+from threading import Lock
+from typing import TYPE_CHECKING, Callable, Iterator
+from weakref import WeakKeyDictionary
+
+from interleave_epub.flask_app.utils import fig2png
+from interleave_epub.interleave.align import Aligner
+from interleave_epub.interleave.constants import (
+    heatmap_max_cached_tiles,
+    heatmap_tile_size,
+)
+from interleave_epub.interleave.heatmap import SimTiles
+from interleave_epub.interleave.pyramid import dense_similarity
+
+if TYPE_CHECKING:
+    from matplotlib.axes import Axes
+    from matplotlib.figure import Figure
+
+# the state versions restart when the server does:
+# the ETags start with a token of the process, so they never match an older image
+etag_salt = token_hex(4)
+
+
+@contextmanager
+def new_figure(
+    figsize: tuple[float, float] = (9, 6)
+) -> Iterator[tuple["Figure", "Axes"]]:
+    """Create a figure with one axes, not tracked by pyplot.
+
+    Render the figure inside the ``with`` block,
+    on exit the figure is cleared so that it holds no data.
+    """
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=figsize)
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    try:
+        yield fig, ax
+    finally:
+        fig.clear()
+
+
+def plot_similarity(al: Aligner, figsize: tuple[float, float] = (9, 6)) -> bytes:
+    """Plot the similarity matrix."""
+    with new_figure(figsize) as (fig, ax):
+        ax.set_title(f"Similarity")
+        ax.imshow(dense_similarity(al.sim).T, origin="lower", aspect="auto")
+        # ax.axvline(al.viz_id_src)
+        # ax.axhline(al.viz_id_dst)
+        return fig2png(fig)
+
+
+def plot_alignment(al: Aligner, figsize: tuple[float, float] = (9, 6)) -> bytes:
+    """Plot the sentence matches and the line fitted on them."""
+    with new_figure(figsize) as (fig, ax):
+        ax.scatter(al.all_good_ids_src, al.all_good_ids_dst_max, s=0.1)
+        ax.plot([0, al.sent_num_src], [0, al.sent_num_dst], linewidth=0.3)
+        fit_y = al.fit_func([0, al.sent_num_src])
+        ax.plot([0, al.sent_num_src], fit_y)
+        ax.plot(al.all_ids_src, al.all_ids_dst_max, linewidth=0.9)
+        ax.set_title(f"Alignment")
+        return fig2png(fig)
+
+
+# figure name: (plot, state version of the aligner the figure depends on)
+figure_plots: dict[
+    str, tuple[Callable[[Aligner], bytes], Callable[[Aligner], int | None]]
+] = {
+    "alignment": (plot_alignment, lambda al: al.state_version),
+    "similarity": (plot_similarity, lambda al: al.sim_version),
+}
+
+
+def figure_version(al: Aligner, fig_name: str) -> int | None:
+    """Get the state version of the aligner a figure depends on.
+
+    Raises:
+        KeyError: If there is no figure called ``fig_name``.
+    """
+    return figure_plots[fig_name][1](al)
+
+
+class FigureCache:
+    """The rendered figures of each aligner, with the version they were drawn at."""
+
+    def __init__(self) -> None:
+        """Initialize an empty cache."""
+        # aligner: {figure name: (state version, rendered figure)}
+        self.figures: WeakKeyDictionary[
+            Aligner, dict[str, tuple[int | None, bytes]]
+        ] = WeakKeyDictionary()
+        self.lock = Lock()
+
+    def get(
+        self,
+        al: Aligner,
+        fig_name: str,
+        version: int | None,
+        plot: Callable[[Aligner], bytes],
+    ) -> bytes:
+        """Get a rendered figure, plotting it if missing or stale.
+
+        Args:
+            al (Aligner): The aligner to plot.
+            fig_name (str): The name of the figure.
+            version (int | None): The state version the figure depends on,
+                None if the figure never changes for this aligner.
+            plot (Callable[[Aligner], bytes]): Render the figure.
+        """
+        with self.lock:
+            al_figures = self.figures.setdefault(al, {})
+            if fig_name in al_figures and al_figures[fig_name][0] == version:
+                return al_figures[fig_name][1]
+
+        # plot outside of the lock, two sessions can draw at the same time
+        fig_png = plot(al)
+        with self.lock:
+            self.figures.setdefault(al, {})[fig_name] = (version, fig_png)
+        return fig_png
+
+    def get_named(self, al: Aligner, fig_name: str) -> tuple[bytes, int | None]:
+        """Get a figure of ``figure_plots`` at the current version of the aligner.
+
+        Returns:
+            tuple[bytes, int | None]: The rendered figure and its version.
+
+        Raises:
+            KeyError: If there is no figure called ``fig_name``.
+        """
+        plot, get_version = figure_plots[fig_name]
+        version = get_version(al)
+        return self.get(al, fig_name, version, plot), version
+
+
+# the figures of all the sessions
+figure_cache = FigureCache()
+
+
+def render_tile_png(tiles: SimTiles, level: int, tile_src: int, tile_dst: int) -> bytes:
+    """Color a tile of the similarity as a PNG image, without a figure.
+
+    The src sentences go along x, the dst ones up along y, as in the old plot.
+    The cells outside of the matrix are transparent.
+    """
+    from matplotlib.image import imsave
+
+    tile = tiles.tile(level, tile_src, tile_dst)
+    png_image = io.BytesIO()
+    imsave(png_image, tile.T[::-1], vmin=tiles.vmin, vmax=tiles.vmax, format="png")
+    return png_image.getvalue()
+
+
+class TileCache:
+    """The similarity tiles of each aligner, with the last PNGs rendered."""
+
+    def __init__(self, tile_size: int = 256, max_tiles: int = 64) -> None:
+        """Initialize an empty cache, keeping ``max_tiles`` PNGs per aligner."""
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        # aligner: (tiles, {(level, tile_src, tile_dst): png, oldest first})
+        self.tiles: WeakKeyDictionary[
+            Aligner, tuple[SimTiles, OrderedDict[tuple[int, int, int], bytes]]
+        ] = WeakKeyDictionary()
+        self.lock = Lock()
+
+    def get_tiles(self, al: Aligner) -> SimTiles:
+        """Get the pyramid of the similarity of the aligner, building it once."""
+        with self.lock:
+            if al in self.tiles:
+                return self.tiles[al][0]
+        # build it outside of the lock, two aligners can build at the same time
+        tiles = SimTiles(dense_similarity(al.sim), self.tile_size)
+        with self.lock:
+            return self.tiles.setdefault(al, (tiles, OrderedDict()))[0]
+
+    def get_png(self, al: Aligner, level: int, tile_src: int, tile_dst: int) -> bytes:
+        """Get a tile of the similarity of the aligner as a PNG image.
+
+        Raises:
+            IndexError: If the tile is outside of the pyramid.
+        """
+        tiles = self.get_tiles(al)
+        tile_key = (level, tile_src, tile_dst)
+        with self.lock:
+            pngs = self.tiles[al][1]
+            if tile_key in pngs:
+                pngs.move_to_end(tile_key)
+                return pngs[tile_key]
+
+        png = render_tile_png(tiles, level, tile_src, tile_dst)
+        with self.lock:
+            pngs[tile_key] = png
+            while len(pngs) > self.max_tiles:
+                pngs.popitem(last=False)
+        return png
+
+    def memory_size(self, al: Aligner) -> int:
+        """Estimate the bytes used by the tiles and the PNGs of the aligner.
+
+        A dense similarity is the first level of the pyramid,
+        it is counted by the aligner already.
+        """
+        with self.lock:
+            if al not in self.tiles:
+                return 0
+            tiles, pngs = self.tiles[al]
+            size = tiles.nbytes + sum(len(png) for png in pngs.values())
+        if tiles.levels[0] is al.sim:
+            size -= tiles.levels[0].nbytes
+        return size
+
+
+# the similarity tiles of all the sessions
+tile_cache = TileCache(heatmap_tile_size, heatmap_max_cached_tiles)
@@ -0,0 +1,171 @@
+"""Run the long operations outside of the request thread.
+
+A request submits a job and gets its id right away,
+the page then polls the status of the job and moves on when it is done.
+
+The jobs run one at a time on a single worker thread:
+they all change the same interleaver, so they must not overlap.
+
+A job submitted in a group supersedes the older jobs of the same group:
+the pending ones never start, the running one stops at its next stage.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field
+from threading import Event, Lock
+from timeit import default_timer
+from typing import Callable
+from uuid import uuid4
+
+from loguru import logger as lg
+
+
+class JobCancelled(Exception):
+    """The job was cancelled, raised at the start of the next stage."""
+
+
+@dataclass
+class Job:
+    """A long operation and its progress."""
+
+    job_id: str
+    name: str
+    # jobs in the same group supersede each other
+    group: str | None = None
+    # "pending", "running", "done", "failed" or "cancelled"
+    status: str = "pending"
+    # the current stage and the progress inside of it, in [0, 1]
+    stage: str = ""
+    progress: float = 0.0
+    # stage name: seconds spent in it
+    stage_timings: dict[str, float] = field(default_factory=dict)
+    error: str = ""
+    t_stage: float = 0.0
+    cancel_event: Event = field(default_factory=Event)
+
+    def cancel(self) -> None:
+        """Ask the job to stop at the next stage."""
+        self.cancel_event.set()
+
+    def check_cancelled(self) -> None:
+        """Raise if the job was cancelled."""
+        if self.cancel_event.is_set():
+            raise JobCancelled(f"Job {self.name} cancelled.")
+
+    def set_stage(self, stage: str) -> None:
+        """Start a new stage, closing the timing of the previous one.
+
+        The stages are where a cancelled job stops.
+        """
+        self.check_cancelled()
+        self.close_stage()
+        lg.debug(f"Job {self.name}: {stage}.")
+        self.stage = stage
+        self.progress = 0.0
+        self.t_stage = default_timer()
+
+    def close_stage(self) -> None:
+        """Record how long the current stage took."""
+        if self.stage != "":
+            self.stage_timings[self.stage] = default_timer() - self.t_stage
+
+    def set_progress(self, done: int, total: int) -> None:
+        """Update the progress of the current stage."""
+        self.progress = done / total if total > 0 else 1.0
+
+    @property
+    def is_finished(self) -> bool:
+        """True if the job is done, failed or cancelled."""
+        return self.status in ("done", "failed", "cancelled")
+
+    def to_dict(self) -> dict:
+        """Serialize the status of the job."""
+        return {
+            "job_id": self.job_id,
+            "name": self.name,
+            "group": self.group,
+            "status": self.status,
+            "stage": self.stage,
+            "progress": self.progress,
+            "stage_timings": self.stage_timings,
+            "error": self.error,
+        }
+
+
+class JobManager:
+    """Run jobs on a worker thread and keep track of them."""
+
+    def __init__(self, max_jobs: int = 50) -> None:
+        """Initialize the manager, keeping the last ``max_jobs`` jobs."""
+        self.max_jobs = max_jobs
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="job")
+        self.jobs: OrderedDict[str, Job] = OrderedDict()
+        self.lock = Lock()
+
+    def submit(
+        self,
+        name: str,
+        func: Callable,
+        *args,
+        group: str | None = None,
+        **kwargs,
+    ) -> Job:
+        """Submit a function to run as a job.
+
+        The function gets the job as the keyword argument ``job``,
+        to report the stages and the progress.
+        The unfinished jobs in the same ``group`` are cancelled.
+        """
+        job = Job(job_id=uuid4().hex, name=name, group=group)
+        with self.lock:
+            if group is not None:
+                for job_old in self.jobs.values():
+                    if job_old.group == group and not job_old.is_finished:
+                        lg.debug(f"Job {job_old.name} superseded by {name}.")
+                        job_old.cancel()
+            self.jobs[job.job_id] = job
+            # forget the oldest finished jobs
+            for job_id_old in list(self.jobs):
+                if len(self.jobs) <= self.max_jobs:
+                    break
+                if self.jobs[job_id_old].is_finished:
+                    self.jobs.pop(job_id_old)
+        self.executor.submit(self.run, job, func, *args, **kwargs)
+        return job
+
+    def run(self, job: Job, func: Callable, *args, **kwargs) -> None:
+        """Run the job function, recording how it went."""
+        if job.cancel_event.is_set():
+            job.status = "cancelled"
+            return
+        job.status = "running"
+        try:
+            func(*args, job=job, **kwargs)
+        except JobCancelled:
+            lg.debug(f"Job {job.name} stopped at {job.stage}.")
+            job.close_stage()
+            job.status = "cancelled"
+            return
+        except Exception as e:
+            lg.exception(f"Job {job.name} failed.")
+            job.close_stage()
+            job.status = "failed"
+            job.error = repr(e)
+            return
+        job.close_stage()
+        job.progress = 1.0
+        job.status = "done"
+        lg.debug(f"Job {job.name} done: {job.stage_timings}.")
+
+    def get(self, job_id: str) -> Job | None:
+        """Get a job by id."""
+        return self.jobs.get(job_id)
+
+    def get_unfinished(self) -> Job | None:
+        """Get the latest job still pending or running, if any."""
+        with self.lock:
+            for job in reversed(self.jobs.values()):
+                if not job.is_finished:
+                    return job
+        return None
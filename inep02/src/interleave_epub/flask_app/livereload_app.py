@@ -2,10 +2,21 @@
 from livereload import Server
 
 from interleave_epub.flask_app import app
+from interleave_epub.interleave.constants import (
+    lt_dst_default,
+    lt_src_default,
+    warm_up_models_at_start,
+)
+from interleave_epub.nlp.model_registry import warm_up_models
 
 
 def main():
     """Serve the app."""
+    # load the models while the first user picks the books
+    # not at import: the align workers import the app too, and would load them again
+    if warm_up_models_at_start:
+        warm_up_models(lt_src_default, lt_dst_default)
+
     # remember to use DEBUG mode for templates auto reload
     # https://github.com/lepture/python-livereload/issues/144
     app.debug
@@ -1,13 +1,42 @@
 """Routes for the flask app."""
 
 from pathlib import Path
-
-from flask import redirect, render_template, request, url_for
+from typing import IO
+
+from flask import (
+    jsonify,
+    redirect,
+    render_template,
+    request,
+    session,
+    url_for,
+)
 from loguru import logger as lg
 
-from interleave_epub.flask_app import app, ii
-from interleave_epub.flask_app.render import render_align, render_load
-from interleave_epub.flask_app.utils import flatten_multidict, permanentize_form_file
+from interleave_epub.flask_app import app, sessions
+from interleave_epub.flask_app.figures import etag_salt, figure_cache, tile_cache
+from interleave_epub.flask_app.jobs import Job, JobManager
+from interleave_epub.flask_app.render import (
+    align_state,
+    render_align,
+    render_job,
+    render_load,
+)
+from interleave_epub.flask_app.sessions import Session
+from interleave_epub.flask_app.utils import (
+    flatten_multidict,
+    permanentize_form_file,
+    png_response,
+    save_upload,
+)
+from interleave_epub.interleave.interactive import InterleaverInteractive
+
+
+def current_session() -> Session:
+    """Get the interleaver state of the user, identified by the session cookie."""
+    if "session_id" not in session:
+        session["session_id"] = sessions.new_session_id()
+    return sessions.get(session["session_id"])
 
 
 @app.route("/")
@@ -103,27 +132,85 @@ def load_ep():
             file_io_src = epub_paths["br"]
             file_io_dst = epub_paths["en"]
 
-        # set the lang tags
-        ii.set_lang_tag(lt_src, "src")
-        ii.set_lang_tag(lt_dst, "dst")
-
-        # load the models
-        ii.load_nlp()
-
-        # load the books
-        ii.add_book(file_io_src, "src", file_name_src, file_author)
-        ii.add_book(file_io_dst, "dst", file_name_dst, file_author)
+        # keep the uploaded books on disk, to restore the session after a restart
+        elif sessions.session_cache_fol is not None:
+            file_io_src = save_upload(file_io_src, sessions.books_fol, ".epub")
+            file_io_dst = save_upload(file_io_dst, sessions.books_fol, ".epub")
 
-        # go forth and align
+        # load the books in the background and go forth and align
         # TODO: some way to force the align with no cache
-        return redirect(url_for("align", first_align=""))
+        ses = current_session()
+        job = ses.jobs.submit(
+            "load",
+            load_books_job,
+            ses.ii,
+            lt_src,
+            lt_dst,
+            (file_io_src, file_name_src),
+            (file_io_dst, file_name_dst),
+            file_author,
+        )
+        return redirect(url_for("job_page", job_id=job.job_id))
 
     return render_load()
 
 
+def load_books_job(
+    ii: InterleaverInteractive,
+    lt_src: str,
+    lt_dst: str,
+    file_src: tuple[IO[bytes] | Path, str],
+    file_dst: tuple[IO[bytes] | Path, str],
+    file_author: str,
+    job: Job,
+):
+    """Load the models and the books, then align the first chapter."""
+    # set the lang tags
+    ii.set_lang_tag(lt_src, "src")
+    ii.set_lang_tag(lt_dst, "dst")
+
+    # load the models
+    job.set_stage("load_nlp")
+    ii.load_nlp()
+
+    # load the books
+    job.set_stage("load_src")
+    ii.add_book(file_src[0], "src", file_src[1], file_author, job.set_progress)
+    job.set_stage("load_dst")
+    ii.add_book(file_dst[0], "dst", file_dst[1], file_author, job.set_progress)
+
+    # a quick first alignment using only the paragraph lengths
+    job.set_stage("align_length")
+    ii.align_length()
+
+    ii.align_auto(on_stage=job.set_stage)
+
+
+@app.route("/jobs/<job_id>")
+def job_page(job_id: str):
+    """Render the page that waits for a job, then goes to the align page."""
+    job = current_session().jobs.get(job_id)
+    if job is None:
+        return redirect(url_for("align"))
+    return render_job(job, url_for("job_status", job_id=job_id), url_for("align"))
+
+
+@app.route("/jobs/<job_id>/status")
+def job_status(job_id: str):
+    """Return the status and progress of a job."""
+    job = current_session().jobs.get(job_id)
+    if job is None:
+        return jsonify({"error": f"Unknown job {job_id}."}), 404
+    return jsonify(job.to_dict())
+
+
 @app.route("/align", methods=["GET", "POST"])
 def align():
     """Align two epubs."""
+    # the interleaver of this user
+    ses = current_session()
+    ii, jobs = ses.ii, ses.jobs
+
     # parse POST request
     lg.debug(f"{request=}")
     if request.method == "POST":
@@ -136,26 +223,218 @@ def align():
     elif request.method == "GET":
         args_data = flatten_multidict(request.args)
         lg.debug(f"{args_data=}")
+        try:
+            job = apply_align_action(ii, jobs, args_data)
+        except (KeyError, ValueError, TypeError) as e:
+            # e.g. a stale link, show the page as it is
+            lg.warning(f"Bad action {args_data}: {e!r}")
+            job = None
+        if job is not None:
+            return redirect(url_for("job_page", job_id=job.job_id))
+
+    # render the page only when the alignment is ready
+    job = wait_for_alignment(ses)
+    if job is not None:
+        return redirect(url_for("job_page", job_id=job.job_id))
+    if ii.ch_id_pair_str not in ii.aligners:
+        return redirect(url_for("load_ep"))
+
+    ses.save_manifest()
+    return render_align(ii)
 
-        if "first_align" in args_data:
-            ii.align_auto()
-
-        elif "dst_pick" in args_data:
-            dst_pick = int(args_data["dst_pick"])
-            ii.pick_dst_par(dst_pick)
-
-        elif "chap_move" in args_data:
-            chap_move = args_data["chap_move"]
-            ii.change_chapter_curr(chap_move)
-
-        elif "delta_move" in args_data:
-            delta_move = args_data["delta_move"]
-            ii.change_chapter_delta(delta_move)
 
-        elif "ignore_cached_match" in args_data:
-            ii.align_auto(force_align=True)
+@app.route("/api/align", methods=["GET", "POST"])
+def align_api():
+    """Apply an action of the align page and return the new state as JSON.
 
-        elif "save_epub" in args_data:
-            ii.save_epub()
+    The POST body is a JSON object with the same actions as the ``/align`` query,
+    like ``{"dst_pick": 12}``,
+    or many fixes at once as ``{"dst_picks": [[src par id, dst par id], ...]}``.
+    The response is the state of ``align_state``, with ``mapping_changes``:
+    the paragraph matches changed by the action, as ``{src par id: dst par id}``.
+    If the alignment is not ready, the response is a 202 with the job to poll.
+    """
+    ses = current_session()
+    ii, jobs = ses.ii, ses.jobs
 
-    return render_align(ii)
+    job = None
+    mapping_old: dict[int, int] = {}
+    if request.method == "POST":
+        args_data = request.get_json(silent=True) or {}
+        lg.debug(f"{args_data=}")
+        al_old = ii.aligners.get(ii.ch_id_pair_str)
+        if al_old is not None:
+            mapping_old = dict(al_old.better_par_src_to_dst_flat)
+        try:
+            job = apply_align_action(ii, jobs, args_data)
+        except (KeyError, ValueError, TypeError) as e:
+            return jsonify({"error": f"Bad action: {e!r}"}), 400
+
+    if job is None:
+        job = wait_for_alignment(ses)
+    if job is not None:
+        job_info = {
+            "job": job.to_dict(),
+            "status_url": url_for("job_status", job_id=job.job_id),
+        }
+        return jsonify(job_info), 202
+    if ii.ch_id_pair_str not in ii.aligners:
+        return jsonify({"error": "Load the books first."}), 409
+
+    state = align_state(ii)
+    # a chapter move always starts a job, so this is still the same aligner
+    mapping = ii.aligners[ii.ch_id_pair_str].better_par_src_to_dst_flat
+    state["mapping_changes"] = {
+        src_id: int(dst_id)
+        for src_id, dst_id in mapping.items()
+        if src_id in mapping_old and mapping_old[src_id] != dst_id
+    }
+    ses.save_manifest()
+    return jsonify(state)
+
+
+def apply_align_action(
+    ii: InterleaverInteractive, jobs: JobManager, args_data: dict
+) -> Job | None:
+    """Apply an action of the align page.
+
+    The slow operations run as jobs, the page waits for them:
+    a new alignment supersedes the one still running for a stale pair.
+
+    Returns:
+        Job | None: The job started by the action, if any.
+    """
+    job = None
+    if "first_align" in args_data:
+        job = jobs.submit("align", align_job, ii, group="align")
+
+    elif "dst_pick" in args_data:
+        dst_pick = int(args_data["dst_pick"])
+        ii.pick_dst_par(dst_pick)
+
+    elif "dst_picks" in args_data:
+        # a list of [src par id, dst par id] pairs, applied together
+        dst_picks = [(int(src), int(dst)) for src, dst in args_data["dst_picks"]]
+        ii.pick_dst_pars(dst_picks)
+
+    elif "accept_window" in args_data:
+        ii.accept_window_guesses()
+
+    elif "undo" in args_data:
+        ii.undo_pick()
+
+    elif "redo" in args_data:
+        ii.redo_pick()
+
+    elif "chap_move" in args_data:
+        chap_move = args_data["chap_move"]
+        ii.change_chapter_curr(chap_move, align=False)
+        job = jobs.submit("chap_move", align_job, ii, group="align")
+
+    elif "delta_move" in args_data:
+        delta_move = args_data["delta_move"]
+        ii.change_chapter_delta(delta_move, align=False)
+        job = jobs.submit("delta_move", align_job, ii, group="align")
+
+    elif "ignore_cached_match" in args_data:
+        job = jobs.submit("align", align_job, ii, group="align", force_align=True)
+
+    elif "align_all" in args_data:
+        job = jobs.submit("align_all", align_all_job, ii)
+
+    elif "save_epub" in args_data:
+        job = jobs.submit("save_epub", save_epub_job, ii)
+
+    return job
+
+
+def wait_for_alignment(ses: Session) -> Job | None:
+    """Find the job the align page has to wait for, aligning the pair if needed.
+
+    A session with no books is restored from its manifest, if it has one.
+
+    Returns:
+        Job | None: The job to wait for,
+            None if the alignment is ready or there are no books to align.
+    """
+    ii, jobs = ses.ii, ses.jobs
+    job = jobs.get_unfinished()
+    if job is not None:
+        return job
+    if ses.can_restore:
+        return jobs.submit("restore", restore_job, ses)
+    if ii.ch_id_pair_str not in ii.aligners and ii.has_both_epubs:
+        return jobs.submit("align", align_job, ii, group="align")
+    return None
+
+
+def restore_job(ses: Session, job: Job):
+    """Load the books of the session from its manifest, then align the chapter."""
+    manifest = ses.manifest
+    if manifest is None:
+        return
+    # a restore that fails is not tried again, the user can load the books
+    ses.manifest = None
+    ses.ii.restore_manifest(manifest, on_stage=job.set_stage, progress=job.set_progress)
+    ses.manifest = manifest
+    ses.ii.align_auto(on_stage=job.set_stage)
+
+
+@app.route("/heatmap/<ch_id_pair_str>")
+def heatmap_tile(ch_id_pair_str: str):
+    """Serve a tile of the similarity heatmap of a chapter pair.
+
+    The query has the ``level`` of the pyramid and the tile ids ``src`` and ``dst``.
+    The URL also has the version ``v`` of the similarity, so the tile can be cached.
+    """
+    al = current_session().ii.aligners.get(ch_id_pair_str)
+    if al is None:
+        return jsonify({"error": f"No aligner for {ch_id_pair_str}."}), 404
+    try:
+        level = int(request.args["level"])
+        tile_src = int(request.args["src"])
+        tile_dst = int(request.args["dst"])
+        png = tile_cache.get_png(al, level, tile_src, tile_dst)
+    except (KeyError, ValueError, IndexError) as e:
+        return jsonify({"error": f"Bad tile: {e!r}"}), 404
+    etag = f"{etag_salt}-sim-{al.sim_version}-{level}-{tile_src}-{tile_dst}"
+    # a link to an old version gets the current tile, that must not be kept
+    is_current = request.args.get("v") == str(al.sim_version)
+    return png_response(png, etag, max_age=3600 if is_current else 0)
+
+
+@app.route("/figure/<ch_id_pair_str>/<fig_name>")
+def figure(ch_id_pair_str: str, fig_name: str):
+    """Serve a figure of a chapter pair, like the ``alignment`` plot.
+
+    The URL has the state version ``v`` the figure was drawn at,
+    so the figure can be cached until the alignment changes.
+    """
+    al = current_session().ii.aligners.get(ch_id_pair_str)
+    if al is None:
+        return jsonify({"error": f"No aligner for {ch_id_pair_str}."}), 404
+    try:
+        png, version = figure_cache.get_named(al, fig_name)
+    except KeyError:
+        return jsonify({"error": f"No figure called {fig_name}."}), 404
+    etag = f"{etag_salt}-{fig_name}-{version}"
+    is_current = request.args.get("v") == str(version)
+    return png_response(png, etag, max_age=3600 if is_current else 0)
+
+
+def align_job(ii: InterleaverInteractive, job: Job, force_align: bool = False):
+    """Align the current chapter pair."""
+    ii.align_auto(force_align=force_align, on_stage=job.set_stage)
+
+
+def align_all_job(ii: InterleaverInteractive, job: Job):
+    """Align all the chapter pairs, then the current one."""
+    job.set_stage("align_all")
+    ii.align_all(progress=job.set_progress)
+    ii.align_auto(on_stage=job.set_stage)
+
+
+def save_epub_job(ii: InterleaverInteractive, job: Job):
+    """Build the interleaved epub."""
+    job.set_stage("save_epub")
+    ii.save_epub()
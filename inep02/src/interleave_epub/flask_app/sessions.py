@@ -0,0 +1,192 @@
+"""Keep an interleaver for each browser session.
+
+Each session has its own books, aligners and job worker,
+the models are shared by all the sessions through the model registry.
+
+The sessions are kept in least recently used order.
+When the estimated memory goes above the budget,
+first the aligners of the oldest sessions are dropped,
+then the oldest sessions altogether.
+The alignments are in the align cache on disk,
+so an evicted aligner is rebuilt instantly and
+an evicted session only needs to load the books again.
+
+Each session writes a small manifest, with the language tags,
+the paths of the books and the chapter ids.
+After a restart of the server, or an eviction,
+the session is restored from it the first time the align page is asked for:
+the books are loaded again from disk,
+the translations, the similarities and the alignments come from their caches.
+"""
+
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import json
+from pathlib import Path
+from threading import Lock
+from uuid import uuid4
+
+from loguru import logger as lg
+
+from interleave_epub.flask_app.figures import tile_cache
+from interleave_epub.flask_app.jobs import JobManager
+from interleave_epub.interleave.interactive import InterleaverInteractive
+
+
+@dataclass
+class Session:
+    """The state of a browser session."""
+
+    session_id: str
+    ii: InterleaverInteractive = field(default_factory=InterleaverInteractive)
+    # the jobs of this session run one at a time, other sessions do not wait
+    jobs: JobManager = field(default_factory=JobManager)
+    # where the manifest of the session is written, None to not write it
+    manifest_path: Path | None = None
+    # the last manifest written or read, if the session can be restored from it
+    manifest: dict | None = None
+
+    def __post_init__(self) -> None:
+        """Count the heatmap tiles of the aligners in the memory of the session."""
+        self.ii.aligner_extra_size = tile_cache.memory_size
+
+    @property
+    def is_busy(self) -> bool:
+        """True if a job of the session is still pending or running."""
+        return self.jobs.get_unfinished() is not None
+
+    def load_manifest(self) -> None:
+        """Read the manifest of a previous run, if its books are still there."""
+        if self.manifest_path is None or not self.manifest_path.exists():
+            return
+        manifest = json.loads(self.manifest_path.read_text())
+        for book_file in manifest["book_files"].values():
+            if not Path(book_file["path"]).exists():
+                lg.warning(f"Missing book {book_file['path']}, cannot restore.")
+                return
+        self.manifest = manifest
+
+    def save_manifest(self) -> None:
+        """Write the manifest of the session, if it changed."""
+        if self.manifest_path is None:
+            return
+        manifest = self.ii.to_manifest()
+        if manifest is None or manifest == self.manifest:
+            return
+        self.manifest_path.write_text(json.dumps(manifest, indent=4))
+        self.manifest = manifest
+
+    @property
+    def can_restore(self) -> bool:
+        """True if the books are not loaded but the manifest can load them."""
+        return not self.ii.has_both_epubs and self.manifest is not None
+
+    def close(self) -> None:
+        """Stop the background work of the session."""
+        self.ii.prefetcher.clear()
+        for job in self.jobs.jobs.values():
+            job.cancel()
+        self.jobs.executor.shutdown(wait=False, cancel_futures=True)
+        self.ii.prefetcher.executor.shutdown(wait=False, cancel_futures=True)
+
+
+class SessionStore:
+    """The sessions of the server, evicted under a memory budget."""
+
+    def __init__(
+        self, memory_budget_mb: float, session_cache_fol: Path | None = None
+    ) -> None:
+        """Initialize an empty store.
+
+        Args:
+            memory_budget_mb (float): The memory the sessions can use.
+            session_cache_fol (Path | None): Where the manifests of the sessions
+                and the uploaded books are written, None to not keep them.
+        """
+        self.memory_budget = int(memory_budget_mb * 2**20)
+        self.session_cache_fol = session_cache_fol
+        if self.session_cache_fol is not None:
+            self.books_fol.mkdir(parents=True, exist_ok=True)
+        # session id: session, least recently used first
+        self.sessions: OrderedDict[str, Session] = OrderedDict()
+        self.lock = Lock()
+
+    @property
+    def books_fol(self) -> Path:
+        """The folder of the uploaded books."""
+        if self.session_cache_fol is None:
+            raise ValueError("The sessions are not kept on disk.")
+        return self.session_cache_fol / "books"
+
+    def new_session_id(self) -> str:
+        """Create an id for a new session."""
+        return uuid4().hex
+
+    def manifest_path(self, session_id: str) -> Path | None:
+        """Get the path of the manifest of a session, if they are kept."""
+        # the id comes from the signed cookie, but it becomes a file name
+        if self.session_cache_fol is None or not session_id.isalnum():
+            return None
+        return self.session_cache_fol / f"manifest_{session_id}.json"
+
+    def get(self, session_id: str) -> Session:
+        """Get the session, creating it if needed, and mark it as used.
+
+        The other sessions are evicted if the memory is over budget.
+        """
+        with self.lock:
+            if session_id in self.sessions:
+                self.sessions.move_to_end(session_id)
+            else:
+                lg.info(f"New session {session_id}.")
+                ses = Session(session_id, manifest_path=self.manifest_path(session_id))
+                ses.load_manifest()
+                self.sessions[session_id] = ses
+            self.enforce_budget(session_id)
+            return self.sessions[session_id]
+
+    def memory_size(self) -> int:
+        """Estimate the bytes used by all the sessions."""
+        return sum(ses.ii.memory_size() for ses in self.sessions.values())
+
+    def enforce_budget(self, session_id_keep: str) -> None:
+        """Evict the least recently used state until the memory is under budget.
+
+        The sessions with a job running are left alone.
+        The current aligner of each session is kept until its session is evicted.
+        """
+        mem_size = self.memory_size()
+        if mem_size <= self.memory_budget:
+            return
+        lg.info(f"Sessions use {mem_size/2**20:.0f}MB, evicting.")
+
+        # first the aligners, starting from the oldest sessions
+        for ses in self.sessions.values():
+            if mem_size <= self.memory_budget:
+                return
+            if ses.is_busy:
+                continue
+            mem_size -= ses.ii.evict_aligners(mem_size - self.memory_budget)
+
+        # then the whole sessions, never the one being used
+        for session_id in list(self.sessions):
+            if mem_size <= self.memory_budget:
+                return
+            ses = self.sessions[session_id]
+            if session_id == session_id_keep or ses.is_busy:
+                continue
+            mem_size -= ses.ii.memory_size()
+            self.drop(session_id)
+
+    def drop(self, session_id: str) -> None:
+        """Forget a session."""
+        ses = self.sessions.pop(session_id, None)
+        if ses is None:
+            return
+        # the alignment state of the user is in the align cache
+        for al in ses.ii.aligners.values():
+            al.save_align_state()
+        # and the books in the manifest, to restore the session if it comes back
+        ses.save_manifest()
+        ses.close()
+        lg.info(f"Evicted session {session_id}.")
@@ -1,38 +1,102 @@
 """Misc functions to support Flask apps."""
 
 import base64
+from hashlib import sha256
 import io
+from pathlib import Path
+import secrets
+from typing import TYPE_CHECKING
 
-from matplotlib.backends.backend_agg import FigureCanvasAgg
-from matplotlib.figure import Figure
+from flask import make_response, request
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
+from werkzeug.wrappers import Response
 
+if TYPE_CHECKING:
+    from matplotlib.figure import Figure
 
-def fig2imgb64str(fig: Figure) -> str:
-    """Encode a matplotlib figure as a base64 string.
 
-    In the jinja2 template use the following <img> to add the plot::
+def fig2png(fig: "Figure") -> bytes:
+    """Render a matplotlib figure as a PNG image."""
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
 
-        <img src="{{ image }}"/>
-    """
-    # convert plot to PNG image
     pngImage = io.BytesIO()
     FigureCanvasAgg(fig).print_png(pngImage)
+    return pngImage.getvalue()
 
-    # encode PNG image to base64 string
-    pngImageB64String = "data:image/png;base64,"
-    pngImageB64String += base64.b64encode(pngImage.getvalue()).decode("utf8")
 
+def png2imgb64str(png: bytes) -> str:
+    """Encode a PNG image as a base64 data URI.
+
+    In the jinja2 template use the following <img> to add the plot::
+
+        <img src="{{ image }}"/>
+    """
+    pngImageB64String = "data:image/png;base64,"
+    pngImageB64String += base64.b64encode(png).decode("utf8")
     return pngImageB64String
 
 
+def fig2imgb64str(fig: "Figure") -> str:
+    """Encode a matplotlib figure as a base64 data URI."""
+    return png2imgb64str(fig2png(fig))
+
+
+def png_response(png: bytes, etag: str, max_age: int = 0) -> Response:
+    """Send a PNG image that the browser can cache.
+
+    If the browser already has the image with the same ``etag``,
+    the response is an empty 304.
+
+    Args:
+        png (bytes): The image.
+        etag (str): Changes whenever the image does.
+        max_age (int): Seconds the browser can use the image without asking again,
+            zero to always revalidate it with the ``etag``.
+    """
+    response = make_response(png)
+    response.mimetype = "image/png"
+    response.set_etag(etag)
+    if max_age > 0:
+        response.headers["Cache-Control"] = f"private, max-age={max_age}"
+    else:
+        response.headers["Cache-Control"] = "private, no-cache"
+    return response.make_conditional(request)
+
+
 # def flatten_multidict(md: ImmutableMultiDict) -> dict:
 def flatten_multidict(md) -> dict:
     """Flatten a multi dict, hoping that there are no key conflicts."""
     return {k: md[k] for k in md}
 
 
+def load_secret_key(key_path: Path) -> str:
+    """Read the secret key of the app, creating it the first time.
+
+    The session cookies signed with it stay valid after a restart.
+    """
+    if key_path.exists():
+        return key_path.read_text().strip()
+    key_path.parent.mkdir(parents=True, exist_ok=True)
+    secret_key = secrets.token_hex()
+    key_path.write_text(secret_key)
+    key_path.chmod(0o600)
+    return secret_key
+
+
+def save_upload(file_io_stream: io.BytesIO, upload_fol: Path, suffix: str) -> Path:
+    """Write an uploaded file to disk, named after its content.
+
+    The same book uploaded twice is written once.
+    """
+    file_bytes_content = file_io_stream.getvalue()
+    file_hash = sha256(file_bytes_content).hexdigest()[:32]
+    file_path = upload_fol / f"{file_hash}{suffix}"
+    if not file_path.exists():
+        file_path.write_bytes(file_bytes_content)
+    return file_path
+
+
 def permanentize_form_file(uploaded_file: FileStorage) -> tuple[str, io.BytesIO]:
     """Save to memory the content of the SpooledTemporaryFile."""
     file_name = uploaded_file.filename
@@ -1,22 +1,40 @@
 """Align to list of sentences."""
 
-from collections import Counter
-from itertools import groupby
-import json
+from itertools import count
 from math import isnan
 from pathlib import Path
 from timeit import default_timer
+from typing import TYPE_CHECKING, Callable
 
 from loguru import logger as lg
 import numpy as np
-import pandas as pd
-from scipy.signal.windows import triang
-from sentence_transformers import SentenceTransformer
-from sklearn.metrics.pairwise import cosine_similarity
 
 from interleave_epub.epub.chapter import Chapter
+from interleave_epub.interleave.align_journal import AlignJournal
+from interleave_epub.interleave.engine import (
+    AlignResult,
+    ChapterFeatures,
+    SimilaritySource,
+    build_engine,
+    find_ooo_ids,
+    interpolate_ooo_ids,
+)
+from interleave_epub.interleave.pyramid import BandSimilarity
+from interleave_epub.interleave.rerank import RerankScorer
+from interleave_epub.interleave.similarity import (
+    adjust_sentence_similarity,
+    compute_similarity,
+    load_similarity,
+    save_similarity,
+    similarity_cache_path,
+)
 from interleave_epub.nlp.utils import sentence_encode_np
-from interleave_epub.utils import are_contiguos
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+
+# unique across all the aligners, a rebuilt aligner never reuses a version
+state_versions = count()
 
 
 class Aligner:
@@ -29,12 +47,48 @@ class Aligner:
         sent_which_align: dict[str, str],
         ch_id_pair_str: str,
         lt_sent_tra: str,
-        sent_transformer: SentenceTransformer,
+        sent_transformer: dict[str, "SentenceTransformer"],
         align_cache_fol: Path,
         force_align: bool = False,
         viz_win_size: int = 10,
+        engine_name: str = "greedy_triangle",
+        engine_kwargs: dict | None = None,
+        length_prior_weight: float = 0.0,
+        sim_method: str = "sent_transformer",
+        auto_accept_th: float | None = None,
+        rerank_scorer: RerankScorer | None = None,
+        on_stage: Callable[[str], None] | None = None,
     ) -> None:
-        """Initialize the aligner."""
+        """Initialize the aligner.
+
+        The matching is done by the registered engine ``engine_name``,
+        built with ``engine_kwargs``:
+        ``greedy_triangle`` compares all the sentences,
+        ``pyramid`` aligns blocks of sentences first and then refines
+        only near the coarse path, useful for very long chapters,
+        ``paragraph`` encodes the paragraphs and aligns them directly,
+        using the sentences only where unsure.
+
+        If ``length_prior_weight`` is positive, the similarity is mixed
+        with a prior built from the Gale-Church length alignment of the sentences.
+
+        ``sim_method`` can be ``sent_transformer``, to compare the embeddings,
+        ``lexical``, to compare hashed n-grams and anchor tokens
+        of the original sentences, without any model,
+        or ``anchor``, to translate and embed only a sample of the src sentences.
+
+        Each paragraph match gets a confidence in ``[0, 1]``,
+        the out of order paragraphs with confidence above ``auto_accept_th``
+        are accepted without asking.
+
+        If a ``rerank_scorer`` is passed, the sentences whose best match is unsure
+        have their top candidates scored again with it.
+
+        ``on_stage`` is called with the name of each stage when it starts:
+        ``encode``, ``similarity`` and ``align``.
+        It can raise to stop the alignment at a stage boundary,
+        e.g. if the chapter pair is not needed anymore.
+        """
         self.ch_src = ch_src
         self.ch_dst = ch_dst
         self.sent_which_align = sent_which_align
@@ -43,6 +97,15 @@ class Aligner:
         self.ch_id_pair_str = ch_id_pair_str
         self.align_cache_fol = align_cache_fol
         self.viz_win_size = viz_win_size
+        self.engine_name = engine_name
+        self.engine = build_engine(engine_name, **(engine_kwargs or {}))
+        self.length_prior_weight = length_prior_weight
+        self.sim_method = sim_method
+        self.auto_accept_th = auto_accept_th
+        self.rerank_scorer = rerank_scorer
+        self.on_stage = on_stage
+        # short src sentences with a clear match after the reranking
+        self.reranked_sure_ids: set[int] = set()
 
         # extract the right list of sentences to use when computing the similarity
         self.sents_text_src_align = self.ch_src.sents_text[self.sent_which_align["src"]]
@@ -55,8 +118,11 @@ class Aligner:
         self.match_info_path: dict[str, Path] = {}
         align_info_name = f"info_align_{self.ch_id_pair_str}.json"
         self.match_info_path["align"] = self.align_cache_fol / align_info_name
-        sim_name = f"info_sim_{self.ch_id_pair_str}.npy"
-        self.match_info_path["sim"] = self.align_cache_fol / sim_name
+        self.match_info_path["sim"] = similarity_cache_path(
+            self.align_cache_fol, self.engine_name, self.ch_id_pair_str
+        )
+        # the picks are appended to a journal next to the align info
+        self.journal = AlignJournal(self.match_info_path["align"])
 
         # use cached res if force align is false and all the paths exist
         use_cached_res = (
@@ -71,37 +137,37 @@ class Aligner:
         # we want all the other class variables to be set
 
         if use_cached_res:
-            self.sim = np.load(self.match_info_path["sim"])
+            self.sim = load_similarity(self.match_info_path["sim"])
         else:
-            self.compute_sentence_similarity()
+            self.report_stage("encode")
+            if self.engine.sim_level == "sentence" and self.sim_method == "anchor":
+                self.compute_anchor_similarity()
+            else:
+                self.compute_similarity()
             # save the similarity
-            np.save(self.match_info_path["sim"], self.sim)
-
-        self.align_sentences()
-
-        # # if we have an alignment already computed, load it
-        # # unless we are forcing a realignment
-        # # the only thing we change are the matching dst ids
-        # if use_cached_res:
-        #     lg.info("Found match info at {}", self.match_info_path["align"])
-        #     align_info = json.loads(self.match_info_path["align"].read_text())
-        #     self.all_ids_dst_max: list[int] = align_info["all_ids_dst_max"]
-        #     # TODO reload fixed_src_ids as well?
-
-        # use the possibly updated matching to compute ooo ids
-        self.compute_ooo_ids()
-        self.interpolate_ooo_ids()
-
-        # align the paragraphs
-        self.align_paragraphs()
+            save_similarity(self.match_info_path["sim"], self.sim)
+        # the views of the similarity change only when it is computed again
+        self.sim_version = next(state_versions)
+
+        # run the engine and copy the result in the aligner
+        try:
+            self.report_stage("align")
+            self.align_with_engine(refine=not use_cached_res)
+        except Exception:
+            # a cancelled or failed alignment must not look cached next time
+            if not use_cached_res:
+                self.match_info_path["sim"].unlink(missing_ok=True)
+            raise
 
+        # src ids we have set manually, to be skipped when searching for ooo ids
+        self.fixed_src_par_ids: list[int] = []
         # reload the partial paragraph matches
         if use_cached_res:
             lg.info("Found match info at {}", self.match_info_path["align"])
-            align_info = json.loads(self.match_info_path["align"].read_text())
-            tmp: dict[int, int] = align_info["better_par_src_to_dst_flat"]
-            # json files treat keys as string
-            self.better_par_src_to_dst_flat = {int(k): v for k, v in tmp.items()}
+            align_info = self.journal.load()
+            self.better_par_src_to_dst_flat = align_info["better_par_src_to_dst_flat"]
+            self.fixed_src_par_ids = align_info["fixed_src_par_ids"]
+            self.bump_state_version()
         else:
             # if you are not reloading, save the initial match
             # or next time the use_cached_res will still be false
@@ -109,333 +175,240 @@ class Aligner:
             self.save_align_state()
 
         # find valid ooo paragraphs to fix manually
-        # src ids we have set manually, to be skipped when searching for ooo ids
-        self.fixed_src_par_ids: list[int] = []
-        self.find_next_par_to_fix()
-
         self.done_aligning = False
+        self.find_next_par_to_fix()
 
         # # set up the interactive parts of the Aligner
         # # src ids we have set manually, to be skipped when searching for ooo ids
         self.fixed_ids_src: list[int] = []
         # self.find_next_valid_ooo()
 
-    def compute_sentence_similarity(self):
-        """Compute the similarity between the two list of sentences."""
-        lg.debug(f"Computing similarity.")
+    def report_stage(self, stage: str) -> None:
+        """Tell the caller which stage of the alignment is starting."""
+        if self.on_stage is not None:
+            self.on_stage(stage)
+
+    def align_with_engine(self, refine: bool = True):
+        """Build the similarity source, run the engine and keep its result.
+
+        The length prior and the reranking modify only the similarity in memory,
+        the cached one is left untouched.
+        If ``refine`` is False the engine gets no encoder:
+        the matching will be reloaded from the cache anyway.
+        """
+        if self.engine.sim_level == "sentence":
+            # mix the length prior in the similarity and look closer at the unsure rows
+            lg.debug(f"Adjusting the similarity.")
+            t0 = default_timer()
+            self.sim, self.reranked_sure_ids = adjust_sentence_similarity(
+                self.sim,
+                self.sents_text_src_align,
+                self.sents_text_dst_align,
+                self.sents_text_src_viz,
+                self.sents_text_dst_viz,
+                self.length_prior_weight,
+                self.rerank_scorer,
+            )
+            lg.debug(
+                f"Adjusting the similarity: done in {default_timer()-t0:.2f}s,"
+                f" {len(self.reranked_sure_ids)} sentences are sure after reranking."
+            )
+
+        encode = self.encode_sentences if refine else None
+        sim_source = SimilaritySource(self.sim, encode, self.reranked_sure_ids)
+        feat_src, feat_dst = self.chapter_features()
+
+        lg.debug(f"Aligning with the {self.engine_name} engine.")
         t0 = default_timer()
-        # encode the sentences
-        enc_orig_src = sentence_encode_np(
-            self.sent_transformer[self.lt_sent_tra], self.sents_text_src_align
-        )
-        enc_tran_dst = sentence_encode_np(
-            self.sent_transformer[self.lt_sent_tra], self.sents_text_dst_align
+        result = self.engine.align(feat_src, feat_dst, sim_source)
+        lg.debug(f"Aligning: done in {default_timer()-t0:.2f}s.")
+        self.set_result(result)
+
+    def chapter_features(self) -> tuple[ChapterFeatures, ChapterFeatures]:
+        """Extract the features of the src and dst chapters."""
+        which_src = self.sent_which_align["src"]
+        which_dst = self.sent_which_align["dst"]
+        feat_src = ChapterFeatures.from_chapter(self.ch_src, which_src)
+        feat_dst = ChapterFeatures.from_chapter(self.ch_dst, which_dst)
+        return feat_src, feat_dst
+
+    def encode_sentences(self, texts: list[str]) -> np.ndarray:
+        """Encode some sentences with the sentence transformer."""
+        return sentence_encode_np(self.sent_transformer[self.lt_sent_tra], texts)
+
+    def bump_state_version(self) -> None:
+        """Mark that the alignment changed, the views built on it are stale."""
+        self.state_version = next(state_versions)
+
+    def set_result(self, result: AlignResult):
+        """Copy the result of an engine in the attributes used by the app."""
+        self.bump_state_version()
+        self.align_result = result
+        self.sent_num_src = result.num_src
+        self.sent_num_dst = result.num_dst
+        self.all_ids_src = result.ids_src
+        self.all_ids_dst_max = result.ids_dst_max
+        self.all_good_ids_src = result.good_ids_src
+        self.all_good_ids_dst_max = result.good_ids_dst_max
+        self.fit_coeff = result.fit_coeff
+        self.fit_func = result.fit_func
+        self.better_par_src_to_dst_flat = result.par_src_to_dst_flat
+        self.par_confidence = result.par_confidence
+
+        # the paragraphs that will not be presented to the user
+        self.auto_accepted_src_par_ids: list[int] = []
+        if self.auto_accept_th is not None:
+            self.auto_accepted_src_par_ids = [
+                par_src_id
+                for par_src_id, confidence in self.par_confidence.items()
+                if confidence >= self.auto_accept_th
+            ]
+
+        # the legacy sentence level fixing starts from the interpolated ooo ids
+        self.compute_ooo_ids()
+        self.interpolate_ooo_ids()
+
+    def compute_similarity(self):
+        """Compute the similarity the engine needs, as the align workers do."""
+        lg.debug(f"Computing {self.engine.sim_level} similarity.")
+        t0 = default_timer()
+        feat_src, feat_dst = self.chapter_features()
+        self.sim: np.ndarray | BandSimilarity = compute_similarity(
+            self.engine,
+            self.sim_method,
+            feat_src,
+            feat_dst,
+            self.sents_text_src_viz,
+            self.sents_text_dst_viz,
+            self.encode_sentences,
+            self.report_stage,
         )
-        # compute the similarity
-        self.sim: np.ndarray = cosine_similarity(enc_orig_src, enc_tran_dst)
         lg.debug(f"Computing similarity: done in {default_timer()-t0:.2f}s.")
 
-    def align_sentences(
+    def compute_anchor_similarity(
         self,
         win_len: int = 20,
         min_sent_len: int = 4,
+        anchor_step: int = 8,
+        min_margin: float = 0.05,
     ):
-        """Align the sentences using the similarity matrix.
-
-        First use the matrix to fit a line,
-        then refine with a triangular filter to give more weight to values near the line.
-        """
-        # length of the sentences in the two chapters
-        sent_len_src = self.ch_src.sents_len[self.sent_which_align["src"]]
-        sent_len_dst = self.ch_dst.sents_len[self.sent_which_align["dst"]]
-        # number of sentences in the two chapters
-        self.sent_num_src = self.ch_src.sents_num[self.sent_which_align["src"]]
-        self.sent_num_dst = self.ch_dst.sents_num[self.sent_which_align["dst"]]
-        self.ratio = self.sent_num_src / self.sent_num_dst
-
-        #############################################################################
-        # first iteration of matching: use the similarity matrix in a greedy way
-        self.all_good_ids_src = []
-        self.all_good_ids_dst_max = []
-
-        # self.sim.shape = (sent_num_src, sent_num_dst)
-        lg.debug(f"{self.sim.shape=} {self.sent_num_src=} {self.sent_num_dst=}")
-
-        for id_src in range(self.sent_num_src):
-
-            # the similarity of this src sent to all the translated ones
-            # this_sent_sim.shape = (sent_num_dst, )
-            this_sent_sim: np.ndarray = self.sim[id_src]
-
-            # find the center rescaled, there are different number of sents in the two chapters
-            id_dst_ratio = int(id_src / self.ratio)
-
-            # the chopped similarity array
-            win_left = max(0, id_dst_ratio - win_len)
-            win_right = min(self.sent_num_dst, id_dst_ratio + win_len + 1)
-            some_sent_sim = this_sent_sim[win_left:win_right]
-
-            # the dst sent id with highest similarity
-            id_dst_max = some_sent_sim.argmax() + win_left
+        """Compute the similarity translating only the src sentences that matter.
 
-            # only save the results if the docs are long enough
-            if (
-                sent_len_src[id_src] > min_sent_len
-                and sent_len_dst[id_dst_max] > min_sent_len
-            ):
-                self.all_good_ids_src.append(id_src)
-                self.all_good_ids_dst_max.append(id_dst_max)
+        Every ``anchor_step``-th long src sentence is translated and embedded,
+        a line is fitted on their matches, and only the sentences around
+        the ambiguous anchors (small margin or far from the line) are translated too.
 
-        # fit a line on the good matches
-        self.fit_coeff = np.polyfit(self.all_good_ids_src, self.all_good_ids_dst_max, 1)
-        self.fit_func = np.poly1d(self.fit_coeff)
+        The rows of the sentences never translated get a single spike
+        on the match interpolated from their neighbours,
+        so that ``align_sentences`` can use the matrix as usual.
 
-        #############################################################################
-        # second iteration of matching: use the line to rescale the similarity
-
-        # build a triangular filter to give more relevance to sentences close to the fit
-        triang_height = 1
-        triang_filt = triang(win_len * 4 + 1) * triang_height + (1 - triang_height)
-        triang_center = win_len * 2 + 1
-
-        # all_max_rescaled = []
-        self.all_good_ids_src_rescaled = []
-        self.all_good_ids_dst_max_rescaled = []
-
-        # self.all_ids_src = []
-        self.all_ids_src = list(range(self.sent_num_src))
-        self.all_ids_dst_max = []
-        self.last_good_id_dst_max = 0
-
-        for id_src in range(self.sent_num_src):
+        With less than two anchors no line can be fitted,
+        and all the src sentences are translated.
+        """
+        lg.debug(f"Computing anchor similarity.")
+        t0 = default_timer()
+        sent_len_src = np.array(self.ch_src.sents_len[self.sent_which_align["src"]])
+        sent_num_src = self.ch_src.sents_num[self.sent_which_align["src"]]
+        sent_num_dst = self.ch_dst.sents_num[self.sent_which_align["dst"]]
 
-            # the similarity of this english sent to all the translated ones
-            this_sent_sim = self.sim[id_src]
+        # the dst sentences are all needed, but they are not translated
+        self.enc_dst = sentence_encode_np(
+            self.sent_transformer[self.lt_sent_tra], self.sents_text_dst_align
+        )
+        self.sim = np.zeros((sent_num_src, sent_num_dst), dtype=np.float32)
+        self.sim_is_computed = np.zeros(sent_num_src, dtype=bool)
+
+        # translate and match a sample of the long sentences
+        ids_long = np.flatnonzero(sent_len_src > min_sent_len)
+        ids_anchor = ids_long[::anchor_step]
+        if len(ids_anchor) < 2:
+            self.compute_sim_rows(range(sent_num_src))
+        else:
+            self.compute_sim_rows(ids_anchor)
+            ids_anchor_dst, margins = self.window_max(ids_anchor, win_len)
+
+            # fit the global path on the anchors
+            fit_func = np.poly1d(np.polyfit(ids_anchor, ids_anchor_dst, 1))
+            dist_fit = np.abs(ids_anchor_dst - fit_func(ids_anchor))
+            is_ambiguous = (margins < min_margin) | (dist_fit > win_len / 2)
+
+            # translate the sentences between the neighbours of the ambiguous anchors
+            for anchor_pos in np.flatnonzero(is_ambiguous).tolist():
+                id_left = ids_anchor[max(anchor_pos - 1, 0)]
+                id_right = ids_anchor[min(anchor_pos + 1, len(ids_anchor) - 1)]
+                self.compute_sim_rows(range(id_left, id_right + 1))
+
+        # put a spike on the interpolated match of the missing rows
+        ids_computed = np.flatnonzero(self.sim_is_computed)
+        ids_missing = np.flatnonzero(~self.sim_is_computed)
+        if len(ids_missing) > 0:
+            ids_computed_dst, _ = self.window_max(ids_computed, win_len)
+            ids_missing_dst = np.interp(ids_missing, ids_computed, ids_computed_dst)
+            ids_missing_dst = np.clip(np.rint(ids_missing_dst), 0, sent_num_dst - 1)
+            spike_value = np.median(self.sim[ids_computed].max(axis=1))
+            self.sim[ids_missing, ids_missing_dst.astype(np.int64)] = spike_value
+
+        lg.debug(
+            f"Computing anchor similarity: done in {default_timer()-t0:.2f}s,"
+            f" translated {len(ids_computed)} of {sent_num_src} sentences."
+        )
 
-            # find the center rescaled because there are different number of sent in the two chapters
-            id_dst_ratio = int(id_src / self.ratio)
+    def compute_sim_rows(self, ids_src) -> None:
+        """Translate, embed and compare with the dst sentences some src sentences."""
+        from sklearn.metrics.pairwise import cosine_similarity
+
+        ids_src = [i for i in ids_src if not self.sim_is_computed[i]]
+        if len(ids_src) == 0:
+            return
+        # the translated sentences are updated in place in the chapter
+        if self.sent_which_align["src"] == "trad":
+            self.ch_src.translate_sents(ids_src)
+        enc_src = sentence_encode_np(
+            self.sent_transformer[self.lt_sent_tra],
+            [self.sents_text_src_align[i] for i in ids_src],
+        )
+        self.sim[ids_src] = cosine_similarity(enc_src, self.enc_dst)
+        self.sim_is_computed[ids_src] = True
 
-            # the chopped similarity array, centered on id_dst_ratio
+    def window_max(
+        self,
+        ids_src: np.ndarray,
+        win_len: int,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """Find the best dst sentence in the window around the rescaled diagonal.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The best dst ids
+                and the margin between the best and the second best similarity.
+        """
+        sent_num_src, sent_num_dst = self.sim.shape
+        ratio = sent_num_src / sent_num_dst
+        ids_dst_max = np.empty(len(ids_src), dtype=np.int64)
+        margins = np.empty(len(ids_src))
+        for i, id_src in enumerate(ids_src):
+            id_dst_ratio = int(id_src / ratio)
             win_left = max(0, id_dst_ratio - win_len)
-            win_right = min(self.sent_num_dst, id_dst_ratio + win_len + 1)
-            some_sent_sim = this_sent_sim[win_left:win_right]
-
-            # the fit along the line
-            ii_fit = self.fit_func([id_src])[0]
-            ii_fit = int(ii_fit)
-            if ii_fit < 0:
-                ii_fit = 0
-            if ii_fit >= self.sent_num_dst:
-                ii_fit = self.sent_num_dst - 1
-            # lg.debug(f"{id_src=} {id_dst_ratio=} {ii_fit=}")
-
-            # chop the filter, centering the apex on the fitted line ii_fit
-            # the apex is in win_len*2+1
-            # the similarity is centered on id_dst_ratio
-            # the shifted filter is still win_len*2+1 long
-            delta_ii_fit = id_dst_ratio - ii_fit
-            filt_edge_left = triang_center + delta_ii_fit - win_len - 1
-            filt_edge_right = triang_center + delta_ii_fit + win_len + 0
-            triang_filt_shifted = triang_filt[filt_edge_left:filt_edge_right]
-
-            # chop the filter as well, if the similarity is near the border
-            if id_dst_ratio < win_len:
-                triang_filt_chop = triang_filt_shifted[win_len - id_dst_ratio :]
-            elif id_dst_ratio > self.sent_num_dst - (win_len + 1):
-                left_edge = self.sent_num_dst - (win_len + 1)
-                triang_filt_chop = triang_filt_shifted[: -(id_dst_ratio - left_edge)]
-            else:
-                triang_filt_chop = triang_filt_shifted
-
-            # lg.debug( f"{id_src=} {id_dst_ratio=} {id_dst_ratio-win_len=} {id_dst_ratio+win_len+1=} {len(some_sent_sim)=} {len(triang_filt_chop)=}")
-            assert len(triang_filt_chop) == len(some_sent_sim)
-
-            # rescale the similarity
-            sim_rescaled = some_sent_sim * triang_filt_chop
-
-            # find the max similarity on the rescaled sim array
-            id_dst_max_rescaled = sim_rescaled.argmax() + win_left
-            # all_max_rescaled.append(id_dst_max_rescaled)
-
-            # keep if both sents are long
-            if (
-                sent_len_src[id_src] > min_sent_len
-                and sent_len_dst[id_dst_max] > min_sent_len
-            ):
-                self.all_good_ids_src_rescaled.append(id_src)
-                self.all_good_ids_dst_max_rescaled.append(id_dst_max_rescaled)
-                # update the last max we saw
-                self.last_good_id_dst_max = id_dst_max_rescaled
-
-            # save all matches id_src-max
-            # self.all_ids_src.append(id_src)
-            self.all_ids_dst_max.append(int(self.last_good_id_dst_max))
+            win_right = min(sent_num_dst, id_dst_ratio + win_len + 1)
+            some_sent_sim = self.sim[id_src, win_left:win_right]
+            ids_dst_max[i] = some_sent_sim.argmax() + win_left
+            top_two = np.sort(some_sent_sim)[-2:]
+            margins[i] = top_two[-1] - top_two[0]
+        return ids_dst_max, margins
 
     def compute_ooo_ids(self):
         """Find the non monothonic ids_dst_max."""
-        self.is_ooo_flattened = []
-        for id_src, id_dst_max in zip(self.all_ids_src, self.all_ids_dst_max):
-            # check to the left if you can
-            if id_src > 0:
-                ooo_left = id_dst_max < self.all_ids_dst_max[id_src - 1]
-            else:
-                ooo_left = False
-            # check to the right if you can
-            if id_src < len(self.all_ids_dst_max) - 1:
-                ooo_right = id_dst_max > self.all_ids_dst_max[id_src + 1]
-            else:
-                ooo_right = False
-            # if any side is ooo, mark it
-            ooo = ooo_right or ooo_left
-            # if ooo: lg.debug(f"{id_src} {id_dst_max}")
-            self.is_ooo_flattened.append(ooo)
+        self.is_ooo_flattened = find_ooo_ids(self.all_ids_dst_max)
 
     def interpolate_ooo_ids(self):
-        """Remove the ooo matches and interpolate them.
-
-        These will be the first guess used to present the paragraph options to the user.
-        """
-        # interpolate the values for the ooo guesses
-        self.all_ids_dst_interpolate = pd.Series(self.all_ids_dst_max)
-        self.all_ids_dst_interpolate[self.is_ooo_flattened] = np.nan
-        self.all_ids_dst_interpolate.interpolate(inplace=True)
-
-        # pair up src and dst interpolated cs_ids
-        self.interp_cs_src_to_dst = {
-            cs_src: cs_dst
-            for cs_src, cs_dst in zip(
-                self.all_ids_src,
-                self.all_ids_dst_interpolate,
-            )
-        }
-
-    def align_paragraphs(self):
-        """Align the paragraphs using the sentence alignment."""
-        # the fraction of sentences in a src paragraph
-        # matched to the same dst paragraph to have a direct match
-        self.th_consensus = 0.6
-
-        # pair up good (long) sentences id in the chapter and the paragraph id they belong to
-        cs_p_src_ids = [
-            {
-                "cs_src_id": cs_src_id,
-                "par_src_id": self.ch_src.cs_to_ps[cs_src_id][0],
-            }
-            for cs_src_id in self.all_good_ids_src_rescaled
-        ]
-
-        ############################################################
-        # the first paragraph matching
-        self.good_par_src_to_dst = {}
-
-        # group the pairs on the paragraphs
-        # par_src_id: the src paragraph
-        # cs_p_src_par_ids: the (src_chap_sent_id, src_par_id) pairs for this src_paragraph
-        for par_src_id, cs_p_src_par_ids in groupby(
-            cs_p_src_ids, lambda x: x["par_src_id"]
-        ):
-
-            # the src chapter sentence ids for this src paragraph
-            cs_src_ids = list(cs_p_src["cs_src_id"] for cs_p_src in cs_p_src_par_ids)
-            num_sents_src = len(cs_src_ids)
-            # lg.debug("{} {} {}", par_src_id, cs_src_ids, num_sents_src)
-
-            # search for the cs_p_src id in the good_src_rescaled dict
-            # if you find it, get the corresponding dst cs_src_id
-            # -> we are iterating over the all_good_ids_src_rescaled sooo
-            # extract all the paragraphs those sentences belong to
-            par_dst_ids = []
-            for cs_src_id in cs_src_ids:
-                if cs_src_id in self.interp_cs_src_to_dst:
-                    # the chapter_sentence_dst id
-                    cs_dst_id = self.interp_cs_src_to_dst[cs_src_id]
-                    # the interpolated values are not int
-                    cs_dst_id = int(cs_dst_id)
-                    # dst (paragraph, ps) id
-                    ps_dst_id = self.ch_dst.cs_to_ps[cs_dst_id]
-                    # get only the paragraph
-                    par_dst_ids.append(ps_dst_id[0])
-                else:
-                    lg.warning(f"Very unexpected, missing {cs_src_id}.")
-
-            # decide if there is a consensus on the paragraphs
-            par_dst_ids_count = Counter(par_dst_ids)
-            # lg.debug(f"\t{par_dst_ids_count}")
-            par_dst_mc = par_dst_ids_count.most_common()[0]
-            par_dst_mc_id = par_dst_mc[0]
-            par_dst_mc_count = par_dst_mc[1]
-
-            # if enough sentences point to the same dst paragraph, select that
-            if par_dst_mc_count / num_sents_src > self.th_consensus:
-                # lg.debug(f"\tMatching par {par_src_id} {par_dst_mc_id}")
-                self.good_par_src_to_dst[par_src_id] = par_dst_mc_id
-            else:
-                # lg.debug(f"\tNo consensus matching. ------------------------")
-                # if all the dst paragraphs are contiguos, select the min
-                if are_contiguos(par_dst_ids):
-                    self.good_par_src_to_dst[par_src_id] = min(par_dst_ids)
-                    # lg.debug(f"\tContiguos matching {min(par_dst_ids)}.")
-                # else: lg.debug(f"\tNo matching.")
-
-        ############################################################
-        # the second paragraph matching
-        # if there are one or two paragraph missing from both src and dst
-        # fill them in
-        self.better_par_src_to_dst = {}
-        # lg.debug("Building better_par_src_to_dst")
-
-        last_src_id = 0
-        last_dst_id = 0
-        for par_src_id, par_dst_id in self.good_par_src_to_dst.items():
-            # lg.debug(f"{par_src_id} {par_dst_id}")
-            # if par_src_id > last_src_id + 1: lg.debug(f"missing src from {last_src_id+1} to {par_src_id-1}")
-
-            after_last_par_src_id = last_src_id + 1
-            after_last_par_dst_id = last_dst_id + 1
-            prev_par_src_id = par_src_id - 1
-            prev_par_dst_id = par_dst_id - 1
-
-            # add the middle one if exactly one is missing
-            if (
-                after_last_par_src_id == prev_par_src_id
-                and after_last_par_dst_id == prev_par_dst_id
-            ):
-                # lg.debug(f"probable {prev_par_src_id} {after_last_par_dst_id}")
-                self.better_par_src_to_dst[prev_par_src_id] = after_last_par_dst_id
-
-            # add the middle two if exactly two are missing
-            elif (
-                after_last_par_src_id + 1 == prev_par_src_id
-                and after_last_par_dst_id + 1 == prev_par_dst_id
-            ):
-                # lg.debug( f"probable two {after_last_par_src_id} {after_last_par_dst_id}")
-                # lg.debug( f"probable two {after_last_par_src_id+1} {after_last_par_dst_id+1}")
-                self.better_par_src_to_dst[
-                    after_last_par_src_id
-                ] = after_last_par_dst_id
-                self.better_par_src_to_dst[after_last_par_src_id + 1] = (
-                    after_last_par_dst_id + 1
-                )
-
-            # add the current one
-            self.better_par_src_to_dst[par_src_id] = par_dst_id
-
-            # update data
-            last_src_id = par_src_id
-            last_dst_id = par_dst_id
-
-        # flatten the better matching to have all the possible par src id
-        self.better_par_src_to_dst_flat = {}
-        for par_src_id in range(len(self.ch_src.paragraphs)):
-            if par_src_id in self.better_par_src_to_dst:
-                self.better_par_src_to_dst_flat[
-                    par_src_id
-                ] = self.better_par_src_to_dst[par_src_id]
-            else:
-                self.better_par_src_to_dst_flat[par_src_id] = -1
+        """Remove the ooo matches and interpolate them."""
+        self.all_ids_dst_interpolate = interpolate_ooo_ids(
+            self.all_ids_dst_max, self.is_ooo_flattened
+        )
 
     def find_next_par_to_fix(self):
         """Find the first ooo src id that has not been fixed yet."""
+        # an undo can bring back a par to fix
+        self.done_aligning = False
         # self.is_ooo_par_flat = []
         self.last_par_dst_id = 0
         for par_src_id, par_dst_id in self.better_par_src_to_dst_flat.items():
@@ -454,7 +427,10 @@ class Aligner:
             ooo = ooo_right or ooo_left
             if ooo:
                 # lg.debug(f"ooo  {par_src_id} {par_dst_id}")
-                if par_src_id not in self.fixed_src_par_ids:
+                if (
+                    par_src_id not in self.fixed_src_par_ids
+                    and par_src_id not in self.auto_accepted_src_par_ids
+                ):
                     self.curr_fix_src_par_id = par_src_id
                     self.curr_fix_dst_par_id = par_dst_id
                     # last_par_dst_id is magically the *previous* dst id
@@ -518,17 +494,27 @@ class Aligner:
         self.viz_id_dst = self.curr_id_dst_interpolate
 
     def save_align_state(self):
-        """Write the current alignment state."""
+        """Write the current alignment state as a snapshot, emptying the journal."""
         align_info = {
             "all_ids_dst_max": self.all_ids_dst_max,
             "better_par_src_to_dst_flat": self.better_par_src_to_dst_flat,
+            "fixed_src_par_ids": self.fixed_src_par_ids,
         }
-        self.match_info_path["align"].write_text(json.dumps(align_info, indent=4))
+        self.journal.write_snapshot(align_info)
+
+    def memory_size(self) -> int:
+        """Estimate the bytes used by the aligner, the arrays are the bulk of it."""
+        return sum(
+            v.nbytes
+            for v in vars(self).values()
+            if isinstance(v, (np.ndarray, BandSimilarity))
+        )
 
     def pick_dst_sent(self, id_dst_correct: int) -> None:
         """Pick which dst sent is the right one for the currently selected src."""
         # save the correct dst id
         self.all_ids_dst_max[self.curr_id_src] = id_dst_correct
+        self.bump_state_version()
         # save the intermediate result
         self.save_align_state()
         # mark this src id as fixed manually
@@ -540,14 +526,83 @@ class Aligner:
 
     def pick_dst_par(self, id_dst_correct: int) -> None:
         """Pick which dst par is the right one for the currently selected src."""
-        # save the correct dst id
-        self.better_par_src_to_dst_flat[self.curr_fix_src_par_id] = id_dst_correct
-        # save the intermediate result
-        self.save_align_state()
-        # mark this src id as fixed manually
-        self.fixed_src_par_ids.append(self.curr_fix_src_par_id)
+        self.pick_dst_pars([(self.curr_fix_src_par_id, id_dst_correct)])
+
+    def pick_dst_pars(self, fixes: list[tuple[int, int]]) -> None:
+        """Pick the right dst par for many src pars at once.
+
+        The fixes are appended to the journal as a single event,
+        that can be undone at once,
+        and the next par to fix is searched once, after all the fixes are applied.
+
+        Args:
+            fixes (list[tuple[int, int]]): The ``(src par id, dst par id)`` pairs.
+
+        Raises:
+            ValueError: If a par id is not in the chapters, nothing is changed.
+        """
+        par_num_dst = len(self.ch_dst.paragraphs)
+        for par_src_id, par_dst_id in fixes:
+            if par_src_id not in self.better_par_src_to_dst_flat:
+                raise ValueError(f"No src paragraph {par_src_id}.")
+            if not 0 <= par_dst_id < par_num_dst:
+                raise ValueError(f"No dst paragraph {par_dst_id}.")
+
+        # save the correct dst ids and mark the src ids as fixed manually
+        self.journal.pick(
+            self.better_par_src_to_dst_flat, self.fixed_src_par_ids, fixes
+        )
+        self.after_journal_event()
+
+    def after_journal_event(self) -> None:
+        """Update the aligner after the journal changed the paragraph matches."""
+        self.bump_state_version()
+        # fold the journal in a new snapshot once in a while
+        if self.journal.needs_compaction:
+            self.save_align_state()
         # find the next src id to fix
         self.find_next_par_to_fix()
 
+    def undo_pick(self) -> bool:
+        """Undo the last pick, a batch of fixes is undone at once.
+
+        Returns:
+            bool: False if there was nothing to undo.
+        """
+        if not self.journal.undo(
+            self.better_par_src_to_dst_flat, self.fixed_src_par_ids
+        ):
+            return False
+        self.after_journal_event()
+        return True
+
+    def redo_pick(self) -> bool:
+        """Redo the last undone pick.
+
+        Returns:
+            bool: False if there was nothing to redo.
+        """
+        if not self.journal.redo(
+            self.better_par_src_to_dst_flat, self.fixed_src_par_ids
+        ):
+            return False
+        self.after_journal_event()
+        return True
+
+    def accept_window_guesses(self) -> None:
+        """Accept the current dst guess of all the src pars shown around the fix.
+
+        The src pars without a guess are left to fix.
+        """
+        fixes = [
+            (par_src_id, self.better_par_src_to_dst_flat[par_src_id])
+            for par_src_id in range(
+                self.curr_fix_src_par_id - self.viz_win_size,
+                self.curr_fix_src_par_id + self.viz_win_size,
+            )
+            if self.better_par_src_to_dst_flat.get(par_src_id, -1) != -1
+        ]
+        self.pick_dst_pars(fixes)
+
     def scroll_sent(self, which_sents, direction) -> None:
         """Scroll the right bunch of sentences in the right direction."""
@@ -0,0 +1,271 @@
+"""Keep the manual paragraph fixes in an append-only journal.
+
+The alignment of a chapter pair is a snapshot, ``info_align_<pair>.json``,
+and a journal next to it, ``info_align_<pair>.jsonl``.
+Each pick appends a line with the fixes it made,
+so saving a pick writes a few bytes instead of the whole alignment.
+Undo and redo are lines of the journal too.
+
+Loading reads the snapshot and replays the journal on top of it.
+After enough events the state is written as a new snapshot
+and the journal starts again empty.
+The snapshot keeps the fixed paragraphs and the undo and redo stacks,
+so a restart restores exactly the same state.
+
+Each snapshot has a generation and each event the generation it was written for:
+if the server stops between a new snapshot and the removal of the old journal,
+the stale events are skipped.
+A snapshot is written to a temporary file and moved over the old one,
+so a crash while writing it leaves the old snapshot and its journal.
+"""
+
+import json
+import os
+from pathlib import Path
+from uuid import uuid4
+
+from loguru import logger as lg
+
+from interleave_epub.interleave.constants import (
+    align_journal_compact_every,
+    align_journal_max_undo,
+)
+
+# a fix of a src paragraph: (par_src_id, par_dst_id_old, par_dst_id_new, was_fixed)
+Fix = tuple[int, int, int, bool]
+
+
+def journal_path_of(snapshot_path: Path) -> Path:
+    """Get the path of the journal of a snapshot."""
+    return snapshot_path.with_suffix(".jsonl")
+
+
+def write_align_snapshot(snapshot_path: Path, align_info: dict) -> None:
+    """Write a whole alignment, replacing the snapshot and dropping its journal.
+
+    The journal is dropped only once the new snapshot is safely on disk.
+    """
+    tmp_path = snapshot_path.with_name(f"{snapshot_path.name}.{uuid4().hex[:8]}.tmp")
+    try:
+        with tmp_path.open("w") as tmp_file:
+            tmp_file.write(json.dumps(align_info, indent=4))
+            tmp_file.flush()
+            os.fsync(tmp_file.fileno())
+        os.replace(tmp_path, snapshot_path)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    journal_path_of(snapshot_path).unlink(missing_ok=True)
+
+
+def apply_fixes(
+    par_src_to_dst_flat: dict[int, int],
+    fixed_src_par_ids: list[int],
+    fixes: list[Fix],
+) -> None:
+    """Set the new dst paragraphs and mark the src ones as fixed."""
+    for par_src_id, _, par_dst_id_new, _ in fixes:
+        par_src_to_dst_flat[par_src_id] = par_dst_id_new
+        if par_src_id not in fixed_src_par_ids:
+            fixed_src_par_ids.append(par_src_id)
+
+
+def revert_fixes(
+    par_src_to_dst_flat: dict[int, int],
+    fixed_src_par_ids: list[int],
+    fixes: list[Fix],
+) -> None:
+    """Restore the old dst paragraphs and fixed marks."""
+    for par_src_id, par_dst_id_old, _, was_fixed in reversed(fixes):
+        par_src_to_dst_flat[par_src_id] = par_dst_id_old
+        if not was_fixed and par_src_id in fixed_src_par_ids:
+            fixed_src_par_ids.remove(par_src_id)
+
+
+class AlignJournal:
+    """The snapshot and journal of the paragraph alignment of a chapter pair.
+
+    The alignment itself is owned by the aligner,
+    the journal changes it in place and records the change.
+    """
+
+    def __init__(
+        self,
+        snapshot_path: Path,
+        compact_every: int = align_journal_compact_every,
+        max_undo: int = align_journal_max_undo,
+    ) -> None:
+        """Initialize an empty journal, ``load`` or ``write_snapshot`` to use it.
+
+        Args:
+            snapshot_path (Path): The ``info_align_<pair>.json`` file.
+            compact_every (int): Events after which a new snapshot is due.
+            max_undo (int): The picks that can be undone.
+        """
+        self.snapshot_path = snapshot_path
+        self.journal_path = journal_path_of(snapshot_path)
+        self.compact_every = compact_every
+        self.max_undo = max_undo
+        self.gen = ""
+        self.undo_stack: list[list[Fix]] = []
+        self.redo_stack: list[list[Fix]] = []
+        # events written since the last snapshot
+        self.event_num = 0
+
+    @property
+    def needs_compaction(self) -> bool:
+        """True if the journal is long enough to be folded in a snapshot."""
+        return self.event_num >= self.compact_every
+
+    def load(self) -> dict:
+        """Read the snapshot and replay the journal on top of it.
+
+        Returns:
+            dict: The alignment info of the snapshot,
+                with ``better_par_src_to_dst_flat`` keyed by int
+                and the ``fixed_src_par_ids``, both up to date.
+        """
+        align_info = json.loads(self.snapshot_path.read_text())
+        tmp: dict[int, int] = align_info["better_par_src_to_dst_flat"]
+        # json files treat keys as string
+        par_src_to_dst_flat = {int(k): v for k, v in tmp.items()}
+        fixed_src_par_ids: list[int] = align_info.get("fixed_src_par_ids", [])
+        self.gen = align_info.get("journal_gen", "")
+        self.undo_stack = [
+            [tuple(fix) for fix in fixes] for fixes in align_info.get("undo", [])
+        ]
+        self.redo_stack = [
+            [tuple(fix) for fix in fixes] for fixes in align_info.get("redo", [])
+        ]
+
+        self.event_num = 0
+        if self.journal_path.exists():
+            for line in self.journal_path.read_text().splitlines():
+                try:
+                    event = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line was cut by a crash
+                    lg.warning(f"Truncated event in {self.journal_path}.")
+                    break
+                if event.get("gen") != self.gen:
+                    continue
+                self.apply_event(event, par_src_to_dst_flat, fixed_src_par_ids)
+                self.event_num += 1
+
+        align_info["better_par_src_to_dst_flat"] = par_src_to_dst_flat
+        align_info["fixed_src_par_ids"] = fixed_src_par_ids
+        return align_info
+
+    def write_snapshot(self, align_info: dict) -> None:
+        """Write the whole state as a new snapshot and empty the journal.
+
+        If the snapshot cannot be written, the events keep going to the old journal.
+        """
+        gen = uuid4().hex[:8]
+        undo_stack = self.undo_stack[-self.max_undo :]
+        align_info = align_info | {
+            "journal_gen": gen,
+            "undo": undo_stack,
+            "redo": self.redo_stack,
+        }
+        write_align_snapshot(self.snapshot_path, align_info)
+        self.gen = gen
+        self.undo_stack = undo_stack
+        self.event_num = 0
+
+    def append(self, event: dict) -> None:
+        """Write an event at the end of the journal."""
+        with self.journal_path.open("a") as journal_file:
+            journal_file.write(json.dumps(event | {"gen": self.gen}) + "\n")
+        self.event_num += 1
+
+    def apply_event(
+        self,
+        event: dict,
+        par_src_to_dst_flat: dict[int, int],
+        fixed_src_par_ids: list[int],
+    ) -> bool:
+        """Apply an event to the alignment and to the undo and redo stacks.
+
+        Returns:
+            bool: False if there was nothing to undo or redo.
+        """
+        if event["op"] == "pick":
+            fixes = [tuple(fix) for fix in event["fixes"]]
+            apply_fixes(par_src_to_dst_flat, fixed_src_par_ids, fixes)
+            self.undo_stack.append(fixes)
+            self.redo_stack.clear()
+        elif event["op"] == "undo":
+            if len(self.undo_stack) == 0:
+                return False
+            fixes = self.undo_stack.pop()
+            revert_fixes(par_src_to_dst_flat, fixed_src_par_ids, fixes)
+            self.redo_stack.append(fixes)
+        elif event["op"] == "redo":
+            if len(self.redo_stack) == 0:
+                return False
+            fixes = self.redo_stack.pop()
+            apply_fixes(par_src_to_dst_flat, fixed_src_par_ids, fixes)
+            self.undo_stack.append(fixes)
+        else:
+            raise ValueError(f"Unknown journal event {event['op']}.")
+        return True
+
+    def pick(
+        self,
+        par_src_to_dst_flat: dict[int, int],
+        fixed_src_par_ids: list[int],
+        picks: list[tuple[int, int]],
+    ) -> None:
+        """Set the dst paragraph of some src paragraphs, and record it.
+
+        Args:
+            par_src_to_dst_flat (dict[int, int]): The alignment to change.
+            fixed_src_par_ids (list[int]): The src paragraphs fixed manually.
+            picks (list[tuple[int, int]]): The ``(src par id, dst par id)`` pairs.
+        """
+        fixes = [
+            (
+                par_src_id,
+                par_src_to_dst_flat[par_src_id],
+                par_dst_id,
+                par_src_id in fixed_src_par_ids,
+            )
+            for par_src_id, par_dst_id in picks
+        ]
+        event = {"op": "pick", "fixes": fixes}
+        self.apply_event(event, par_src_to_dst_flat, fixed_src_par_ids)
+        self.append(event)
+
+    def undo(
+        self, par_src_to_dst_flat: dict[int, int], fixed_src_par_ids: list[int]
+    ) -> bool:
+        """Undo the last pick, and record it.
+
+        Returns:
+            bool: False if there was nothing to undo.
+        """
+        event = {"op": "undo"}
+        if not self.apply_event(event, par_src_to_dst_flat, fixed_src_par_ids):
+            return False
+        self.append(event)
+        return True
+
+    def redo(
+        self, par_src_to_dst_flat: dict[int, int], fixed_src_par_ids: list[int]
+    ) -> bool:
+        """Redo the last undone pick, and record it.
+
+        Returns:
+            bool: False if there was nothing to redo.
+        """
+        event = {"op": "redo"}
+        if not self.apply_event(event, par_src_to_dst_flat, fixed_src_par_ids):
+            return False
+        self.append(event)
+        return True
+
+
+def load_align_info(snapshot_path: Path) -> dict:
+    """Read the alignment of a chapter pair, with the journal replayed."""
+    return AlignJournal(snapshot_path).load()
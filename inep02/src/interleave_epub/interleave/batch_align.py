@@ -0,0 +1,200 @@
+"""Align all the chapter pairs of a book in parallel.
+
+Each chapter pair is a job sent to a process pool.
+The jobs only carry the picklable chapter features,
+each worker loads its own sentence transformer once,
+computes the similarity and the automatic alignment,
+and writes the same ``info_sim_*`` and ``info_align_*.json`` caches
+that the ``Aligner`` reloads when the chapter is shown.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from dataclasses import dataclass, field
+from multiprocessing import get_context
+from pathlib import Path
+from timeit import default_timer
+from typing import Callable
+
+from loguru import logger as lg
+import numpy as np
+
+from interleave_epub.interleave.align_journal import write_align_snapshot
+from interleave_epub.interleave.engine import (
+    ChapterFeatures,
+    SimilaritySource,
+    build_engine,
+)
+from interleave_epub.interleave.rerank import (
+    RerankScorer,
+    cross_encoder_scorer,
+    token_overlap_scorer,
+)
+from interleave_epub.interleave.similarity import (
+    adjust_sentence_similarity,
+    compute_similarity,
+    is_lexical,
+    save_similarity,
+    similarity_cache_path,
+)
+from interleave_epub.nlp.utils import sentence_encode_np
+
+
+@dataclass
+class AlignSettings:
+    """How to align the chapters, the same for every job of a book."""
+
+    sent_model_name: str
+    engine_name: str = "greedy_triangle"
+    engine_kwargs: dict = field(default_factory=dict)
+    sim_method: str = "sent_transformer"
+    length_prior_weight: float = 0.0
+    rerank_scorer_name: str | None = None
+    cross_encoder_model_name: str | None = None
+
+
+@dataclass
+class PairJob:
+    """A chapter pair to align."""
+
+    ch_id_pair_str: str
+    feat_src: ChapterFeatures
+    feat_dst: ChapterFeatures
+    # the original sentences, for the lexical similarity and the length prior
+    sents_text_orig_src: list[str]
+    sents_text_orig_dst: list[str]
+    # the engine for this pair, if different from the book settings
+    engine_name: str | None = None
+    engine_kwargs: dict | None = None
+
+
+# the models loaded once in each worker process
+worker_models: dict = {}
+
+
+def init_worker(settings: AlignSettings) -> None:
+    """Load the models needed by the jobs in this worker process."""
+    from sentence_transformers import SentenceTransformer
+
+    if not is_lexical(settings.sim_method, settings.engine_name):
+        worker_models["sent_transformer"] = SentenceTransformer(
+            settings.sent_model_name, device="cpu"
+        )
+    if settings.rerank_scorer_name == "cross_encoder":
+        if settings.cross_encoder_model_name is None:
+            raise ValueError("The cross encoder reranking needs a model name.")
+        worker_models["rerank_scorer"] = cross_encoder_scorer(
+            settings.cross_encoder_model_name
+        )
+    elif settings.rerank_scorer_name == "token_overlap":
+        worker_models["rerank_scorer"] = token_overlap_scorer
+
+
+def encode_worker(texts: list[str]) -> np.ndarray:
+    """Encode some sentences with the sentence transformer of this worker."""
+    return sentence_encode_np(worker_models["sent_transformer"], texts)
+
+
+def align_pair(
+    job: PairJob,
+    settings: AlignSettings,
+    align_cache_fol: Path,
+) -> tuple[str, float]:
+    """Align a chapter pair and write the caches.
+
+    Returns:
+        tuple[str, float]: The chapter pair and the time it took.
+    """
+    t0 = default_timer()
+    engine_name = job.engine_name or settings.engine_name
+    engine_kwargs = job.engine_kwargs or settings.engine_kwargs
+    engine = build_engine(engine_name, **engine_kwargs)
+    encode = encode_worker if "sent_transformer" in worker_models else None
+
+    sim = compute_similarity(
+        engine,
+        settings.sim_method,
+        job.feat_src,
+        job.feat_dst,
+        job.sents_text_orig_src,
+        job.sents_text_orig_dst,
+        encode,
+    )
+
+    sim_adjusted = sim
+    sure_ids_src: set[int] = set()
+    if engine.sim_level == "sentence":
+        rerank_scorer: RerankScorer | None = worker_models.get("rerank_scorer")
+        sim_adjusted, sure_ids_src = adjust_sentence_similarity(
+            sim,
+            job.feat_src.sents_text,
+            job.feat_dst.sents_text,
+            job.sents_text_orig_src,
+            job.sents_text_orig_dst,
+            settings.length_prior_weight,
+            rerank_scorer,
+        )
+
+    sim_source = SimilaritySource(sim_adjusted, encode, sure_ids_src)
+    result = engine.align(job.feat_src, job.feat_dst, sim_source)
+
+    # write the caches only now: together they look like a finished alignment
+    sim_path = similarity_cache_path(align_cache_fol, engine_name, job.ch_id_pair_str)
+    save_similarity(sim_path, sim)
+    align_info = {
+        "all_ids_dst_max": result.ids_dst_max,
+        "better_par_src_to_dst_flat": result.par_src_to_dst_flat,
+    }
+    align_info_name = f"info_align_{job.ch_id_pair_str}.json"
+    write_align_snapshot(align_cache_fol / align_info_name, align_info)
+
+    return job.ch_id_pair_str, default_timer() - t0
+
+
+def align_pairs_parallel(
+    jobs: list[PairJob],
+    settings: AlignSettings,
+    align_cache_fol: Path,
+    max_workers: int = 2,
+    progress: Callable[[int, int], None] | None = None,
+) -> list[str]:
+    """Align the chapter pairs on a process pool.
+
+    ``progress`` is called with the number of pairs finished and the total.
+
+    The processes are spawned, not forked, so that torch is not inherited
+    half initialized from the parent.
+
+    Returns:
+        list[str]: The chapter pairs aligned successfully.
+    """
+    if len(jobs) == 0:
+        return []
+    lg.info(f"Aligning {len(jobs)} chapter pairs on {max_workers} processes.")
+    t0 = default_timer()
+    done_pairs = []
+    with ProcessPoolExecutor(
+        max_workers=min(max_workers, len(jobs)),
+        mp_context=get_context("spawn"),
+        initializer=init_worker,
+        initargs=(settings,),
+    ) as executor:
+        futures = {
+            executor.submit(align_pair, job, settings, align_cache_fol): job
+            for job in jobs
+        }
+        for num_finished, future in enumerate(as_completed(futures), start=1):
+            job = futures[future]
+            if progress is not None:
+                progress(num_finished, len(jobs))
+            try:
+                ch_id_pair_str, elapsed = future.result()
+            except Exception as e:
+                lg.warning(f"Failed to align {job.ch_id_pair_str}: {e!r}")
+                continue
+            done_pairs.append(ch_id_pair_str)
+            lg.debug(
+                f"Aligned {ch_id_pair_str} in {elapsed:.2f}s"
+                f" ({len(done_pairs)}/{len(jobs)})."
+            )
+    lg.info(f"Aligned {len(done_pairs)} chapter pairs in {default_timer()-t0:.2f}s.")
+    return done_pairs
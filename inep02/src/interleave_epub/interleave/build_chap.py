@@ -1,5 +1,12 @@
-"""Build an interleaved chapter given a paragraph matching."""
+"""Build an interleaved chapter given a paragraph matching.
 
+Composing a chapter is slow, and saving the book again usually changes
+only the chapters the user fixed:
+``ComposedChapterCache`` keeps a hash of the input of each composed chapter
+and of the composed file, so the unchanged chapters are reused.
+"""
+
+from hashlib import sha256
 import json
 from pathlib import Path
 
@@ -8,6 +15,7 @@ from loguru import logger as lg
 
 from interleave_epub.epub.chapter import Chapter
 from interleave_epub.epub.utils import tag_add_attr_multi_valued
+from interleave_epub.interleave.align_journal import load_align_info
 
 
 def interleave_chap(
@@ -22,7 +30,8 @@ def interleave_chap(
     lt_pair_h: str,
     lang_alpha2_tag_src: str,
     lang_alpha2_tag_dst: str,
-):
+    composed_cache: "ComposedChapterCache | None" = None,
+) -> bool:
     """Build an interleaved chapter given a paragraph matching.
 
     Fill 5 keys in tmpl_ch:
@@ -40,12 +49,43 @@ def interleave_chap(
 
     par_dst_id is the chapter id *up to* which you can add,
     that par must be shown after
+
+    If ``composed_cache`` is given and the chapter was composed from the same input,
+    the composed file is kept as it is.
+
+    Returns:
+        bool: True if the chapter was composed, False if it was reused.
     """
-    # load the matching
-    align_info = json.loads(par_matching_path.read_text())
-    tmp: dict[int, int] = align_info["better_par_src_to_dst_flat"]
-    # json files treat keys as string
-    par_src_to_dst_flat = {int(k): v for k, v in tmp.items()}
+    # load the matching, with the manual fixes of the journal
+    align_info = load_align_info(par_matching_path)
+    par_src_to_dst_flat: dict[int, int] = align_info["better_par_src_to_dst_flat"]
+
+    # build a vague chapter title
+    chapter_title = f"Chapter {ch_viz_id}"
+
+    # load the chapter template
+    tmpl_ch_path = ep_tmpl_fol / "tmpl_ch.xhtml"
+    tmpl_ch = tmpl_ch_path.read_text()
+
+    # where to save the chapter
+    composed_ch_path = output_fol / f"ch_{ch_viz_id:04d}.xhtml"
+
+    # skip the chapter if nothing it depends on changed
+    if composed_cache is not None:
+        input_hash = composed_chapter_hash(
+            ch_src,
+            ch_dst,
+            par_src_to_dst_flat,
+            tmpl_ch,
+            book_title=book_title,
+            book_author=book_author,
+            composed_tag=lt_pair_h,
+            chapter_title=chapter_title,
+            lang_alpha2_tag_src=lang_alpha2_tag_src,
+            lang_alpha2_tag_dst=lang_alpha2_tag_dst,
+        )
+        if composed_cache.is_current(composed_ch_path, input_hash):
+            return False
 
     last_dst_par_id = -1
     composed_ch_htext = ""
@@ -79,13 +119,6 @@ def interleave_chap(
         # lg.trace(f"add tag >{dst_tag}<")
         composed_ch_htext += f"{dst_tag}\n"
 
-    # build a vague chapter title
-    chapter_title = f"Chapter {ch_viz_id}"
-
-    # load the chapter template
-    tmpl_ch_path = ep_tmpl_fol / "tmpl_ch.xhtml"
-    tmpl_ch = tmpl_ch_path.read_text()
-
     # fill the template
     full_ch_text = tmpl_ch.format(
         book_title=book_title,
@@ -95,11 +128,79 @@ def interleave_chap(
         chapter_content=composed_ch_htext,
     )
 
-    # where to save the chapter
-    composed_ch_path = output_fol / f"ch_{ch_viz_id:04d}.xhtml"
     lg.debug(f"Saving in {composed_ch_path}")
 
     # build a soup for the chapter content
     parsed_text = BeautifulSoup(full_ch_text, features="html.parser")
     # write the prettified text
     composed_ch_path.write_text(parsed_text.prettify())
+
+    if composed_cache is not None:
+        composed_cache.update(composed_ch_path, input_hash)
+    return True
+
+
+def composed_chapter_hash(
+    ch_src: Chapter,
+    ch_dst: Chapter,
+    par_src_to_dst_flat: dict[int, int],
+    tmpl_ch: str,
+    **fill_values: str | int,
+) -> str:
+    """Hash everything a composed chapter depends on.
+
+    Args:
+        ch_src (Chapter): The src chapter.
+        ch_dst (Chapter): The dst chapter.
+        par_src_to_dst_flat (dict[int, int]): The paragraph matching.
+        tmpl_ch (str): The chapter template.
+        fill_values (str | int): The other values put in the chapter,
+            like the title of the book and of the chapter.
+    """
+    chap_hash = sha256()
+    chap_hash.update(json.dumps(par_src_to_dst_flat).encode())
+    chap_hash.update(json.dumps(fill_values, sort_keys=True).encode())
+    chap_hash.update(tmpl_ch.encode())
+    for ch in (ch_src, ch_dst):
+        # the separator keeps the paragraph boundaries in the hash
+        chap_hash.update("\0".join(par.get_text() for par in ch.paragraphs).encode())
+        chap_hash.update(b"\1")
+    return chap_hash.hexdigest()
+
+
+def file_hash(file_path: Path) -> str:
+    """Hash the content of a file."""
+    return sha256(file_path.read_bytes()).hexdigest()
+
+
+class ComposedChapterCache:
+    """The hashes of the composed chapters in an output folder."""
+
+    def __init__(self, output_fol: Path) -> None:
+        """Load the hashes written by the last save of the book."""
+        self.hashes_path = output_fol / "composed_hashes.json"
+        # composed chapter file name: {"input": hash, "output": hash}
+        self.hashes: dict[str, dict[str, str]] = {}
+        if self.hashes_path.exists():
+            self.hashes = json.loads(self.hashes_path.read_text())
+
+    def is_current(self, composed_ch_path: Path, input_hash: str) -> bool:
+        """Check if a composed chapter was built from the same input, untouched."""
+        ch_hashes = self.hashes.get(composed_ch_path.name)
+        return (
+            ch_hashes is not None
+            and ch_hashes["input"] == input_hash
+            and composed_ch_path.exists()
+            and ch_hashes["output"] == file_hash(composed_ch_path)
+        )
+
+    def update(self, composed_ch_path: Path, input_hash: str) -> None:
+        """Record the hashes of a chapter just composed."""
+        self.hashes[composed_ch_path.name] = {
+            "input": input_hash,
+            "output": file_hash(composed_ch_path),
+        }
+
+    def save(self) -> None:
+        """Write the hashes next to the composed chapters."""
+        self.hashes_path.write_text(json.dumps(self.hashes, indent=4))
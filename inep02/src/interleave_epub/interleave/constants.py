@@ -33,9 +33,65 @@ sent_model_names = {
     "en": "sentence-transformers/all-MiniLM-L6-v2",
 }
 
+# cross encoder model names, used to rerank the unsure sentence matches
+cross_encoder_model_names = {
+    "en": "cross-encoder/stsb-distilroberta-base",
+}
+
+################################################################################
+# alignment
+
+# chapters with more sentences than this use the coarse-to-fine "pyramid" engine
+pyramid_min_sent_num = 1500
+# number of sentences pooled in a block for the coarse alignment
+pyramid_block_size = 16
+# weight of the sentence length prior mixed in the similarity, 0 to disable it
+length_prior_weight = 0.0
+# how to compare the sentences: "sent_transformer", "lexical" or "anchor"
+sim_method = "sent_transformer"
+# the engine that matches the chapters, see interleave.engine:
+# "greedy_triangle" votes the paragraphs from the sentences,
+# "paragraph" aligns the paragraph embeddings directly
+align_engine_name = "greedy_triangle"
+# number of processes used to align all the chapters at once,
+# each one loads its own sentence transformer
+align_all_max_workers = 2
+# compute the aligner of the next chapter in the background
+prefetch_enabled = True
+# also prefetch the current chapter with the delta changed by one
+prefetch_delta_neighbours = False
+# at most this many prefetched aligners are kept in memory
+prefetch_max_aligners = 2
+# paragraph matches with a confidence above this are accepted without asking,
+# None to ask for all of them
+auto_accept_th: float | None = None
+# how to rerank the unsure sentence matches: "token_overlap", "cross_encoder" or None
+rerank_scorer_name: str | None = None
+# the paragraph picks are appended to a journal,
+# folded in a snapshot of the alignment after this many events
+align_journal_compact_every = 200
+# the picks that can be undone for each chapter pair
+align_journal_max_undo = 100
+
+################################################################################
+# server
+
+# each browser session gets its own interleaver,
+# above this budget the least recently used aligners and sessions are evicted
+session_memory_budget_mb = 4096
+# rough memory used by a parsed sentence, with its spacy docs and translation
+book_bytes_per_sent = 20_000
+# load the models for the default languages in the background when the server starts
+warm_up_models_at_start = True
+
 ################################################################################
 # default values for the view
 
+# size in pixels of the tiles of the similarity heatmap
+heatmap_tile_size = 256
+# the PNG tiles kept in memory for each aligner
+heatmap_max_cached_tiles = 64
+
 # language tags
 lt_options = [
     {"tag": "auto", "name": "Auto detect"},
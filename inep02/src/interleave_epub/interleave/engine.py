@@ -0,0 +1,792 @@
+"""Alignment engines: different strategies behind a common interface.
+
+An engine gets the features of the two chapters and a similarity source,
+and returns the sentence and paragraph mappings with their confidence.
+The ``Aligner`` computes (and caches) the similarity and keeps the state
+of the interactive fixing, the engine only does the matching,
+so engines can be benchmarked and swapped per book without touching the app.
+
+New engines are registered with ``register_engine`` and built by name
+with ``build_engine``.
+"""
+
+from collections import Counter
+from dataclasses import dataclass, field
+from itertools import groupby
+from typing import TYPE_CHECKING, Callable, ClassVar, Protocol
+
+from loguru import logger as lg
+import numpy as np
+
+from interleave_epub.epub.chapter import Chapter
+from interleave_epub.interleave.par_align import (
+    match_margins,
+    path_margins,
+    vote_dst_par,
+)
+from interleave_epub.interleave.pyramid import (
+    BandSimilarity,
+    coarse_block_path,
+    dense_similarity,
+    path_centers,
+    path_corridor,
+    pool_sim_blocks,
+)
+from interleave_epub.utils import are_contiguos
+
+if TYPE_CHECKING:
+    import pandas as pd
+
+
+@dataclass
+class ChapterFeatures:
+    """What an engine needs to know about a chapter.
+
+    Plain lists, so that the features can be pickled and sent to other processes.
+    """
+
+    # the sentences used to compute the similarity
+    sents_text: list[str]
+    # the length in tokens of those sentences
+    sents_len: list[int]
+    # the paragraph id of each sentence
+    sents_par_id: list[int]
+    # the number of paragraphs
+    par_num: int
+
+    @property
+    def sents_num(self) -> int:
+        """The number of sentences."""
+        return len(self.sents_text)
+
+    @property
+    def pars_sent_ids(self) -> list[list[int]]:
+        """The chapter sentence ids of each paragraph."""
+        pars_cs_ids: list[list[int]] = [[] for _ in range(self.par_num)]
+        for cs_id, par_id in enumerate(self.sents_par_id):
+            pars_cs_ids[par_id].append(cs_id)
+        return pars_cs_ids
+
+    @property
+    def pars_text(self) -> list[str]:
+        """The sentences of each paragraph joined."""
+        return [
+            " ".join(self.sents_text[cs_id] for cs_id in par_cs_ids)
+            for par_cs_ids in self.pars_sent_ids
+        ]
+
+    @classmethod
+    def from_chapter(cls, ch: Chapter, which_sent: str) -> "ChapterFeatures":
+        """Extract the features of a chapter.
+
+        The sentence texts are not copied: if they are translated in place later,
+        the features see the translation.
+        """
+        return cls(
+            sents_text=ch.sents_text[which_sent],
+            sents_len=ch.sents_len[which_sent],
+            sents_par_id=[ch.cs_to_ps[cs_id][0] for cs_id in range(len(ch.cs_to_ps))],
+            par_num=len(ch.paragraphs),
+        )
+
+
+@dataclass
+class SimilaritySource:
+    """The similarity an engine works on.
+
+    ``sim`` is between sentences or between paragraphs,
+    depending on the ``sim_level`` of the engine.
+    The pyramid similarity is only computed in a corridor,
+    and carries the coarse path the corridor was built around.
+    """
+
+    sim: np.ndarray | BandSimilarity
+    # encode more texts if the engine needs them, in the space of the similarity
+    encode: Callable[[list[str]], np.ndarray] | None = None
+    # src ids whose best match is sure even if they are short
+    sure_ids_src: set[int] = field(default_factory=set)
+
+
+@dataclass
+class AlignResult:
+    """The output of an engine.
+
+    The sentence level fields are used to plot the alignment,
+    the engines that match paragraphs directly fill them with paragraph ids.
+    """
+
+    # number of items aligned in the two chapters
+    num_src: int
+    num_dst: int
+    # the best dst id for every src id
+    ids_dst_max: list[int]
+    # the matches considered reliable
+    good_ids_src: list[int]
+    good_ids_dst_max: list[int]
+    # the line fitted on the good matches
+    fit_coeff: np.ndarray
+    # the dst paragraph of every src paragraph, -1 if missing
+    par_src_to_dst_flat: dict[int, int]
+    # how much we trust each paragraph match, in [0, 1]
+    par_confidence: dict[int, float]
+
+    @property
+    def ids_src(self) -> list[int]:
+        """All the src ids."""
+        return list(range(self.num_src))
+
+    @property
+    def fit_func(self) -> np.poly1d:
+        """The fitted line."""
+        return np.poly1d(self.fit_coeff)
+
+
+class AlignEngine(Protocol):
+    """Match the sentences and paragraphs of two chapters."""
+
+    # the registered name
+    name: ClassVar[str]
+    # "sentence" or "paragraph": which similarity the engine needs
+    sim_level: ClassVar[str]
+
+    def align(
+        self,
+        feat_src: ChapterFeatures,
+        feat_dst: ChapterFeatures,
+        sim_source: SimilaritySource,
+    ) -> AlignResult:
+        """Align the two chapters."""
+        ...
+
+
+# engine name: engine class
+align_engines: dict[str, type[AlignEngine]] = {}
+
+
+def register_engine(name: str):
+    """Register an engine class under a name."""
+
+    def decorator(cls: type[AlignEngine]) -> type[AlignEngine]:
+        cls.name = name
+        align_engines[name] = cls
+        return cls
+
+    return decorator
+
+
+def build_engine(name: str, **kwargs) -> AlignEngine:
+    """Build a registered engine, the kwargs are passed to the constructor."""
+    if name not in align_engines:
+        raise ValueError(
+            f"Unknown align engine {name}, pick one of {list(align_engines)}."
+        )
+    return align_engines[name](**kwargs)
+
+
+################################################################################
+# steps shared by the sentence engines
+
+
+def find_ooo_ids(ids_dst_max: list[int]) -> list[bool]:
+    """Find the non monothonic ids_dst_max."""
+    is_ooo_flattened = []
+    for id_src, id_dst_max in enumerate(ids_dst_max):
+        # check to the left if you can
+        if id_src > 0:
+            ooo_left = id_dst_max < ids_dst_max[id_src - 1]
+        else:
+            ooo_left = False
+        # check to the right if you can
+        if id_src < len(ids_dst_max) - 1:
+            ooo_right = id_dst_max > ids_dst_max[id_src + 1]
+        else:
+            ooo_right = False
+        # if any side is ooo, mark it
+        is_ooo_flattened.append(ooo_right or ooo_left)
+    return is_ooo_flattened
+
+
+def interpolate_ooo_ids(ids_dst_max: list[int], is_ooo: list[bool]) -> "pd.Series":
+    """Remove the ooo matches and interpolate them.
+
+    These will be the first guess used to present the paragraph options to the user.
+    """
+    import pandas as pd
+
+    ids_dst_interpolate = pd.Series(ids_dst_max)
+    ids_dst_interpolate[is_ooo] = np.nan
+    ids_dst_interpolate.interpolate(inplace=True)
+    return ids_dst_interpolate
+
+
+def vote_paragraphs(
+    good_ids_src: list[int],
+    ids_dst_interpolate: "pd.Series",
+    feat_src: ChapterFeatures,
+    feat_dst: ChapterFeatures,
+    th_consensus: float = 0.6,
+) -> tuple[dict[int, int], dict[int, float]]:
+    """Match the paragraphs voting with the good sentences.
+
+    Args:
+        good_ids_src (list[int]): The src sentences that can vote.
+        ids_dst_interpolate (pd.Series): The dst sentence of every src sentence.
+        feat_src (ChapterFeatures): The src chapter.
+        feat_dst (ChapterFeatures): The dst chapter.
+        th_consensus (float): The fraction of sentences in a src paragraph
+            matched to the same dst paragraph to have a direct match.
+
+    Returns:
+        tuple[dict[int, int], dict[int, float]]: The direct paragraph matches
+            and the fraction of sentences that agree with each match.
+    """
+    good_par_src_to_dst = {}
+    par_consensus = {}
+    # indexing the series one sentence at a time is slow
+    ids_dst_interpolate_np = ids_dst_interpolate.to_numpy()
+
+    # group the good sentences on their src paragraph
+    for par_src_id, cs_src_ids_group in groupby(
+        good_ids_src, lambda cs_src_id: feat_src.sents_par_id[cs_src_id]
+    ):
+        cs_src_ids = list(cs_src_ids_group)
+        num_sents_src = len(cs_src_ids)
+
+        # the dst paragraphs those sentences are matched to
+        # the interpolated values are not int
+        par_dst_ids = [
+            feat_dst.sents_par_id[int(ids_dst_interpolate_np[cs_src_id])]
+            for cs_src_id in cs_src_ids
+        ]
+
+        # decide if there is a consensus on the paragraphs
+        par_dst_mc_id, par_dst_mc_count = Counter(par_dst_ids).most_common()[0]
+        par_consensus[par_src_id] = par_dst_mc_count / num_sents_src
+
+        # if enough sentences point to the same dst paragraph, select that
+        if par_dst_mc_count / num_sents_src > th_consensus:
+            good_par_src_to_dst[par_src_id] = par_dst_mc_id
+        # if all the dst paragraphs are contiguos, select the min
+        elif are_contiguos(par_dst_ids):
+            good_par_src_to_dst[par_src_id] = min(par_dst_ids)
+
+    return good_par_src_to_dst, par_consensus
+
+
+def fill_paragraph_gaps(
+    good_par_src_to_dst: dict[int, int],
+    par_num_src: int,
+) -> dict[int, int]:
+    """Fill in the paragraphs missing from both src and dst, then flatten.
+
+    If one or two paragraphs are missing on both sides between two matches,
+    they are matched in order.
+    All the other src paragraphs without a match get -1.
+    """
+    better_par_src_to_dst = {}
+
+    last_src_id = 0
+    last_dst_id = 0
+    for par_src_id, par_dst_id in good_par_src_to_dst.items():
+        after_last_par_src_id = last_src_id + 1
+        after_last_par_dst_id = last_dst_id + 1
+        prev_par_src_id = par_src_id - 1
+        prev_par_dst_id = par_dst_id - 1
+
+        # add the middle one if exactly one is missing
+        if (
+            after_last_par_src_id == prev_par_src_id
+            and after_last_par_dst_id == prev_par_dst_id
+        ):
+            better_par_src_to_dst[prev_par_src_id] = after_last_par_dst_id
+
+        # add the middle two if exactly two are missing
+        elif (
+            after_last_par_src_id + 1 == prev_par_src_id
+            and after_last_par_dst_id + 1 == prev_par_dst_id
+        ):
+            better_par_src_to_dst[after_last_par_src_id] = after_last_par_dst_id
+            better_par_src_to_dst[after_last_par_src_id + 1] = after_last_par_dst_id + 1
+
+        # add the current one
+        better_par_src_to_dst[par_src_id] = par_dst_id
+
+        # update data
+        last_src_id = par_src_id
+        last_dst_id = par_dst_id
+
+    # flatten the better matching to have all the possible par src id
+    return {
+        par_src_id: better_par_src_to_dst.get(par_src_id, -1)
+        for par_src_id in range(par_num_src)
+    }
+
+
+def paragraph_confidence(
+    par_src_to_dst_flat: dict[int, int],
+    par_consensus: dict[int, float],
+    unit_par_ids: list[int] | np.ndarray,
+    unit_margins: np.ndarray,
+    unit_dists: np.ndarray,
+    win_len: int,
+    margin_scale: float = 0.1,
+) -> dict[int, float]:
+    """Compute how much we trust each paragraph match.
+
+    The confidence is the mean of three scores in ``[0, 1]``:
+
+    * the consensus: fraction of sentences that voted for the dst paragraph,
+    * the margin between the best and second best similarity,
+      saturated at ``margin_scale``,
+    * the closeness of the match to the fitted line, relative to ``win_len``.
+
+    The margin and the distance of the matched units (sentences or paragraphs)
+    are averaged on the src paragraph ``unit_par_ids`` they belong to.
+    The paragraphs without a direct match (filled in or missing) get 0.
+    """
+    # the mean margin and distance of the units of each paragraph
+    unit_par_ids = np.asarray(unit_par_ids, dtype=np.int64)
+    par_num = max(max(par_src_to_dst_flat, default=-1), unit_par_ids.max(initial=-1))
+    unit_counts = np.bincount(unit_par_ids, minlength=par_num + 1)
+    unit_counts_safe = np.maximum(unit_counts, 1)
+    pars_margin = (
+        np.bincount(unit_par_ids, weights=unit_margins, minlength=par_num + 1)
+        / unit_counts_safe
+    )
+    pars_dist = (
+        np.bincount(unit_par_ids, weights=unit_dists, minlength=par_num + 1)
+        / unit_counts_safe
+    )
+    pars_score_margin = np.clip(pars_margin / margin_scale, 0, 1)
+    pars_score_line = np.maximum(0, 1 - pars_dist / win_len)
+
+    par_confidence: dict[int, float] = {}
+    for par_src_id in par_src_to_dst_flat:
+        if par_src_id not in par_consensus or unit_counts[par_src_id] == 0:
+            par_confidence[par_src_id] = 0
+            continue
+        confidence = (
+            par_consensus[par_src_id]
+            + pars_score_margin[par_src_id]
+            + pars_score_line[par_src_id]
+        ) / 3
+        par_confidence[par_src_id] = float(confidence)
+    return par_confidence
+
+
+def sentence_result(
+    ids_dst_max: list[int],
+    good_ids_src: list[int],
+    good_ids_dst_max: list[int],
+    good_ids_src_rescaled: list[int],
+    good_ids_dst_max_rescaled: list[int],
+    feat_src: ChapterFeatures,
+    feat_dst: ChapterFeatures,
+    sim: np.ndarray | BandSimilarity,
+    win_len: int,
+    th_consensus: float,
+) -> AlignResult:
+    """Vote the paragraphs from a sentence matching and pack the result."""
+    fit_coeff = np.polyfit(good_ids_src, good_ids_dst_max, 1)
+
+    # vote the paragraphs with the monotone part of the matching
+    is_ooo = find_ooo_ids(ids_dst_max)
+    ids_dst_interpolate = interpolate_ooo_ids(ids_dst_max, is_ooo)
+    good_par_src_to_dst, par_consensus = vote_paragraphs(
+        good_ids_src_rescaled, ids_dst_interpolate, feat_src, feat_dst, th_consensus
+    )
+    par_src_to_dst_flat = fill_paragraph_gaps(good_par_src_to_dst, feat_src.par_num)
+
+    # only the direct matches get a confidence
+    par_consensus = {k: v for k, v in par_consensus.items() if k in good_par_src_to_dst}
+    cs_src_ids = np.array(good_ids_src_rescaled, dtype=np.int64)
+    cs_dst_ids = np.array(good_ids_dst_max_rescaled, dtype=np.int64)
+    par_confidence = paragraph_confidence(
+        par_src_to_dst_flat,
+        par_consensus,
+        [feat_src.sents_par_id[cs_src_id] for cs_src_id in cs_src_ids],
+        match_margins(sim, cs_src_ids, cs_dst_ids, win_len),
+        np.abs(cs_dst_ids - np.poly1d(fit_coeff)(cs_src_ids)),
+        win_len,
+    )
+
+    return AlignResult(
+        num_src=feat_src.sents_num,
+        num_dst=feat_dst.sents_num,
+        ids_dst_max=ids_dst_max,
+        good_ids_src=good_ids_src,
+        good_ids_dst_max=good_ids_dst_max,
+        fit_coeff=fit_coeff,
+        par_src_to_dst_flat=par_src_to_dst_flat,
+        par_confidence=par_confidence,
+    )
+
+
+################################################################################
+# the engines
+
+
+@register_engine("greedy_triangle")
+class GreedyTriangleEngine:
+    """Greedy sentence matching, refined with a triangular filter on a fitted line.
+
+    First use the similarity matrix to fit a line,
+    then give more weight to values near the line.
+    The paragraphs are voted by their sentences.
+    """
+
+    sim_level = "sentence"
+
+    def __init__(
+        self,
+        win_len: int = 20,
+        min_sent_len: int = 4,
+        th_consensus: float = 0.6,
+    ) -> None:
+        """Initialize the engine."""
+        self.win_len = win_len
+        self.min_sent_len = min_sent_len
+        self.th_consensus = th_consensus
+
+    def align(
+        self,
+        feat_src: ChapterFeatures,
+        feat_dst: ChapterFeatures,
+        sim_source: SimilaritySource,
+    ) -> AlignResult:
+        """Align the sentences, then vote the paragraphs."""
+        from scipy.signal.windows import triang
+
+        sim = sim_source.sim
+        win_len = self.win_len
+        min_sent_len = self.min_sent_len
+        # length of the sentences in the two chapters
+        sent_len_src = feat_src.sents_len
+        sent_len_dst = feat_dst.sents_len
+        # number of sentences in the two chapters
+        sent_num_src = feat_src.sents_num
+        sent_num_dst = feat_dst.sents_num
+        ratio = sent_num_src / sent_num_dst
+
+        #############################################################################
+        # first iteration of matching: use the similarity matrix in a greedy way
+        good_ids_src = []
+        good_ids_dst_max = []
+
+        # sim.shape = (sent_num_src, sent_num_dst)
+        lg.debug(f"{sim.shape=} {sent_num_src=} {sent_num_dst=}")
+
+        for id_src in range(sent_num_src):
+            # find the center rescaled, there are different number of sents in the two chapters
+            id_dst_ratio = int(id_src / ratio)
+
+            # the chopped similarity array
+            win_left = max(0, id_dst_ratio - win_len)
+            win_right = min(sent_num_dst, id_dst_ratio + win_len + 1)
+            some_sent_sim = sim[id_src, win_left:win_right]
+
+            # the dst sent id with highest similarity
+            id_dst_max = some_sent_sim.argmax() + win_left
+
+            # only save the results if the docs are long enough
+            # or if the reranking found a clear match
+            if (
+                sent_len_src[id_src] > min_sent_len
+                and sent_len_dst[id_dst_max] > min_sent_len
+            ) or id_src in sim_source.sure_ids_src:
+                good_ids_src.append(id_src)
+                good_ids_dst_max.append(id_dst_max)
+
+        # fit a line on the good matches
+        fit_func = np.poly1d(np.polyfit(good_ids_src, good_ids_dst_max, 1))
+
+        #############################################################################
+        # second iteration of matching: use the line to rescale the similarity
+
+        # build a triangular filter to give more relevance to sentences close to the fit
+        triang_filt = triang(win_len * 4 + 1)
+        triang_center = win_len * 2 + 1
+
+        good_ids_src_rescaled = []
+        good_ids_dst_max_rescaled = []
+        ids_dst_max = []
+        last_good_id_dst_max = 0
+
+        for id_src in range(sent_num_src):
+            # find the center rescaled because there are different number of sent in the two chapters
+            id_dst_ratio = int(id_src / ratio)
+
+            # the chopped similarity array, centered on id_dst_ratio
+            win_left = max(0, id_dst_ratio - win_len)
+            win_right = min(sent_num_dst, id_dst_ratio + win_len + 1)
+            some_sent_sim = sim[id_src, win_left:win_right]
+
+            # the fit along the line
+            ii_fit = int(fit_func([id_src])[0])
+            ii_fit = min(max(ii_fit, 0), sent_num_dst - 1)
+
+            # chop the filter, centering the apex on the fitted line ii_fit
+            # the apex is in win_len*2+1
+            # the similarity is centered on id_dst_ratio
+            # the shifted filter is still win_len*2+1 long
+            delta_ii_fit = id_dst_ratio - ii_fit
+            filt_edge_left = triang_center + delta_ii_fit - win_len - 1
+            filt_edge_right = triang_center + delta_ii_fit + win_len + 0
+            triang_filt_shifted = triang_filt[filt_edge_left:filt_edge_right]
+
+            # chop the filter as well, if the similarity is near the border
+            if id_dst_ratio < win_len:
+                triang_filt_chop = triang_filt_shifted[win_len - id_dst_ratio :]
+            elif id_dst_ratio > sent_num_dst - (win_len + 1):
+                left_edge = sent_num_dst - (win_len + 1)
+                triang_filt_chop = triang_filt_shifted[: -(id_dst_ratio - left_edge)]
+            else:
+                triang_filt_chop = triang_filt_shifted
+
+            assert len(triang_filt_chop) == len(some_sent_sim)
+
+            # find the max similarity on the rescaled sim array
+            sim_rescaled = some_sent_sim * triang_filt_chop
+            id_dst_max_rescaled = sim_rescaled.argmax() + win_left
+
+            # keep if both sents are long or the match is sure
+            if (
+                sent_len_src[id_src] > min_sent_len
+                and sent_len_dst[id_dst_max] > min_sent_len
+            ) or id_src in sim_source.sure_ids_src:
+                good_ids_src_rescaled.append(id_src)
+                good_ids_dst_max_rescaled.append(int(id_dst_max_rescaled))
+                # update the last max we saw
+                last_good_id_dst_max = id_dst_max_rescaled
+
+            # save all matches id_src-max
+            ids_dst_max.append(int(last_good_id_dst_max))
+
+        return sentence_result(
+            ids_dst_max,
+            good_ids_src,
+            [int(i) for i in good_ids_dst_max],
+            good_ids_src_rescaled,
+            good_ids_dst_max_rescaled,
+            feat_src,
+            feat_dst,
+            sim,
+            win_len,
+            self.th_consensus,
+        )
+
+
+@register_engine("pyramid")
+class PyramidEngine:
+    """Coarse-to-fine matching, for very long chapters.
+
+    The sentences are pooled in blocks of ``block_size``,
+    the monotone path on the block similarity gives a corridor,
+    and the sentences are matched only inside the corridor,
+    with a triangular filter centered on the path instead of a line.
+
+    A ``BandSimilarity`` already has the coarse path and the corridor,
+    and the engine reads only the values inside it.
+    A dense similarity is pooled in blocks to find them again.
+    """
+
+    sim_level = "sentence"
+
+    def __init__(
+        self,
+        win_len: int = 20,
+        min_sent_len: int = 4,
+        th_consensus: float = 0.6,
+        block_size: int = 16,
+        corridor_blocks: int = 1,
+    ) -> None:
+        """Initialize the engine."""
+        self.win_len = win_len
+        self.min_sent_len = min_sent_len
+        self.th_consensus = th_consensus
+        self.block_size = block_size
+        self.corridor_blocks = corridor_blocks
+
+    def align(
+        self,
+        feat_src: ChapterFeatures,
+        feat_dst: ChapterFeatures,
+        sim_source: SimilaritySource,
+    ) -> AlignResult:
+        """Align the sentences inside the corridor, then vote the paragraphs."""
+        sim = sim_source.sim
+        win_len = self.win_len
+        min_sent_len = self.min_sent_len
+        bs = self.block_size
+        # length of the sentences in the two chapters
+        sent_len_src = np.array(feat_src.sents_len)
+        sent_len_dst = np.array(feat_dst.sents_len)
+        # number of sentences in the two chapters
+        sent_num_src = feat_src.sents_num
+        sent_num_dst = feat_dst.sents_num
+
+        if isinstance(sim, BandSimilarity):
+            # the corridor was found when the similarity was computed
+            block_path = sim.block_path
+            bs = sim.block_size
+            band_lo, band_hi = sim.band_lo, sim.band_hi
+        else:
+            # find the coarse path on the pooled similarity and the corridor around it
+            block_path = coarse_block_path(pool_sim_blocks(sim, bs))
+            band_lo, band_hi = path_corridor(
+                block_path, bs, sent_num_dst, self.corridor_blocks
+            )
+        centers = path_centers(block_path, bs, sent_num_src, sent_num_dst)
+
+        ids_src = np.arange(sent_num_src)
+        ids_dst_max = np.empty(sent_num_src, dtype=np.int64)
+        ids_dst_max_rescaled = np.empty(sent_num_src, dtype=np.int64)
+
+        for block_id, (lo, hi) in enumerate(zip(band_lo, band_hi)):
+            rows = slice(block_id * bs, min((block_id + 1) * bs, sent_num_src))
+            if isinstance(sim, BandSimilarity):
+                some_sim = sim.block(block_id)
+            else:
+                some_sim = sim[rows, lo:hi]
+
+            # first iteration: the max in the corridor
+            ids_dst_max[rows] = some_sim.argmax(axis=1) + lo
+
+            # second iteration: rescale with a triangular filter on the path
+            dist = np.abs(np.arange(lo, hi)[None, :] - centers[rows, None])
+            triang_filt = np.clip(1 - dist / (win_len * 2 + 1), 0, None)
+            ids_dst_max_rescaled[rows] = (some_sim * triang_filt).argmax(axis=1) + lo
+
+        # only keep the matches if the sentences are long enough
+        is_good = (sent_len_src > min_sent_len) & (
+            sent_len_dst[ids_dst_max] > min_sent_len
+        )
+        is_good_rescaled = (sent_len_src > min_sent_len) & (
+            sent_len_dst[ids_dst_max_rescaled] > min_sent_len
+        )
+        is_good_rescaled |= np.isin(ids_src, list(sim_source.sure_ids_src))
+
+        # propagate the last good match to the short sentences
+        last_good_pos = np.maximum.accumulate(np.where(is_good_rescaled, ids_src, -1))
+        last_good_ids = np.where(
+            last_good_pos >= 0, ids_dst_max_rescaled[last_good_pos], 0
+        )
+
+        # the line is used only for the visualization and the confidence
+        return sentence_result(
+            [int(i) for i in last_good_ids],
+            ids_src[is_good].tolist(),
+            ids_dst_max[is_good].tolist(),
+            ids_src[is_good_rescaled].tolist(),
+            ids_dst_max_rescaled[is_good_rescaled].tolist(),
+            feat_src,
+            feat_dst,
+            sim,
+            win_len,
+            self.th_consensus,
+        )
+
+
+@register_engine("paragraph")
+class ParagraphEngine:
+    """Match the paragraphs directly on the paragraph similarity.
+
+    The matching is the monotone path with the highest similarity.
+    If an ``encode`` function is available, the src paragraphs whose match
+    does not beat the neighbours by ``min_margin`` are matched again
+    using their sentences, compared only with the sentences
+    of the dst paragraphs around the path.
+
+    The confidence uses only the paragraph similarity and the path on it,
+    so it is the same with or without an ``encode`` function:
+    the unsure paragraphs get no consensus score.
+    """
+
+    sim_level = "paragraph"
+
+    def __init__(
+        self,
+        min_margin: float = 0.05,
+        win_len: int = 2,
+    ) -> None:
+        """Initialize the engine."""
+        self.min_margin = min_margin
+        self.win_len = win_len
+
+    def align(
+        self,
+        feat_src: ChapterFeatures,
+        feat_dst: ChapterFeatures,
+        sim_source: SimilaritySource,
+    ) -> AlignResult:
+        """Align the paragraphs, refining the unsure ones with the sentences."""
+        from sklearn.metrics.pairwise import cosine_similarity
+
+        # the paragraph similarity is small, it is never stored in a band
+        sim = dense_similarity(sim_source.sim)
+        par_num_src, par_num_dst = sim.shape
+        path = coarse_block_path(sim)
+        par_margins = path_margins(sim, path, self.win_len)
+        ids_src = np.arange(par_num_src)
+
+        # the confidence of the path before the refinement,
+        # the sure paragraphs are the ones the refinement leaves alone
+        is_sure = par_margins >= self.min_margin
+        par_consensus = dict(enumerate(is_sure.astype(float).tolist()))
+        # already at paragraph level, the window is in paragraphs
+        par_confidence = paragraph_confidence(
+            dict(enumerate(path.tolist())),
+            par_consensus,
+            ids_src.tolist(),
+            par_margins,
+            np.abs(path - np.poly1d(np.polyfit(ids_src, path, 1))(ids_src)),
+            self.win_len,
+        )
+
+        if sim_source.encode is not None:
+            pars_cs_src = feat_src.pars_sent_ids
+            pars_cs_dst = feat_dst.pars_sent_ids
+            ids_unsure = np.flatnonzero(par_margins < self.min_margin)
+            lg.debug(f"Refining {len(ids_unsure)} of {par_num_src} paragraphs.")
+            for par_src_id in ids_unsure.tolist():
+                # keep the path monotone
+                dst_left = path[par_src_id - 1] if par_src_id > 0 else 0
+                dst_right = (
+                    path[par_src_id + 1]
+                    if par_src_id < par_num_src - 1
+                    else par_num_dst - 1
+                )
+                cs_src_ids = pars_cs_src[par_src_id]
+                cs_dst_ids = [
+                    cs_id
+                    for par_dst_id in range(dst_left, dst_right + 1)
+                    for cs_id in pars_cs_dst[par_dst_id]
+                ]
+                if len(cs_src_ids) == 0 or len(cs_dst_ids) == 0:
+                    continue
+                enc_src = sim_source.encode(
+                    [feat_src.sents_text[i] for i in cs_src_ids]
+                )
+                enc_dst = sim_source.encode(
+                    [feat_dst.sents_text[i] for i in cs_dst_ids]
+                )
+                sim_sents = cosine_similarity(enc_src, enc_dst)
+                path[par_src_id], _ = vote_dst_par(
+                    sim_sents, cs_dst_ids, feat_dst.sents_par_id
+                )
+
+        ids_dst = [int(i) for i in path]
+        fit_coeff = np.polyfit(ids_src, ids_dst, 1)
+        par_src_to_dst_flat = dict(enumerate(ids_dst))
+
+        # the plots expect a sentence alignment, show the paragraph one instead
+        return AlignResult(
+            num_src=par_num_src,
+            num_dst=par_num_dst,
+            ids_dst_max=ids_dst,
+            good_ids_src=ids_src.tolist(),
+            good_ids_dst_max=ids_dst,
+            fit_coeff=fit_coeff,
+            par_src_to_dst_flat=par_src_to_dst_flat,
+            par_confidence=par_confidence,
+        )
@@ -0,0 +1,79 @@
+"""Cut the similarity matrix in tiles, at several zoom levels.
+
+A chapter with thousands of sentences has a similarity matrix
+far bigger than the screen: drawn whole, the band of good matches
+is a one pixel line.
+
+The matrix is max pooled in 2x2 blocks over and over,
+building a pyramid of levels: level 0 is the full matrix,
+each level halves the size of the previous one, the last one fits in a tile.
+Max pooling keeps the band of good matches visible at every level.
+Each level is cut in square tiles, the page shows the tiles around
+the paragraph being fixed and can zoom in and out.
+"""
+
+import numpy as np
+
+
+def max_pool_sim(sim: np.ndarray) -> np.ndarray:
+    """Max pool a similarity matrix in 2x2 blocks, the last ones can be smaller."""
+    starts_src = np.arange(0, sim.shape[0], 2)
+    starts_dst = np.arange(0, sim.shape[1], 2)
+    return np.maximum.reduceat(
+        np.maximum.reduceat(sim, starts_src, axis=0), starts_dst, axis=1
+    )
+
+
+class SimTiles:
+    """The pyramid of max pooled levels of a similarity matrix, cut in tiles."""
+
+    def __init__(self, sim: np.ndarray, tile_size: int = 256) -> None:
+        """Build all the levels of the pyramid.
+
+        The levels together are a third of the size of the matrix.
+        """
+        self.tile_size = tile_size
+        self.levels = [sim]
+        while max(self.levels[-1].shape) > tile_size:
+            self.levels.append(max_pool_sim(self.levels[-1]))
+        # the same colors at every level and for every tile
+        self.vmin = float(sim.min()) if sim.size > 0 else 0.0
+        self.vmax = float(sim.max()) if sim.size > 0 else 1.0
+
+    @property
+    def nbytes(self) -> int:
+        """The bytes used by all the levels."""
+        return sum(level.nbytes for level in self.levels)
+
+    @property
+    def level_num(self) -> int:
+        """The number of levels, the last one fits in a single tile."""
+        return len(self.levels)
+
+    def tile_num(self, level: int) -> tuple[int, int]:
+        """The number of tiles along src and dst at a level."""
+        size_src, size_dst = self.levels[level].shape
+        return (
+            -(-size_src // self.tile_size),
+            -(-size_dst // self.tile_size),
+        )
+
+    def tile(self, level: int, tile_src: int, tile_dst: int) -> np.ndarray:
+        """Get a tile, the cells outside of the matrix are NaN.
+
+        Raises:
+            IndexError: If the tile is outside of the pyramid.
+        """
+        if not 0 <= level < self.level_num:
+            raise IndexError(f"No level {level} in {self.level_num} levels.")
+        tile_num_src, tile_num_dst = self.tile_num(level)
+        if not (0 <= tile_src < tile_num_src and 0 <= tile_dst < tile_num_dst):
+            raise IndexError(f"No tile {tile_src} {tile_dst} at level {level}.")
+
+        ts = self.tile_size
+        block = self.levels[level][
+            tile_src * ts : (tile_src + 1) * ts, tile_dst * ts : (tile_dst + 1) * ts
+        ]
+        tile = np.full((ts, ts), np.nan, dtype=np.float32)
+        tile[: block.shape[0], : block.shape[1]] = block
+        return tile
@@ -1,28 +1,56 @@
 """Interactive interleaver."""
 
+from functools import partial
 from pathlib import Path
-from typing import IO, cast
+from typing import IO, Callable, Iterator
 
 from loguru import logger as lg
-from sentence_transformers import SentenceTransformer
-from transformers.pipelines import pipeline
-from transformers.pipelines.text2text_generation import TranslationPipeline
 
+from interleave_epub.epub.chapter import Chapter
 from interleave_epub.epub.epub import EPub
 from interleave_epub.epub.epub_builder import EpubBuilder
 from interleave_epub.interleave.align import Aligner
-from interleave_epub.interleave.build_chap import interleave_chap
+from interleave_epub.interleave.align_journal import write_align_snapshot
+from interleave_epub.interleave.batch_align import (
+    AlignSettings,
+    PairJob,
+    align_pairs_parallel,
+)
+from interleave_epub.interleave.build_chap import ComposedChapterCache, interleave_chap
 from interleave_epub.interleave.constants import (
+    align_all_max_workers,
+    align_engine_name,
+    auto_accept_th,
+    book_bytes_per_sent,
+    cross_encoder_model_names,
     hug_model_name_tmpl,
     hug_model_names,
     hug_trad_cache_fol,
     hug_trad_file_tmpl,
+    length_prior_weight,
+    prefetch_delta_neighbours,
+    prefetch_enabled,
+    prefetch_max_aligners,
+    pyramid_block_size,
+    pyramid_min_sent_num,
+    rerank_scorer_name,
     sent_model_names,
-    spa_model_cache_fol,
+    sim_method,
     spa_model_names,
 )
+from interleave_epub.interleave.engine import ChapterFeatures
+from interleave_epub.interleave.length_align import length_align_paragraphs
+from interleave_epub.interleave.prefetch import AlignerPrefetcher
+from interleave_epub.interleave.rerank import RerankScorer, token_overlap_scorer
+from interleave_epub.interleave.similarity import is_lexical, similarity_cache_path
 from interleave_epub.nlp.cached_pipe import TranslationPipelineCache
-from interleave_epub.nlp.local_spacy_model import spacy_load_local_model
+from interleave_epub.nlp.model_registry import (
+    cross_encoder,
+    model_registry,
+    sentence_transformer,
+    spacy_model,
+    translation_pipe,
+)
 from interleave_epub.utils import get_package_fol, orig_or_trad, src_or_dst
 
 
@@ -47,9 +75,15 @@ class InterleaverInteractive:
         # placeholder for the epubs
         self.epubs: dict[src_or_dst, EPub] = {}
         self.has_both_epubs = False
+        # the books loaded from a file, that can be loaded again after a restart
+        self.book_files: dict[src_or_dst, dict[str, str]] = {}
 
         # aligners
         self.aligners: dict[str, Aligner] = {}
+        # aligners of the next chapters, computed in the background
+        self.prefetcher = AlignerPrefetcher(prefetch_max_aligners)
+        # the bytes kept for an aligner outside of it, as the heatmap tiles
+        self.aligner_extra_size: Callable[[Aligner], int] = lambda al: 0
         self.reset_chapter_ids()
 
     def set_lang_tag(self, lang_tag: str, which_lang: src_or_dst) -> None:
@@ -76,11 +110,8 @@ class InterleaverInteractive:
             return
         lg.debug("Loading NLP tools.")
 
-        # load the spacy models
-        self.nlp = {
-            lt: spacy_load_local_model(spa_model_names[lt], spa_model_cache_fol)
-            for lt in self.lts_l
-        }
+        # load the spacy models, shared with the other interleavers
+        self.nlp = {lt: spacy_model(spa_model_names[lt]) for lt in self.lts_l}
         lg.debug("Loaded SpaCy models.")
 
         # get the location of the trad cache files
@@ -97,26 +128,22 @@ class InterleaverInteractive:
             self.lts_ph[0]: True,
             self.lts_ph[1]: False,
         }
-
-        # load the huggingface pipelines
-        self.pipe = {
-            lth: cast(
-                TranslationPipeline,
-                # pipeline("translation", model=hug_model_name_tmpl.format(lth)),
-                pipeline("translation", model=hug_model_names[lth]),
-            )
-            if load_pipe[lth]
-            else None
-            for lth in self.lts_ph
-        }
+        # the lexical similarity compares the original sentences, no translation
+        self.needs_trad = not is_lexical(sim_method, align_engine_name)
 
         # create the cached pipelines
-        self.pipe_cache = {
-            lth: TranslationPipelineCache(
-                self.pipe[lth], self.trad_cache_path[lth], lt_pair=lth
+        # shared: two caches on the same file would overwrite each other
+        self.pipe_cache: dict[str, TranslationPipelineCache] = {}
+        for lth in self.lts_ph:
+            pipe_cache = model_registry.get(
+                f"trad_cache_{lth}",
+                partial(TranslationPipelineCache, None, self.trad_cache_path[lth], lth),
             )
-            for lth in self.lts_ph
-        }
+            # load the huggingface pipeline if this pair needs it
+            if load_pipe[lth] and self.needs_trad and pipe_cache.pipe is None:
+                # translation_pipe(hug_model_name_tmpl.format(lth))
+                pipe_cache.pipe = translation_pipe(hug_model_names[lth])
+            self.pipe_cache[lth] = pipe_cache
         lg.debug("Loaded HuggingFace models.")
 
         # load the sentence transformer
@@ -124,11 +151,8 @@ class InterleaverInteractive:
         # which will mean aligning src_trad-dst_orig or vice versa
         # we assume that dst is english and we know the sent model for that
         self.lt_sent_tra = self.sd_to_lt["dst"]
-        # TODO: why on CPU? parametrize that
         self.sent_transformer = {
-            self.lt_sent_tra: SentenceTransformer(
-                sent_model_names[self.lt_sent_tra], device="cpu"
-            )
+            self.lt_sent_tra: sentence_transformer(sent_model_names[self.lt_sent_tra])
         }
         # which sent to use to align in the source and dest ebook
         self.sent_which_align = {
@@ -137,6 +161,16 @@ class InterleaverInteractive:
         }
         lg.debug("Loaded SentenceTransformer model.")
 
+        # the scorer for the unsure sentence matches
+        self.rerank_scorer: RerankScorer | None = None
+        if rerank_scorer_name == "token_overlap":
+            self.rerank_scorer = token_overlap_scorer
+        elif rerank_scorer_name == "cross_encoder":
+            self.rerank_scorer = cross_encoder(
+                cross_encoder_model_names[self.lt_sent_tra]
+            )
+            lg.debug("Loaded CrossEncoder model.")
+
         self.has_nlp_loaded = True
 
     def add_book(
@@ -145,10 +179,12 @@ class InterleaverInteractive:
         which_ep: src_or_dst,
         ep_name: str = "",
         ep_author: str = "",
+        progress: Callable[[int, int], None] | None = None,
     ) -> None:
         """Add a book to the interleaver.
 
         Pass which one it is.
+        ``progress`` is called with the number of chapters loaded and the total.
         """
         if not self.has_both_lts:
             return
@@ -172,8 +208,25 @@ class InterleaverInteractive:
             lt_trad,
             self.nlp,
             self.pipe_cache,
+            # in anchor mode only the sentences needed to align are translated,
+            # in lexical mode none of them
+            defer_trad=sim_method == "anchor" or not self.needs_trad,
+            progress=progress,
         )
 
+        # remember where the book is, to restore the session
+        if isinstance(ep_path, (str, Path)):
+            self.book_files[which_ep] = {
+                "path": str(ep_path),
+                "name": ep_name,
+                "author": ep_author,
+            }
+        else:
+            self.book_files.pop(which_ep, None)
+
+        # the prefetched aligners belong to the old book
+        self.prefetcher.clear()
+
         if "src" in self.epubs and "dst" in self.epubs:
             self.has_both_epubs = True
 
@@ -200,10 +253,16 @@ class InterleaverInteractive:
         if not self.output_fol.exists():
             self.output_fol.mkdir(parents=True)
 
-    def align_auto(self, force_align: bool = False) -> None:
+    def align_auto(
+        self,
+        force_align: bool = False,
+        on_stage: Callable[[str], None] | None = None,
+    ) -> None:
         """Compute the similarity and hopeful alignment.
 
         TODO: Whenever a change in ch_curr/ch_delta occurs, this is called.
+
+        ``on_stage`` is called with the name of each stage of the alignment.
         """
         if not self.has_both_epubs:
             lg.warning("Load both epubs before aligning.")
@@ -215,17 +274,291 @@ class InterleaverInteractive:
 
         # get the current chapters we are using and
         # create the aligner for this pair of chapters if needed
-        if self.ch_id_pair_str not in self.aligners or force_align:
-            self.aligners[self.ch_id_pair_str] = Aligner(
-                self.epubs["src"].chapters[self.ch_id_src],
-                self.epubs["dst"].chapters[self.ch_id_dst],
-                self.sent_which_align,
-                self.ch_id_pair_str,
-                self.lt_sent_tra,
-                self.sent_transformer,
-                self.align_cache_fol,
-                force_align,
+        # the ids are copied: the user can move to another chapter meanwhile
+        ch_id_src, ch_id_dst = self.ch_id_src, self.ch_id_dst
+        ch_id_pair_str = f"{ch_id_src}_{ch_id_dst}"
+        if ch_id_pair_str not in self.aligners or force_align:
+            ch_src = self.epubs["src"].chapters[ch_id_src]
+            ch_dst = self.epubs["dst"].chapters[ch_id_dst]
+
+            # use the aligner computed in the background if there is one
+            aligner = self.prefetcher.pop(ch_id_pair_str)
+            if aligner is None or force_align:
+                aligner = self.build_aligner(
+                    ch_src, ch_dst, ch_id_pair_str, force_align, on_stage
+                )
+            self.aligners[ch_id_pair_str] = aligner
+        else:
+            # the aligners are kept in least recently used order
+            self.aligners[ch_id_pair_str] = self.aligners.pop(ch_id_pair_str)
+
+        # while the user reviews this chapter, align the next ones
+        if prefetch_enabled:
+            self.prefetch_next()
+
+    def prefetch_next(self) -> None:
+        """Start computing in the background the chapters that will be shown next.
+
+        The next chapter with the same delta, and optionally
+        the current chapter with the delta changed by one.
+        """
+        ch_ids = [(self.ch_id_src + 1, self.ch_id_dst + 1)]
+        if prefetch_delta_neighbours:
+            ch_ids.append((self.ch_id_src, self.ch_id_dst + 1))
+            ch_ids.append((self.ch_id_src, self.ch_id_dst - 1))
+
+        targets: dict[str, Callable[..., Aligner]] = {}
+        for ch_id_src, ch_id_dst in ch_ids:
+            ch_id_pair_str = f"{ch_id_src}_{ch_id_dst}"
+            if ch_id_pair_str in self.aligners:
+                continue
+            if ch_id_src not in self.epubs["src"].chapters:
+                continue
+            if ch_id_dst not in self.epubs["dst"].chapters:
+                continue
+            ch_src = self.epubs["src"].chapters[ch_id_src]
+            ch_dst = self.epubs["dst"].chapters[ch_id_dst]
+            targets[ch_id_pair_str] = partial(
+                self.build_aligner, ch_src, ch_dst, ch_id_pair_str
+            )
+        self.prefetcher.prefetch(targets)
+
+    def build_aligner(
+        self,
+        ch_src: Chapter,
+        ch_dst: Chapter,
+        ch_id_pair_str: str,
+        force_align: bool = False,
+        on_stage: Callable[[str], None] | None = None,
+    ) -> Aligner:
+        """Build the aligner for a pair of chapters, with the current settings."""
+        engine_name, engine_kwargs = self.pick_engine(ch_src)
+        return Aligner(
+            ch_src,
+            ch_dst,
+            self.sent_which_align,
+            ch_id_pair_str,
+            self.lt_sent_tra,
+            self.sent_transformer,
+            self.align_cache_fol,
+            force_align,
+            engine_name=engine_name,
+            engine_kwargs=engine_kwargs,
+            length_prior_weight=length_prior_weight,
+            sim_method=sim_method,
+            auto_accept_th=auto_accept_th,
+            rerank_scorer=self.rerank_scorer,
+            on_stage=on_stage,
+        )
+
+    def pick_engine(self, ch_src: Chapter) -> tuple[str, dict]:
+        """Pick the align engine for a chapter, and its parameters."""
+        # very long chapters are aligned coarse-to-fine
+        sent_num_src = ch_src.sents_num[self.sent_which_align["src"]]
+        if align_engine_name != "paragraph" and sent_num_src > pyramid_min_sent_num:
+            return "pyramid", {"block_size": pyramid_block_size}
+        return align_engine_name, {}
+
+    def iter_chapter_pairs(self) -> Iterator[tuple[int, int, Chapter, Chapter]]:
+        """Iterate over the src chapters that have a dst chapter, with the delta."""
+        for ch_id_src, ch_src in self.epubs["src"].chapters.items():
+            ch_id_dst = ch_id_src + self.ch_delta_id
+            if ch_id_dst not in self.epubs["dst"].chapters:
+                continue
+            yield ch_id_src, ch_id_dst, ch_src, self.epubs["dst"].chapters[ch_id_dst]
+
+    def align_all(
+        self,
+        force_align: bool = False,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> None:
+        """Align all the chapter pairs in parallel, and cache the results.
+
+        The pairs that already have a cached alignment are skipped,
+        unless ``force_align`` is True.
+        ``progress`` is called with the number of pairs aligned and the total.
+        When a chapter is shown, the ``Aligner`` finds the caches and is instant.
+
+        In anchor mode the sentences are translated on demand in this process,
+        so the pairs are aligned one after the other.
+        """
+        if not self.has_both_epubs:
+            lg.warning("Load both epubs before aligning.")
+            return
+
+        # create a folder for temporary files
+        self.create_temp_fol()
+
+        jobs = []
+        for ch_id_src, ch_id_dst, ch_src, ch_dst in self.iter_chapter_pairs():
+            ch_id_pair_str = f"{ch_id_src}_{ch_id_dst}"
+            engine_name, engine_kwargs = self.pick_engine(ch_src)
+
+            # the length based guess does not count as an alignment
+            sim_path = similarity_cache_path(
+                self.align_cache_fol, engine_name, ch_id_pair_str
+            )
+            if sim_path.exists() and not force_align:
+                continue
+
+            if sim_method == "anchor":
+                self.aligners[ch_id_pair_str] = self.build_aligner(
+                    ch_src, ch_dst, ch_id_pair_str, force_align
+                )
+                continue
+
+            which_src = self.sent_which_align["src"]
+            which_dst = self.sent_which_align["dst"]
+            jobs.append(
+                PairJob(
+                    ch_id_pair_str,
+                    ChapterFeatures.from_chapter(ch_src, which_src),
+                    ChapterFeatures.from_chapter(ch_dst, which_dst),
+                    ch_src.sents_text["orig"],
+                    ch_dst.sents_text["orig"],
+                    engine_name,
+                    engine_kwargs,
+                )
+            )
+
+        settings = AlignSettings(
+            sent_model_name=sent_model_names[self.lt_sent_tra],
+            engine_name=align_engine_name,
+            sim_method=sim_method,
+            length_prior_weight=length_prior_weight,
+            rerank_scorer_name=rerank_scorer_name,
+            cross_encoder_model_name=cross_encoder_model_names.get(self.lt_sent_tra),
+        )
+        done_pairs = align_pairs_parallel(
+            jobs, settings, self.align_cache_fol, align_all_max_workers, progress
+        )
+
+        # the aligners built before are stale now
+        for ch_id_pair_str in done_pairs:
+            self.aligners.pop(ch_id_pair_str, None)
+
+    def align_length(self) -> None:
+        """Align all the chapter pairs using only the paragraph lengths.
+
+        Instant first guess, written only for the pairs without a cached alignment:
+        the book can be saved right away, and the real alignment will overwrite it.
+        """
+        if not self.has_both_epubs:
+            lg.warning("Load both epubs before aligning.")
+            return
+
+        # create a folder for temporary files
+        self.create_temp_fol()
+
+        for ch_id_src, ch_id_dst, ch_src, ch_dst in self.iter_chapter_pairs():
+            # do not overwrite the real alignment
+            align_info_name = f"info_align_{ch_id_src}_{ch_id_dst}.json"
+            align_info_path = self.align_cache_fol / align_info_name
+            if align_info_path.exists():
+                continue
+
+            align_info = {
+                "better_par_src_to_dst_flat": length_align_paragraphs(ch_src, ch_dst)
+            }
+            write_align_snapshot(align_info_path, align_info)
+
+    def memory_size(self) -> int:
+        """Estimate the bytes used by the books and the aligners.
+
+        The parsed books are estimated from their number of sentences,
+        the aligners include the bytes kept for them, see ``aligner_extra_size``.
+        """
+        size = 0
+        for ep in self.epubs.values():
+            for ch in ep.chapters.values():
+                size += ch.sents_num.get("orig", 0) * book_bytes_per_sent
+        for al in self.aligners.values():
+            size += self.aligner_memory_size(al)
+        for al in self.prefetcher.aligners.values():
+            size += self.aligner_memory_size(al)
+        return size
+
+    def aligner_memory_size(self, al: Aligner) -> int:
+        """Estimate the bytes freed by dropping an aligner."""
+        return al.memory_size() + self.aligner_extra_size(al)
+
+    def evict_aligners(self, bytes_to_free: int) -> int:
+        """Drop the least recently used aligners, keeping the current one.
+
+        The alignment state is written to the align cache first,
+        the aligner is rebuilt from there when the chapter is shown again.
+
+        Returns:
+            int: The bytes freed, an estimate.
+        """
+        # the prefetched aligners are only a guess, drop them first
+        freed = sum(
+            self.aligner_memory_size(al) for al in self.prefetcher.aligners.values()
+        )
+        self.prefetcher.clear()
+        for ch_id_pair_str in list(self.aligners):
+            if freed >= bytes_to_free:
+                break
+            if ch_id_pair_str == self.ch_id_pair_str:
+                continue
+            al = self.aligners.pop(ch_id_pair_str)
+            al.save_align_state()
+            freed += self.aligner_memory_size(al)
+            lg.debug(f"Evicted aligner {ch_id_pair_str}.")
+        return freed
+
+    def to_manifest(self) -> dict | None:
+        """Describe the state needed to restore the interleaver.
+
+        The books are referenced by path, and the alignments are in the align cache.
+
+        Returns:
+            dict | None: The manifest, None if a book was not loaded from a file.
+        """
+        if not self.has_both_epubs or len(self.book_files) < 2:
+            return None
+        return {
+            "lang_tags": self.sd_to_lt,
+            "book_files": self.book_files,
+            "ch_curr_id": self.ch_curr_id,
+            "ch_first_id": self.ch_first_id,
+            "ch_delta_id": self.ch_delta_id,
+        }
+
+    def restore_manifest(
+        self,
+        manifest: dict,
+        on_stage: Callable[[str], None] | None = None,
+        progress: Callable[[int, int], None] | None = None,
+    ) -> None:
+        """Load the books and chapter ids described by ``to_manifest``.
+
+        The aligners are not built here:
+        when a chapter is shown its aligner finds the similarity and
+        the journaled alignment in the align cache.
+
+        ``on_stage`` is called with the name of each stage,
+        ``progress`` with the chapters of the book loaded and the total.
+        """
+        for which_lang, lang_tag in manifest["lang_tags"].items():
+            self.set_lang_tag(lang_tag, which_lang)
+        if on_stage is not None:
+            on_stage("load_nlp")
+        self.load_nlp()
+        for which_ep, book_file in manifest["book_files"].items():
+            if on_stage is not None:
+                on_stage(f"load_{which_ep}")
+            self.add_book(
+                Path(book_file["path"]),
+                which_ep,
+                book_file["name"],
+                book_file["author"],
+                progress,
             )
+        self.ch_curr_id = manifest["ch_curr_id"]
+        self.ch_first_id = manifest["ch_first_id"]
+        self.ch_delta_id = manifest["ch_delta_id"]
+        self.update_chapter_id_info()
 
     def reset_chapter_ids(self) -> None:
         """Reset the chapter ids."""
@@ -284,7 +617,12 @@ class InterleaverInteractive:
         The user must not be a fool.
         """
 
-    def change_chapter_curr(self, direction: str) -> None:
+    def change_chapter_curr(
+        self,
+        direction: str,
+        on_stage: Callable[[str], None] | None = None,
+        align: bool = True,
+    ) -> None:
         """Go and fix the next chapter."""
         # update the ch_curr_id
         if direction == "back":
@@ -316,9 +654,16 @@ class InterleaverInteractive:
         # update the other chap ids
         self.update_chapter_id_info()
         # compute the alignment for this pair
-        self.align_auto()
+        # the caller can align later, e.g. in a background job
+        if align:
+            self.align_auto(on_stage=on_stage)
 
-    def change_chapter_delta(self, direction: str) -> None:
+    def change_chapter_delta(
+        self,
+        direction: str,
+        on_stage: Callable[[str], None] | None = None,
+        align: bool = True,
+    ) -> None:
         """Change the delta between chapters. Also set which is the first."""
         # update the ch_delta
         if direction == "back":
@@ -331,7 +676,9 @@ class InterleaverInteractive:
         # update the other chap ids
         self.update_chapter_id_info()
         # compute the alignment for this pair
-        self.align_auto()
+        # the caller can align later, e.g. in a background job
+        if align:
+            self.align_auto(on_stage=on_stage)
 
     def select_src_sent(self) -> None:
         """Select a new src sent to align."""
@@ -340,11 +687,31 @@ class InterleaverInteractive:
         """Pick which dst par is the right one for the currently selected src."""
         self.aligners[self.ch_id_pair_str].pick_dst_par(id_dst_correct)
 
+    def pick_dst_pars(self, fixes: list[tuple[int, int]]) -> None:
+        """Pick the right dst par for many src pars of the current chapter."""
+        self.aligners[self.ch_id_pair_str].pick_dst_pars(fixes)
+
+    def accept_window_guesses(self) -> None:
+        """Accept the current guesses of the pars shown around the fix."""
+        self.aligners[self.ch_id_pair_str].accept_window_guesses()
+
+    def undo_pick(self) -> bool:
+        """Undo the last pick in the current chapter."""
+        return self.aligners[self.ch_id_pair_str].undo_pick()
+
+    def redo_pick(self) -> bool:
+        """Redo the last undone pick in the current chapter."""
+        return self.aligners[self.ch_id_pair_str].redo_pick()
+
     def scroll_sent(self, which_sents, direction) -> None:
         """Scroll the right bunch of sentences in the right direction."""
 
-    def save_epub(self) -> None:
-        """Build the interleaved epub."""
+    def save_epub(self, epub_out: Path | IO[bytes] | None = None) -> None:
+        """Build the interleaved epub.
+
+        ``epub_out`` is a path or a binary buffer to write the epub to,
+        by default the epub is written in the output folder.
+        """
         # build the interleaved chaps
         # TODO this should be an attribute of the book
         ch_tot_num = len(self.epubs["src"].chapters)
@@ -360,8 +727,11 @@ class InterleaverInteractive:
         lang_alpha2_tag_src = self.sd_to_lt["src"]
         lang_alpha2_tag_dst = self.sd_to_lt["dst"]
 
-        for ch_build_id in range(ch_tot_num):
+        # the chapters composed by the last save
+        composed_cache = ComposedChapterCache(self.output_fol)
+        composed_num = 0
 
+        for ch_build_id in range(ch_tot_num):
             # the current chapters to align
             ch_id_src = self.ch_first_id + ch_build_id
             ch_src = self.epubs["src"].chapters[ch_id_src]
@@ -373,7 +743,7 @@ class InterleaverInteractive:
             align_info_name = f"info_align_{ch_id_pair_str}.json"
             par_matching_path = self.align_cache_fol / align_info_name
 
-            interleave_chap(
+            composed_num += interleave_chap(
                 ch_src=ch_src,
                 ch_dst=ch_dst,
                 ch_viz_id=ch_build_id + 1,
@@ -385,8 +755,12 @@ class InterleaverInteractive:
                 lt_pair_h=lt_pair_h,
                 lang_alpha2_tag_src=lang_alpha2_tag_src,
                 lang_alpha2_tag_dst=lang_alpha2_tag_dst,
+                composed_cache=composed_cache,
             )
 
+        composed_cache.save()
+        lg.info(f"Composed {composed_num} of {ch_tot_num} chapters.")
+
         # build the ep
         # MAYBE here we pass the src language tag
         eb = EpubBuilder(
@@ -398,4 +772,4 @@ class InterleaverInteractive:
             book_name_full=book_title,
             lang_alpha2_tag=lang_alpha2_tag_src,
         )
-        eb.do_build()
+        eb.do_build(epub_out)
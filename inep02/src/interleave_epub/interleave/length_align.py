@@ -0,0 +1,184 @@
+"""Align paragraphs or sentences using only their length, Gale-Church style.
+
+No neural model is needed: a long paragraph is usually translated
+into a long paragraph, so the character lengths alone give a decent
+first alignment, available instantly.
+
+The alignment is a sequence of beads,
+each bead pairs ``di`` src items with ``dj`` dst items.
+The cost of a bead is ``-log(P(bead)) - log(P(length delta | bead))``
+and the dynamic programming finds the cheapest sequence of beads.
+The rows of the dynamic programming table are computed with vector operations,
+the within-row dependency of the ``0-1`` beads becomes a running minimum.
+
+https://aclanthology.org/J93-1004.pdf
+"""
+
+import numpy as np
+
+from interleave_epub.epub.chapter import Chapter
+
+# bead type: prior probability
+BEAD_PRIORS = {
+    (1, 1): 0.89,
+    (1, 0): 0.0099 / 2,
+    (0, 1): 0.0099 / 2,
+    (2, 1): 0.089 / 2,
+    (1, 2): 0.089 / 2,
+    (2, 2): 0.011,
+}
+# the beads that consume at least one src item, the others are handled in-row
+BEADS_SRC = [bead for bead in BEAD_PRIORS if bead[0] > 0]
+BEAD_IDS = {bead: bead_id for bead_id, bead in enumerate(BEAD_PRIORS)}
+
+# variance of the length ratio, from the paper
+LEN_VARIANCE = 6.8
+
+
+def bead_cost(
+    len_src: np.ndarray,
+    len_dst: np.ndarray,
+    bead: tuple[int, int],
+    len_ratio: float,
+) -> np.ndarray:
+    """Compute the cost of a bead given the lengths of the src and dst chunks."""
+    from scipy.special import log_ndtr
+
+    len_mean = (len_src + len_dst / len_ratio) / 2
+    len_mean = np.maximum(len_mean, 1e-6)
+    z = (len_ratio * len_src - len_dst) / np.sqrt(len_mean * LEN_VARIANCE)
+    # log(2 * (1 - Phi(|z|)))
+    log_prob_delta = np.log(2) + log_ndtr(-np.abs(z))
+    return -np.log(BEAD_PRIORS[bead]) - log_prob_delta
+
+
+def gale_church_align(
+    lens_src: list[int] | np.ndarray,
+    lens_dst: list[int] | np.ndarray,
+) -> list[tuple[int, int, int, int]]:
+    """Align two sequences of items using their lengths.
+
+    Returns:
+        list[tuple[int, int, int, int]]: The beads as ``(i, di, j, dj)``:
+            src items ``i:i+di`` are paired with dst items ``j:j+dj``.
+    """
+    lens_src = np.asarray(lens_src, dtype=np.float64)
+    lens_dst = np.asarray(lens_dst, dtype=np.float64)
+    num_src = len(lens_src)
+    num_dst = len(lens_dst)
+
+    # expected number of dst chars for each src char
+    len_ratio = max(lens_dst.sum(), 1) / max(lens_src.sum(), 1)
+
+    # prefix sums to get the length of any chunk
+    cum_src = np.concatenate([[0], np.cumsum(lens_src)])
+    cum_dst = np.concatenate([[0], np.cumsum(lens_dst)])
+
+    # the cost of the 0-1 beads in a row does not depend on the row
+    cost_01 = np.zeros(num_dst + 1)
+    cost_01[1:] = bead_cost(np.zeros(num_dst), lens_dst, (0, 1), len_ratio)
+    cum_cost_01 = np.cumsum(cost_01)
+
+    # only the last two rows of costs are needed, but all the back pointers
+    cost_rows = [np.full(num_dst + 1, np.inf) for _ in range(3)]
+    back = np.full((num_src + 1, num_dst + 1), -1, dtype=np.int8)
+    bead_list = list(BEAD_PRIORS)
+
+    for i in range(num_src + 1):
+        row_best = np.full(num_dst + 1, np.inf)
+        row_back = np.full(num_dst + 1, -1, dtype=np.int8)
+        if i == 0:
+            row_best[0] = 0
+
+        # beads that come from a previous row
+        for di, dj in BEADS_SRC:
+            if i < di:
+                continue
+            prev_row = cost_rows[(i - di) % 3]
+            len_src_chunk = cum_src[i] - cum_src[i - di]
+            len_dst_chunk = cum_dst[dj:] - cum_dst[: num_dst + 1 - dj]
+            cand = prev_row[: num_dst + 1 - dj] + bead_cost(
+                len_src_chunk, len_dst_chunk, (di, dj), len_ratio
+            )
+            is_better = cand < row_best[dj:]
+            row_best[dj:] = np.where(is_better, cand, row_best[dj:])
+            row_back[dj:] = np.where(is_better, BEAD_IDS[(di, dj)], row_back[dj:])
+
+        # 0-1 beads chain inside the row:
+        # best[j] = min_k<j (from_prev[k] + sum(cost_01[k+1:j+1]))
+        run_min = np.minimum.accumulate(row_best - cum_cost_01)
+        chained = np.concatenate([[np.inf], run_min[:-1]]) + cum_cost_01
+        is_chained = chained < row_best
+        row_best = np.where(is_chained, chained, row_best)
+        row_back = np.where(is_chained, BEAD_IDS[(0, 1)], row_back)
+
+        cost_rows[i % 3] = row_best
+        back[i] = row_back
+
+    # follow the back pointers from the end
+    beads = []
+    i, j = num_src, num_dst
+    while i > 0 or j > 0:
+        di, dj = bead_list[back[i, j]]
+        beads.append((i - di, di, j - dj, dj))
+        i, j = i - di, j - dj
+    beads.reverse()
+    return beads
+
+
+def beads_to_src_to_dst_flat(
+    beads: list[tuple[int, int, int, int]],
+    num_src: int,
+    num_dst: int,
+) -> dict[int, int]:
+    """Convert the beads in a flat src to dst mapping.
+
+    Each src item is mapped to the first dst item of its bead.
+    The src items without a dst item are mapped to the next dst item,
+    so that the mapping stays monotone,
+    or to the last one if they are at the end.
+    Without dst items everything is mapped to -1.
+    """
+    src_to_dst_flat = {}
+    for i, di, j, _dj in beads:
+        for src_id in range(i, i + di):
+            src_to_dst_flat[src_id] = min(j, num_dst - 1)
+    return {src_id: src_to_dst_flat[src_id] for src_id in range(num_src)}
+
+
+def length_align_paragraphs(ch_src: Chapter, ch_dst: Chapter) -> dict[int, int]:
+    """Align the paragraphs of two chapters using their character length.
+
+    Returns the same structure as ``Aligner.better_par_src_to_dst_flat``.
+    """
+    beads = gale_church_align(ch_src.pars_len, ch_dst.pars_len)
+    return beads_to_src_to_dst_flat(beads, len(ch_src.pars_len), len(ch_dst.pars_len))
+
+
+def length_align_sentences(
+    lens_src: list[int] | np.ndarray,
+    lens_dst: list[int] | np.ndarray,
+) -> np.ndarray:
+    """Align the sentences using their length, return the dst id for each src id."""
+    beads = gale_church_align(lens_src, lens_dst)
+    src_to_dst_flat = beads_to_src_to_dst_flat(beads, len(lens_src), len(lens_dst))
+    return np.array(list(src_to_dst_flat.values()))
+
+
+def length_prior(
+    lens_src: list[int] | np.ndarray,
+    lens_dst: list[int] | np.ndarray,
+    sigma: float = 5.0,
+) -> np.ndarray:
+    """Build a prior on the sentence similarity from the length alignment.
+
+    The prior is a gaussian of width ``sigma`` sentences
+    centered on the dst sentence matched by length to each src sentence.
+
+    Returns:
+        np.ndarray: The prior, with shape ``(len(lens_src), len(lens_dst))``.
+    """
+    ids_dst_len = length_align_sentences(lens_src, lens_dst)
+    ids_dst = np.arange(len(lens_dst))
+    dist = ids_dst[None, :] - ids_dst_len[:, None]
+    return np.exp(-0.5 * (dist / sigma) ** 2)
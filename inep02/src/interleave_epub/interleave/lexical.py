@@ -0,0 +1,138 @@
+"""Lexical similarity between sentences, without translation models.
+
+Translations share a lot of cheap signal:
+numbers, proper nouns, punctuation like quotes and question marks,
+and for close languages many cognates that share character n-grams.
+
+Each sentence is hashed in a sparse vector of these features,
+and the similarity is computed with sparse matrix products,
+only in a band around the diagonal.
+"""
+
+import re
+from typing import TYPE_CHECKING
+import unicodedata
+from zlib import crc32
+
+import numpy as np
+
+if TYPE_CHECKING:
+    from scipy.sparse import csr_matrix
+
+# size of the hashed feature space
+LEX_NUM_FEATURES = 2**18
+# length of the character n-grams
+LEX_NGRAM_LEN = 3
+# weight of the anchor tokens relative to a single n-gram
+LEX_ANCHOR_WEIGHT = 4.0
+
+RE_NUMBER = re.compile(r"\d+")
+RE_WORD = re.compile(r"\w+")
+# punctuation that usually survives translation
+LEX_PUNCT = '?!"«»“”—…:;()'
+
+
+def strip_accents(text: str) -> str:
+    """Remove the accents, so that cognates like ``café`` and ``cafe`` match."""
+    text_nfkd = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in text_nfkd if not unicodedata.combining(c))
+
+
+def lexical_features(text: str) -> tuple[list[str], list[str]]:
+    """Extract the n-gram and anchor features of a sentence.
+
+    Returns:
+        tuple[list[str], list[str]]: The character n-grams and the anchor tokens.
+    """
+    text_clean = strip_accents(text)
+
+    # character n-grams of the lowercase words, padded with spaces
+    ngrams = []
+    for word in RE_WORD.findall(text_clean.lower()):
+        word_pad = f" {word} "
+        for i in range(len(word_pad) - LEX_NGRAM_LEN + 1):
+            ngrams.append(word_pad[i : i + LEX_NGRAM_LEN])
+
+    # numbers are the same in every language
+    anchors = [f"num:{n}" for n in RE_NUMBER.findall(text_clean)]
+    # capitalized words not at the start of the sentence are likely names
+    words = RE_WORD.findall(text_clean)
+    anchors += [f"cap:{w[:5].lower()}" for w in words[1:] if w[0].isupper()]
+    # punctuation, all quotes look the same
+    for c in text_clean:
+        if c in LEX_PUNCT:
+            anchors.append(f"pun:{c if c in '?!:;()' else 'quote'}")
+
+    return ngrams, anchors
+
+
+def hash_feature(feature: str) -> int:
+    """Hash a feature in the feature space, stable across runs."""
+    return crc32(feature.encode("utf-8")) % LEX_NUM_FEATURES
+
+
+def lexical_encode(sents_text: list[str]) -> "csr_matrix":
+    """Encode the sentences as sparse l2 normalized vectors of hashed features."""
+    from scipy.sparse import csr_matrix
+
+    indices: list[int] = []
+    data: list[float] = []
+    indptr = [0]
+    for text in sents_text:
+        ngrams, anchors = lexical_features(text)
+        indices.extend(hash_feature(f) for f in ngrams)
+        data.extend([1.0] * len(ngrams))
+        indices.extend(hash_feature(f) for f in anchors)
+        data.extend([LEX_ANCHOR_WEIGHT] * len(anchors))
+        indptr.append(len(indices))
+
+    enc = csr_matrix(
+        (np.array(data), np.array(indices, dtype=np.int64), np.array(indptr)),
+        shape=(len(sents_text), LEX_NUM_FEATURES),
+    )
+    # repeated features are summed
+    enc.sum_duplicates()
+
+    # normalize the rows, so that the product is the cosine similarity
+    norms = np.sqrt(np.asarray(enc.multiply(enc).sum(axis=1)).ravel())
+    norms[norms == 0] = 1
+    enc = csr_matrix(enc.multiply(1 / norms[:, None]))
+    return enc
+
+
+def lexical_similarity(
+    enc_src: "csr_matrix",
+    enc_dst: "csr_matrix",
+    band_half_width: int = 40,
+    chunk_size: int = 256,
+) -> np.ndarray:
+    """Compute the similarity in a band around the rescaled diagonal.
+
+    The src sentences are processed in chunks,
+    each chunk is multiplied only with the dst sentences in its band.
+    The result is dense, the values outside of the band are left to zero.
+    """
+    sent_num_src = enc_src.shape[0]
+    sent_num_dst = enc_dst.shape[0]
+    ratio = sent_num_src / sent_num_dst
+    sim = np.zeros((sent_num_src, sent_num_dst), dtype=np.float32)
+
+    ids_dst = np.arange(sent_num_dst)
+    for chunk_start in range(0, sent_num_src, chunk_size):
+        chunk_end = min(chunk_start + chunk_size, sent_num_src)
+        ids_src = np.arange(chunk_start, chunk_end)
+
+        # the band of each src sentence, centered on the rescaled diagonal
+        centers = (ids_src / ratio).astype(np.int64)
+        band_lo = np.clip(centers - band_half_width, 0, sent_num_dst)
+        band_hi = np.clip(centers + band_half_width + 1, 0, sent_num_dst)
+        lo, hi = band_lo.min(), band_hi.max()
+
+        sim_chunk = (enc_src[chunk_start:chunk_end] @ enc_dst[lo:hi].T).toarray()
+        # mask the values outside of the band of each sentence
+        in_band = (ids_dst[None, lo:hi] >= band_lo[:, None]) & (
+            ids_dst[None, lo:hi] < band_hi[:, None]
+        )
+        sim[chunk_start:chunk_end, lo:hi] = np.where(in_band, sim_chunk, 0)
+
+    return sim
@@ -0,0 +1,75 @@
+"""Align the paragraphs directly, without going through the sentences.
+
+The paragraphs are encoded as a whole, and the paragraph similarity matrix
+is an order of magnitude smaller than the sentence one.
+The monotone path on it is the paragraph matching,
+the sentences are used only for the paragraphs where the path is unsure.
+"""
+
+from collections import Counter
+
+import numpy as np
+
+from interleave_epub.epub.chapter import Chapter
+from interleave_epub.interleave.pyramid import BandSimilarity, gather_similarity
+
+
+def paragraph_texts(ch: Chapter, which_sent: str) -> list[str]:
+    """Join the sentences of each paragraph of a chapter."""
+    pars_sents: list[list[str]] = [[] for _ in ch.paragraphs]
+    for cs_id, sent_text in enumerate(ch.sents_text[which_sent]):
+        par_id = ch.cs_to_ps[cs_id][0]
+        pars_sents[par_id].append(sent_text)
+    return [" ".join(par_sents) for par_sents in pars_sents]
+
+
+def match_margins(
+    sim: np.ndarray | BandSimilarity,
+    ids_src: np.ndarray,
+    ids_dst: np.ndarray,
+    win_len: int = 2,
+) -> np.ndarray:
+    """Compute how much each match beats its neighbours.
+
+    The margin is the similarity of the matched dst
+    minus the best similarity of the other dst in a window of ``win_len``.
+    """
+    ids_src = np.asarray(ids_src, dtype=np.int64)
+    ids_dst = np.asarray(ids_dst, dtype=np.int64)
+    # the other dst in the window of each match, masked if outside of the matrix
+    offsets = np.delete(np.arange(-win_len, win_len + 1), win_len)
+    ids_other = ids_dst[:, None] + offsets[None, :]
+    is_valid = (ids_other >= 0) & (ids_other < sim.shape[1])
+    sim_other = gather_similarity(
+        sim, ids_src[:, None], np.clip(ids_other, 0, sim.shape[1] - 1)
+    )
+    sim_other = np.where(is_valid, sim_other, -np.inf)
+    best_other = sim_other.max(axis=1, initial=-np.inf)
+    best_other[np.isinf(best_other)] = 0
+    return gather_similarity(sim, ids_src, ids_dst) - best_other
+
+
+def path_margins(sim: np.ndarray, path: np.ndarray, win_len: int = 2) -> np.ndarray:
+    """Compute the margins of a path that matches every src item."""
+    return match_margins(sim, np.arange(len(path)), path, win_len)
+
+
+def vote_dst_par(
+    sim_sents: np.ndarray,
+    cs_dst_ids: list[int],
+    sents_par_id_dst: list[int],
+) -> tuple[int, float]:
+    """Let each src sentence vote for the dst paragraph of its best dst sentence.
+
+    Returns the voted dst paragraph and the fraction of sentences that voted for it.
+
+    Args:
+        sim_sents (np.ndarray): Similarity of the src sentences of a paragraph
+            with the candidate dst sentences.
+        cs_dst_ids (list[int]): The chapter ids of the candidate dst sentences.
+        sents_par_id_dst (list[int]): The paragraph id of each dst sentence.
+    """
+    ids_best = sim_sents.argmax(axis=1)
+    par_dst_ids = [sents_par_id_dst[cs_dst_ids[i]] for i in ids_best]
+    par_dst_id, par_dst_count = Counter(par_dst_ids).most_common()[0]
+    return par_dst_id, par_dst_count / len(par_dst_ids)
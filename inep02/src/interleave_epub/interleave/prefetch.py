@@ -0,0 +1,125 @@
+"""Compute the next aligners in the background, while the user reviews one.
+
+A single worker thread builds the aligners of the chapter pairs
+the user will probably look at next.
+The thread shares the models already loaded in this process.
+
+The prefetcher is bounded: at most ``max_aligners`` finished aligners are kept,
+the oldest are dropped first.
+When the targets change, the jobs not started yet are cancelled,
+and a job already running stops at the next stage of the alignment.
+"""
+
+from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from threading import RLock
+from typing import Callable
+
+from loguru import logger as lg
+
+from interleave_epub.interleave.align import Aligner
+
+
+class PrefetchDropped(Exception):
+    """The pair being prefetched is not a target anymore."""
+
+
+class AlignerPrefetcher:
+    """Build aligners speculatively on a background thread."""
+
+    def __init__(self, max_aligners: int = 2) -> None:
+        """Initialize the prefetcher."""
+        self.max_aligners = max_aligners
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="prefetch")
+        # pair str: future of the aligner being built
+        self.futures: dict[str, Future] = {}
+        # pair str: aligner, oldest first
+        self.aligners: OrderedDict[str, Aligner] = OrderedDict()
+        # reentrant: a callback runs in the submitting thread if the job is done already
+        self.lock = RLock()
+
+    def prefetch(self, targets: dict[str, Callable[..., Aligner]]) -> None:
+        """Build the aligners of the target pairs, dropping the old targets.
+
+        Args:
+            targets (dict[str, Callable[..., Aligner]]): For each chapter pair,
+                in order of priority, the function that builds its aligner,
+                accepting an ``on_stage`` keyword argument.
+        """
+        with self.lock:
+            # cancel the jobs that are not wanted anymore
+            for ch_id_pair_str in list(self.futures):
+                if ch_id_pair_str not in targets:
+                    if self.futures[ch_id_pair_str].cancel():
+                        lg.debug(f"Prefetch of {ch_id_pair_str} cancelled.")
+                    self.futures.pop(ch_id_pair_str)
+
+            for ch_id_pair_str, build_aligner in targets.items():
+                if ch_id_pair_str in self.futures or ch_id_pair_str in self.aligners:
+                    continue
+                lg.debug(f"Prefetching {ch_id_pair_str}.")
+                on_stage = partial(self.check_wanted, ch_id_pair_str)
+                future = self.executor.submit(build_aligner, on_stage=on_stage)
+                self.futures[ch_id_pair_str] = future
+                future.add_done_callback(partial(self.store, ch_id_pair_str))
+
+    def check_wanted(self, ch_id_pair_str: str, stage: str) -> None:
+        """Stop building an aligner at a stage boundary if the pair was dropped."""
+        with self.lock:
+            if ch_id_pair_str not in self.futures:
+                raise PrefetchDropped(f"Prefetch of {ch_id_pair_str} dropped.")
+
+    def store(self, ch_id_pair_str: str, future: Future) -> None:
+        """Keep a finished aligner, evicting the oldest ones."""
+        if future.cancelled() or isinstance(future.exception(), PrefetchDropped):
+            lg.debug(f"Prefetch of {ch_id_pair_str} stopped.")
+            return
+        if future.exception() is not None:
+            lg.warning(f"Prefetch of {ch_id_pair_str} failed: {future.exception()!r}")
+            with self.lock:
+                self.futures.pop(ch_id_pair_str, None)
+            return
+        with self.lock:
+            # the target was dropped while the aligner was being built
+            if self.futures.pop(ch_id_pair_str, None) is None:
+                return
+            self.aligners[ch_id_pair_str] = future.result()
+            while len(self.aligners) > self.max_aligners:
+                ch_id_pair_str_old, _ = self.aligners.popitem(last=False)
+                lg.debug(f"Prefetched {ch_id_pair_str_old} evicted.")
+        lg.debug(f"Prefetched {ch_id_pair_str}.")
+
+    def pop(self, ch_id_pair_str: str) -> Aligner | None:
+        """Get the prefetched aligner of a pair, if there is one.
+
+        If the aligner is being built, wait for it: it is already on its way.
+        If the job did not start yet, it is cancelled and None is returned,
+        so that the caller builds the aligner right away.
+        """
+        with self.lock:
+            if ch_id_pair_str in self.aligners:
+                return self.aligners.pop(ch_id_pair_str)
+            future = self.futures.get(ch_id_pair_str)
+            if future is None or future.cancel():
+                self.futures.pop(ch_id_pair_str, None)
+                return None
+
+        # the job is running, wait outside of the lock
+        lg.debug(f"Waiting for the prefetch of {ch_id_pair_str}.")
+        try:
+            aligner = future.result()
+        except Exception:
+            return None
+        with self.lock:
+            self.aligners.pop(ch_id_pair_str, None)
+            self.futures.pop(ch_id_pair_str, None)
+        return aligner
+
+    def clear(self) -> None:
+        """Cancel the pending jobs, stop the running one, drop the aligners."""
+        with self.lock:
+            for future in self.futures.values():
+                future.cancel()
+            self.futures.clear()
+            self.aligners.clear()
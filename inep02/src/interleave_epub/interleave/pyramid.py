@@ -0,0 +1,350 @@
+"""Coarse-to-fine alignment for very long chapters.
+
+The sentence embeddings are pooled in blocks of consecutive sentences,
+the much smaller block similarity matrix is used to find a coarse monotone path,
+and the sentence similarity is then computed only inside a corridor around that path.
+
+The corridor follows the drift between the two books,
+so it can stay narrow even when the drift is large.
+Only the similarity inside the corridor is stored, with the coarse path,
+so no step of the pyramid alignment touches the full matrix.
+"""
+
+from dataclasses import dataclass
+
+import numpy as np
+
+
+def normalize_rows(enc: np.ndarray) -> np.ndarray:
+    """Normalize the rows of a matrix to unit norm, so that dot is cosine."""
+    norms = np.linalg.norm(enc, axis=1, keepdims=True)
+    norms[norms == 0] = 1
+    return enc / norms
+
+
+def pool_blocks(enc: np.ndarray, block_size: int) -> np.ndarray:
+    """Mean pool the rows of ``enc`` in blocks of ``block_size`` consecutive rows.
+
+    The last block can be shorter. The pooled rows are normalized.
+    """
+    block_starts = np.arange(0, enc.shape[0], block_size)
+    block_sums = np.add.reduceat(enc, block_starts, axis=0)
+    return normalize_rows(block_sums)
+
+
+def pool_sim_blocks(sim: np.ndarray, block_size: int) -> np.ndarray:
+    """Mean pool a similarity matrix in square blocks.
+
+    Used to find the coarse path when only the cached similarity is available.
+    """
+    starts_src = np.arange(0, sim.shape[0], block_size)
+    starts_dst = np.arange(0, sim.shape[1], block_size)
+    block_sums = np.add.reduceat(
+        np.add.reduceat(sim, starts_src, axis=0), starts_dst, axis=1
+    )
+    count_src = np.diff(np.append(starts_src, sim.shape[0]))
+    count_dst = np.diff(np.append(starts_dst, sim.shape[1]))
+    return block_sums / np.outer(count_src, count_dst)
+
+
+def coarse_block_path(sim_blocks: np.ndarray) -> np.ndarray:
+    """Find the monotone block path with the highest total similarity.
+
+    Each src block is matched to a dst block, and the dst blocks never go back:
+    ``score[i, j] = sim[i, j] + max(score[i-1, :j+1])``.
+
+    Returns:
+        np.ndarray: The dst block id for each src block.
+    """
+    num_blocks_src, num_blocks_dst = sim_blocks.shape
+    score = np.empty_like(sim_blocks, dtype=np.float64)
+    # the best previous dst block for each (src block, dst block)
+    back = np.zeros(sim_blocks.shape, dtype=np.int64)
+
+    score[0] = sim_blocks[0]
+    col_ids = np.arange(num_blocks_dst)
+    for i in range(1, num_blocks_src):
+        prev = score[i - 1]
+        # running max of the previous row and where it was found
+        run_max = np.maximum.accumulate(prev)
+        is_new_max = prev >= run_max
+        run_arg = np.maximum.accumulate(np.where(is_new_max, col_ids, 0))
+        score[i] = sim_blocks[i] + run_max
+        back[i] = run_arg
+
+    # backtrack from the best final dst block
+    path = np.empty(num_blocks_src, dtype=np.int64)
+    path[-1] = score[-1].argmax()
+    for i in range(num_blocks_src - 1, 0, -1):
+        path[i - 1] = back[i, path[i]]
+    return path
+
+
+def path_corridor(
+    path: np.ndarray,
+    block_size: int,
+    sent_num_dst: int,
+    corridor_blocks: int = 1,
+) -> tuple[np.ndarray, np.ndarray]:
+    """Build the dst sentence corridor ``[lo, hi)`` for each src block.
+
+    The corridor of a src block spans the dst blocks matched
+    to it and to its neighbours, widened by ``corridor_blocks`` on each side,
+    so that a jump in the coarse path is still covered.
+    """
+    path_prev = np.concatenate([path[:1], path[:-1]])
+    path_next = np.concatenate([path[1:], path[-1:]])
+    block_lo = np.minimum(np.minimum(path_prev, path), path_next) - corridor_blocks
+    block_hi = np.maximum(np.maximum(path_prev, path), path_next) + corridor_blocks + 1
+    band_lo = np.clip(block_lo * block_size, 0, sent_num_dst)
+    band_hi = np.clip(block_hi * block_size, 0, sent_num_dst)
+    return band_lo, band_hi
+
+
+def path_centers(
+    path: np.ndarray,
+    block_size: int,
+    sent_num_src: int,
+    sent_num_dst: int,
+) -> np.ndarray:
+    """Interpolate the coarse path to get a dst center for every src sentence."""
+    src_block_centers = np.arange(len(path)) * block_size + (block_size - 1) / 2
+    dst_block_centers = path * block_size + (block_size - 1) / 2
+    centers = np.interp(np.arange(sent_num_src), src_block_centers, dst_block_centers)
+    return np.clip(centers, 0, sent_num_dst - 1)
+
+
+@dataclass
+class BandSimilarity:
+    """A sentence similarity computed only inside the corridor of a coarse path.
+
+    The src sentences are grouped in blocks of ``block_size``,
+    block ``b`` is compared with the dst sentences ``band_lo[b]:band_hi[b]``,
+    and its ``(rows, band_hi[b] - band_lo[b])`` values are stored flat
+    in ``values``, starting at ``offsets[b]``.
+    The similarity outside of the corridor is zero.
+
+    A row of the similarity can be indexed like in a dense matrix,
+    ``sim[id_src, cols]``, with ``cols`` an int, a slice or an array of ids.
+    """
+
+    values: np.ndarray
+    offsets: np.ndarray
+    band_lo: np.ndarray
+    band_hi: np.ndarray
+    # the dst block of each src block, the corridor was built around it
+    block_path: np.ndarray
+    block_size: int
+    shape: tuple[int, int]
+
+    @property
+    def nbytes(self) -> int:
+        """The bytes used by the arrays."""
+        return sum(
+            arr.nbytes
+            for arr in (
+                self.values,
+                self.offsets,
+                self.band_lo,
+                self.band_hi,
+                self.block_path,
+            )
+        )
+
+    def block_rows(self, block_id: int) -> slice:
+        """The src sentences of a block."""
+        return slice(
+            block_id * self.block_size,
+            min((block_id + 1) * self.block_size, self.shape[0]),
+        )
+
+    def block(self, block_id: int) -> np.ndarray:
+        """The similarity of a block inside its band, as a view."""
+        rows = self.block_rows(block_id)
+        width = int(self.band_hi[block_id] - self.band_lo[block_id])
+        start = int(self.offsets[block_id])
+        end = int(self.offsets[block_id + 1])
+        return self.values[start:end].reshape(rows.stop - rows.start, width)
+
+    def row_band(self, id_src: int) -> tuple[int, np.ndarray]:
+        """The first dst id of the band of a row, and the row inside the band."""
+        block_id = id_src // self.block_size
+        return (
+            int(self.band_lo[block_id]),
+            self.block(block_id)[id_src - block_id * self.block_size],
+        )
+
+    def col_ids(self, cols: int | slice | np.ndarray) -> np.ndarray:
+        """Convert the column index of a row to an array of dst ids."""
+        if isinstance(cols, slice):
+            return np.arange(*cols.indices(self.shape[1]))
+        return np.atleast_1d(np.asarray(cols, dtype=np.int64))
+
+    def __getitem__(self, key: tuple[int, int | slice | np.ndarray]):
+        """Get some values of a row, the ones outside of the band are zero."""
+        id_src, cols = key
+        lo, row = self.row_band(id_src)
+        ids_dst = self.col_ids(cols)
+        row_values = np.zeros(len(ids_dst), dtype=self.values.dtype)
+        in_band = (ids_dst >= lo) & (ids_dst < lo + len(row))
+        row_values[in_band] = row[ids_dst[in_band] - lo]
+        if isinstance(cols, (int, np.integer)):
+            return row_values[0]
+        return row_values
+
+    def __setitem__(
+        self, key: tuple[int, int | slice | np.ndarray], new_values
+    ) -> None:
+        """Set some values of a row, the ones outside of the band are dropped."""
+        id_src, cols = key
+        lo, row = self.row_band(id_src)
+        ids_dst = self.col_ids(cols)
+        new_values = np.broadcast_to(new_values, ids_dst.shape)
+        in_band = (ids_dst >= lo) & (ids_dst < lo + len(row))
+        row[ids_dst[in_band] - lo] = new_values[in_band]
+
+    def gather(self, ids_src: np.ndarray, ids_dst: np.ndarray) -> np.ndarray:
+        """Get the similarity of many ``(src, dst)`` pairs, zero outside of the band."""
+        ids_src, ids_dst = np.broadcast_arrays(ids_src, ids_dst)
+        block_ids = ids_src // self.block_size
+        lo = self.band_lo[block_ids]
+        width = self.band_hi[block_ids] - lo
+        in_band = (ids_dst >= lo) & (ids_dst < lo + width)
+        flat_ids = (
+            self.offsets[block_ids]
+            + (ids_src - block_ids * self.block_size) * width
+            + (ids_dst - lo)
+        )
+        return np.where(in_band, self.values[np.where(in_band, flat_ids, 0)], 0)
+
+    def copy(self) -> "BandSimilarity":
+        """Copy the values, the corridor is shared."""
+        return BandSimilarity(
+            self.values.copy(),
+            self.offsets,
+            self.band_lo,
+            self.band_hi,
+            self.block_path,
+            self.block_size,
+            self.shape,
+        )
+
+    def blend(self, other: np.ndarray, weight: float) -> "BandSimilarity":
+        """Mix a dense matrix in the band, with weight ``weight``."""
+        values = np.empty_like(self.values)
+        for block_id, (lo, hi) in enumerate(zip(self.band_lo, self.band_hi)):
+            rows = self.block_rows(block_id)
+            block_mixed = (1 - weight) * self.block(block_id) + weight * other[
+                rows, lo:hi
+            ]
+            values[
+                self.offsets[block_id] : self.offsets[block_id + 1]
+            ] = block_mixed.ravel()
+        return BandSimilarity(
+            values,
+            self.offsets,
+            self.band_lo,
+            self.band_hi,
+            self.block_path,
+            self.block_size,
+            self.shape,
+        )
+
+    def toarray(self) -> np.ndarray:
+        """Build the dense similarity, only to look at it."""
+        sim = np.zeros(self.shape, dtype=self.values.dtype)
+        for block_id, (lo, hi) in enumerate(zip(self.band_lo, self.band_hi)):
+            sim[self.block_rows(block_id), lo:hi] = self.block(block_id)
+        return sim
+
+    def to_arrays(self) -> dict[str, np.ndarray]:
+        """Pack the similarity in arrays, to save it with ``np.savez``."""
+        return {
+            "values": self.values,
+            "offsets": self.offsets,
+            "band_lo": self.band_lo,
+            "band_hi": self.band_hi,
+            "block_path": self.block_path,
+            "block_size": np.array(self.block_size),
+            "shape": np.array(self.shape),
+        }
+
+    @classmethod
+    def from_arrays(cls, arrays) -> "BandSimilarity":
+        """Unpack the arrays written by ``to_arrays``."""
+        sent_num_src, sent_num_dst = arrays["shape"].tolist()
+        return cls(
+            arrays["values"],
+            arrays["offsets"],
+            arrays["band_lo"],
+            arrays["band_hi"],
+            arrays["block_path"],
+            int(arrays["block_size"]),
+            (sent_num_src, sent_num_dst),
+        )
+
+
+def dense_similarity(sim: np.ndarray | BandSimilarity) -> np.ndarray:
+    """Get a similarity as a dense matrix, to plot it."""
+    if isinstance(sim, BandSimilarity):
+        return sim.toarray()
+    return sim
+
+
+def gather_similarity(
+    sim: np.ndarray | BandSimilarity, ids_src: np.ndarray, ids_dst: np.ndarray
+) -> np.ndarray:
+    """Get the similarity of many ``(src, dst)`` pairs, dense or in a band."""
+    if isinstance(sim, BandSimilarity):
+        return sim.gather(ids_src, ids_dst)
+    return sim[ids_src, ids_dst]
+
+
+def corridor_similarity(
+    enc_src: np.ndarray,
+    enc_dst: np.ndarray,
+    block_path: np.ndarray,
+    band_lo: np.ndarray,
+    band_hi: np.ndarray,
+    block_size: int,
+) -> BandSimilarity:
+    """Compute the cosine similarity only inside the corridor."""
+    enc_src = normalize_rows(enc_src)
+    enc_dst = normalize_rows(enc_dst)
+    sent_num_src = enc_src.shape[0]
+    rows_num = np.diff(np.append(np.arange(0, sent_num_src, block_size), sent_num_src))
+    offsets = np.concatenate([[0], np.cumsum(rows_num * (band_hi - band_lo))])
+    sim = BandSimilarity(
+        np.empty(offsets[-1], dtype=np.float32),
+        offsets,
+        band_lo,
+        band_hi,
+        block_path,
+        block_size,
+        (sent_num_src, enc_dst.shape[0]),
+    )
+    for block_id, (lo, hi) in enumerate(zip(band_lo, band_hi)):
+        sim.block(block_id)[:] = enc_src[sim.block_rows(block_id)] @ enc_dst[lo:hi].T
+    return sim
+
+
+def pyramid_similarity(
+    enc_src: np.ndarray,
+    enc_dst: np.ndarray,
+    block_size: int,
+    corridor_blocks: int = 1,
+) -> BandSimilarity:
+    """Compute the sentence similarity only near the coarse path of the blocks."""
+    # align the pooled blocks to find the corridor
+    sim_blocks = (
+        normalize_rows(pool_blocks(enc_src, block_size))
+        @ normalize_rows(pool_blocks(enc_dst, block_size)).T
+    )
+    block_path = coarse_block_path(sim_blocks)
+    band_lo, band_hi = path_corridor(
+        block_path, block_size, enc_dst.shape[0], corridor_blocks
+    )
+    # compute the similarity inside the corridor
+    return corridor_similarity(
+        enc_src, enc_dst, block_path, band_lo, band_hi, block_size
+    )
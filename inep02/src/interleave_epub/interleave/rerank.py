@@ -0,0 +1,111 @@
+"""Rerank the candidates of the ambiguous sentences with a more expensive scorer.
+
+The cosine similarity of the sentence embeddings is cheap, but for short lines
+(dialogue, interjections) the best and second best candidates are often close.
+Only for those rows the top candidates are scored again,
+with a token overlap model or a cross encoder, and the scores are mixed in.
+"""
+
+import re
+from typing import Callable
+
+import numpy as np
+
+from interleave_epub.interleave.pyramid import BandSimilarity
+
+# score a src sentence against a list of dst candidates
+RerankScorer = Callable[[str, list[str]], np.ndarray]
+
+RE_TOKEN = re.compile(r"\w+")
+
+
+def token_overlap_scorer(text_src: str, texts_dst: list[str]) -> np.ndarray:
+    """Score the candidates with the Dice coefficient of the lowercase tokens.
+
+    Works when the src sentence is translated in the language of the dst ones.
+    """
+    tokens_src = set(RE_TOKEN.findall(text_src.lower()))
+    scores = np.zeros(len(texts_dst))
+    for i, text_dst in enumerate(texts_dst):
+        tokens_dst = set(RE_TOKEN.findall(text_dst.lower()))
+        num_tokens = len(tokens_src) + len(tokens_dst)
+        if num_tokens > 0:
+            scores[i] = 2 * len(tokens_src & tokens_dst) / num_tokens
+    return scores
+
+
+def cross_encoder_scorer(model_name: str) -> RerankScorer:
+    """Build a scorer that uses a cross encoder from sentence_transformers.
+
+    The scores are mixed with cosine similarities, so they are put on the same range:
+    the raw output of the stsb cross encoder is squashed in ``[0, 1]``,
+    the scale of the stsb labels, and stretched on ``[-1, 1]``.
+    """
+    from sentence_transformers import CrossEncoder
+    from torch.nn import Identity
+
+    cross_encoder = CrossEncoder(model_name, device="cpu")
+
+    def scorer(text_src: str, texts_dst: list[str]) -> np.ndarray:
+        """Score the src sentence against each candidate."""
+        pairs = [(text_src, text_dst) for text_dst in texts_dst]
+        logits = np.asarray(cross_encoder.predict(pairs, activation_fct=Identity()))
+        return 2 / (1 + np.exp(-logits)) - 1
+
+    return scorer
+
+
+def rerank_ambiguous_rows(
+    sim: np.ndarray | BandSimilarity,
+    texts_src: list[str],
+    texts_dst: list[str],
+    scorer: RerankScorer,
+    win_len: int = 20,
+    top_k: int = 5,
+    margin_th: float = 0.05,
+    score_weight: float = 0.5,
+) -> tuple[list[int], list[int]]:
+    """Rerank the top candidates of the rows where the best match is unsure.
+
+    The candidates are searched in the same window around the rescaled diagonal
+    used by ``Aligner.align_sentences``.
+    The similarity of the candidates is updated in place,
+    mixing in the scorer result with weight ``score_weight``.
+
+    Returns:
+        tuple[list[int], list[int]]: The reranked src ids,
+            and the subset that have a clear winner after the reranking.
+    """
+    sent_num_src, sent_num_dst = sim.shape
+    ratio = sent_num_src / sent_num_dst
+    ids_reranked = []
+    ids_sure = []
+
+    for id_src in range(sent_num_src):
+        # the same window used to search the match
+        id_dst_ratio = int(id_src / ratio)
+        win_left = max(0, id_dst_ratio - win_len)
+        win_right = min(sent_num_dst, id_dst_ratio + win_len + 1)
+        some_sent_sim = sim[id_src, win_left:win_right]
+        if len(some_sent_sim) < 2:
+            continue
+
+        # the first stage: is the best candidate clearly better than the second?
+        ids_top = np.argsort(some_sent_sim)[::-1][:top_k]
+        margin = some_sent_sim[ids_top[0]] - some_sent_sim[ids_top[1]]
+        if margin >= margin_th:
+            continue
+
+        # the second stage: score the top candidates with the expensive model
+        ids_cand = ids_top + win_left
+        scores = scorer(texts_src[id_src], [texts_dst[i] for i in ids_cand])
+        sim_cand = (1 - score_weight) * sim[id_src, ids_cand] + score_weight * scores
+        sim[id_src, ids_cand] = sim_cand
+        ids_reranked.append(id_src)
+
+        # a clear winner is trusted even for short sentences
+        sim_cand_sorted = np.sort(sim_cand)
+        if sim_cand_sorted[-1] - sim_cand_sorted[-2] >= margin_th:
+            ids_sure.append(id_src)
+
+    return ids_reranked, ids_sure
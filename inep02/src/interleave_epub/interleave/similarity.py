@@ -0,0 +1,188 @@
+"""Compute the similarity the engines align on.
+
+The interactive ``Aligner`` and the workers of ``align_pairs_parallel``
+call the same functions, so a chapter aligned in the background
+gets the same alignment as one aligned on screen,
+and they read and write the same similarity caches.
+"""
+
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+from interleave_epub.interleave.engine import (
+    AlignEngine,
+    ChapterFeatures,
+    PyramidEngine,
+    align_engines,
+)
+from interleave_epub.interleave.length_align import length_prior
+from interleave_epub.interleave.lexical import lexical_encode, lexical_similarity
+from interleave_epub.interleave.pyramid import BandSimilarity, pyramid_similarity
+from interleave_epub.interleave.rerank import RerankScorer, rerank_ambiguous_rows
+
+# encode a list of texts as the rows of a matrix
+Encoder = Callable[[list[str]], np.ndarray]
+
+
+def is_lexical(sim_method: str, engine_name: str) -> bool:
+    """Check if the similarity uses only the original sentences.
+
+    The lexical similarity needs no translation and no sentence transformer,
+    but the paragraph engines always compare the embeddings.
+    """
+    return (
+        sim_method == "lexical" and align_engines[engine_name].sim_level == "sentence"
+    )
+
+
+def similarity_cache_path(
+    align_cache_fol: Path, engine_name: str, ch_id_pair_str: str
+) -> Path:
+    """Get the path of the cached similarity of a chapter pair.
+
+    The paragraph similarity has a different shape, it is kept separate.
+    The pyramid engine keeps its corridor sparse, with the coarse path.
+    """
+    engine_cls = align_engines[engine_name]
+    if engine_cls.sim_level == "paragraph":
+        return align_cache_fol / f"info_sim_par_{ch_id_pair_str}.npy"
+    if issubclass(engine_cls, PyramidEngine):
+        return align_cache_fol / f"info_sim_band_{ch_id_pair_str}.npz"
+    return align_cache_fol / f"info_sim_{ch_id_pair_str}.npy"
+
+
+def save_similarity(sim_path: Path, sim: np.ndarray | BandSimilarity) -> None:
+    """Save a similarity, in the format picked by ``similarity_cache_path``."""
+    if isinstance(sim, BandSimilarity):
+        np.savez(sim_path, allow_pickle=False, **sim.to_arrays())
+    elif sim_path.suffix == ".npz":
+        # the pyramid engine also runs on the dense lexical and anchor similarity
+        np.savez(sim_path, sim=sim)
+    else:
+        np.save(sim_path, sim)
+
+
+def load_similarity(sim_path: Path) -> np.ndarray | BandSimilarity:
+    """Load a similarity written by ``save_similarity``."""
+    if sim_path.suffix != ".npz":
+        return np.load(sim_path)
+    with np.load(sim_path) as arrays:
+        if "sim" in arrays:
+            return arrays["sim"]
+        return BandSimilarity.from_arrays(arrays)
+
+
+def compute_similarity(
+    engine: AlignEngine,
+    sim_method: str,
+    feat_src: ChapterFeatures,
+    feat_dst: ChapterFeatures,
+    sents_text_orig_src: list[str],
+    sents_text_orig_dst: list[str],
+    encode: Encoder | None,
+    on_stage: Callable[[str], None] | None = None,
+    win_len: int = 20,
+) -> np.ndarray | BandSimilarity:
+    """Compute the similarity the engine needs.
+
+    The paragraph engines compare the embeddings of the paragraphs.
+    The sentence engines compare the embeddings of the sentences,
+    only in the corridor around the coarse path for the pyramid engine,
+    or the hashed n-grams of the original sentences if ``sim_method`` is lexical.
+
+    Args:
+        engine (AlignEngine): The engine that will align the chapters.
+        sim_method (str): ``sent_transformer`` or ``lexical``.
+        feat_src (ChapterFeatures): The features of the src chapter.
+        feat_dst (ChapterFeatures): The features of the dst chapter.
+        sents_text_orig_src (list[str]): The original src sentences.
+        sents_text_orig_dst (list[str]): The original dst sentences.
+        encode (Encoder | None): Embed the texts, not needed for the lexical one.
+        on_stage (Callable[[str], None] | None): Called with ``similarity``
+            when the texts are encoded.
+        win_len (int): The half width of the windows used by the engine,
+            the lexical band covers twice that.
+
+    Raises:
+        ValueError: If the similarity needs an encoder and there is none.
+    """
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    if engine.sim_level == "sentence" and sim_method == "lexical":
+        enc_lex_src = lexical_encode(sents_text_orig_src)
+        enc_lex_dst = lexical_encode(sents_text_orig_dst)
+        if on_stage is not None:
+            on_stage("similarity")
+        return lexical_similarity(enc_lex_src, enc_lex_dst, band_half_width=win_len * 2)
+
+    if encode is None:
+        raise ValueError(f"The {sim_method} similarity needs a sentence encoder.")
+    if engine.sim_level == "paragraph":
+        enc_src = encode(feat_src.pars_text)
+        enc_dst = encode(feat_dst.pars_text)
+    else:
+        enc_src = encode(feat_src.sents_text)
+        enc_dst = encode(feat_dst.sents_text)
+    if on_stage is not None:
+        on_stage("similarity")
+
+    if isinstance(engine, PyramidEngine):
+        return pyramid_similarity(
+            enc_src, enc_dst, engine.block_size, engine.corridor_blocks
+        )
+    return cosine_similarity(enc_src, enc_dst)
+
+
+def adjust_sentence_similarity(
+    sim: np.ndarray | BandSimilarity,
+    sents_text_src: list[str],
+    sents_text_dst: list[str],
+    sents_text_orig_src: list[str],
+    sents_text_orig_dst: list[str],
+    length_prior_weight: float = 0.0,
+    rerank_scorer: RerankScorer | None = None,
+    win_len: int = 20,
+) -> tuple[np.ndarray | BandSimilarity, set[int]]:
+    """Mix the length prior in a sentence similarity and rerank the unsure rows.
+
+    The similarity passed is not changed, the cached one stays the raw similarity.
+
+    Args:
+        sim (np.ndarray | BandSimilarity): The sentence similarity.
+        sents_text_src (list[str]): The src sentences the similarity was built on.
+        sents_text_dst (list[str]): The dst sentences the similarity was built on.
+        sents_text_orig_src (list[str]): The original src sentences.
+        sents_text_orig_dst (list[str]): The original dst sentences.
+        length_prior_weight (float): The weight of the Gale-Church length prior,
+            0 to skip it.
+        rerank_scorer (RerankScorer | None): Score again the top candidates
+            of the unsure rows, None to skip it.
+        win_len (int): The half width of the windows searched when reranking.
+
+    Returns:
+        tuple[np.ndarray | BandSimilarity, set[int]]: The new similarity,
+            and the src sentences whose match is sure after the reranking.
+    """
+    if length_prior_weight > 0:
+        # the character length of the original sentences, no translation needed
+        prior = length_prior(
+            [len(s) for s in sents_text_orig_src],
+            [len(s) for s in sents_text_orig_dst],
+        )
+        w = length_prior_weight
+        if isinstance(sim, BandSimilarity):
+            sim = sim.blend(prior, w)
+        else:
+            sim = (1 - w) * sim + w * prior
+
+    sure_ids_src: set[int] = set()
+    if rerank_scorer is not None:
+        # the reranking changes the rows in place
+        sim = sim.copy()
+        _, ids_sure = rerank_ambiguous_rows(
+            sim, sents_text_src, sents_text_dst, rerank_scorer, win_len=win_len
+        )
+        sure_ids_src = set(ids_sure)
+    return sim, sure_ids_src
@@ -2,12 +2,16 @@
 
 And by basic I mean a JSON file that gets *completely* rewritten every time.
 """
+from __future__ import annotations
+
 import json
 from pathlib import Path
-from typing import Optional
+from typing import TYPE_CHECKING, Optional
 
 from loguru import logger as lg
-from transformers.pipelines.text2text_generation import TranslationPipeline
+
+if TYPE_CHECKING:
+    from transformers.pipelines.text2text_generation import TranslationPipeline
 
 
 class TranslationPipelineCache:
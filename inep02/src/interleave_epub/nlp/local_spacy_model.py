@@ -1,8 +1,11 @@
 """Load cached local spacy models."""
+from __future__ import annotations
+
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-import spacy
-from spacy.cli.download import download
+if TYPE_CHECKING:
+    import spacy
 
 
 def spacy_load_local_model(
@@ -22,6 +25,10 @@ def spacy_load_local_model(
     Returns:
         spacy.language.Language: Loaded model.
     """
+    # spacy is slow to import, only do it when a model is needed
+    import spacy
+    from spacy.cli.download import download
+
     if not cache_dir.exists():
         Path.mkdir(cache_dir, parents=True)
 
@@ -0,0 +1,178 @@
+"""Share the loaded models between all the interleavers of the process.
+
+The models are big and read only once loaded,
+so every session and language pair uses the same instances, keyed by model name.
+
+Loading a model takes seconds, and the first inference is slow too:
+each model runs a tiny warm-up inference right after loading.
+``warm_up_models`` loads the models in a background thread when the server starts,
+so the first user does not wait for them.
+
+The libraries of the models are imported only when a model is loaded,
+so the app starts fast.
+"""
+
+from __future__ import annotations
+
+from functools import partial
+from threading import Lock, Thread
+from typing import TYPE_CHECKING, Any, Callable, cast
+
+from loguru import logger as lg
+
+from interleave_epub.interleave.constants import (
+    align_engine_name,
+    cross_encoder_model_names,
+    hug_model_names,
+    rerank_scorer_name,
+    sent_model_names,
+    sim_method,
+    spa_model_cache_fol,
+    spa_model_names,
+)
+from interleave_epub.interleave.rerank import RerankScorer, cross_encoder_scorer
+from interleave_epub.interleave.similarity import is_lexical
+from interleave_epub.nlp.local_spacy_model import spacy_load_local_model
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from spacy.language import Language
+    from transformers.pipelines.text2text_generation import TranslationPipeline
+
+# the text used to warm up the models
+warm_up_text = "This is a short sentence to warm up the model."
+
+
+class ModelRegistry:
+    """Load each model once, keyed by name."""
+
+    def __init__(self) -> None:
+        """Initialize an empty registry."""
+        self.models: dict[str, Any] = {}
+        # one lock per model, so that two models can load at the same time
+        self.locks: dict[str, Lock] = {}
+        self.lock = Lock()
+
+    def get(
+        self,
+        name: str,
+        loader: Callable[[], Any],
+        warm_up: Callable[[Any], Any] | None = None,
+    ) -> Any:
+        """Get a model, loading it with ``loader`` the first time.
+
+        If another thread is loading the same model, wait for it.
+
+        Args:
+            name (str): The key of the model.
+            loader (Callable[[], Any]): Build the model.
+            warm_up (Callable[[Any], Any] | None): Called once with the new model,
+                before any other thread can use it.
+        """
+        with self.lock:
+            if name in self.models:
+                return self.models[name]
+            model_lock = self.locks.setdefault(name, Lock())
+
+        with model_lock:
+            # loaded while we were waiting
+            if name in self.models:
+                return self.models[name]
+            lg.debug(f"Loading model {name}.")
+            model = loader()
+            if warm_up is not None:
+                warm_up(model)
+            with self.lock:
+                self.models[name] = model
+        return model
+
+    def __contains__(self, name: str) -> bool:
+        """Check if a model is loaded already."""
+        return name in self.models
+
+
+# the registry of the process
+model_registry = ModelRegistry()
+
+
+def spacy_model(model_name: str) -> Language:
+    """Get a spacy model."""
+    return model_registry.get(
+        f"spacy_{model_name}",
+        partial(spacy_load_local_model, model_name, spa_model_cache_fol),
+        lambda nlp: nlp(warm_up_text),
+    )
+
+
+def load_translation_pipe(model_name: str) -> TranslationPipeline:
+    """Load a huggingface translation pipeline."""
+    from transformers.pipelines import pipeline
+
+    return cast("TranslationPipeline", pipeline("translation", model=model_name))
+
+
+def translation_pipe(model_name: str) -> TranslationPipeline:
+    """Get a huggingface translation pipeline."""
+    return model_registry.get(
+        f"pipe_{model_name}",
+        partial(load_translation_pipe, model_name),
+        lambda pipe: pipe(warm_up_text),
+    )
+
+
+def load_sentence_transformer(model_name: str) -> SentenceTransformer:
+    """Load a sentence transformer."""
+    from sentence_transformers import SentenceTransformer
+
+    # TODO: why on CPU? parametrize that
+    return SentenceTransformer(model_name, device="cpu")
+
+
+def sentence_transformer(model_name: str) -> SentenceTransformer:
+    """Get a sentence transformer."""
+    return model_registry.get(
+        f"sent_transformer_{model_name}",
+        partial(load_sentence_transformer, model_name),
+        lambda model: model.encode([warm_up_text]),
+    )
+
+
+def cross_encoder(model_name: str) -> RerankScorer:
+    """Get a scorer that uses a cross encoder."""
+    return model_registry.get(
+        f"cross_encoder_{model_name}",
+        partial(cross_encoder_scorer, model_name),
+        lambda scorer: scorer(warm_up_text, [warm_up_text]),
+    )
+
+
+def warm_up_models(lt_src: str, lt_dst: str) -> Thread:
+    """Load in a background thread the models needed for a language pair.
+
+    The same models ``InterleaverInteractive.load_nlp`` asks for:
+    an interleaver that needs one while it is loading waits for it.
+
+    Returns:
+        Thread: The thread loading the models, already started.
+    """
+
+    def load() -> None:
+        lg.info(f"Warming up the models for {lt_src}-{lt_dst}.")
+        try:
+            for lt in (lt_src, lt_dst):
+                spacy_model(spa_model_names[lt])
+            if not is_lexical(sim_method, align_engine_name):
+                translation_pipe(hug_model_names[f"{lt_src}-{lt_dst}"])
+            # we assume that dst is english and we know the sent model for that
+            sentence_transformer(sent_model_names[lt_dst])
+            if rerank_scorer_name == "cross_encoder":
+                cross_encoder(cross_encoder_model_names[lt_dst])
+        except Exception as e:
+            # the request that needs the model will try again and show the error
+            lg.warning(f"Failed to warm up the models: {e!r}")
+            return
+        lg.info("Models warmed up.")
+
+    thread = Thread(target=load, name="warm_up", daemon=True)
+    thread.start()
+    return thread
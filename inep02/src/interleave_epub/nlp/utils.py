@@ -1,10 +1,14 @@
 """Misc functions and constantr pertaining to nlp models."""
+from __future__ import annotations
+
 from pathlib import Path
-from typing import cast
+from typing import TYPE_CHECKING, cast
 
 import numpy as np
-from sentence_transformers import SentenceTransformer
-from torch import Tensor
+
+if TYPE_CHECKING:
+    from sentence_transformers import SentenceTransformer
+    from torch import Tensor
 
 
 def sentence_encode_np(
@@ -19,7 +23,7 @@ def sentence_encode_np(
         sim = cosine_similarity(enc0, enc1)
     """
     encodings = cast(
-        Tensor,
+        "Tensor",
         sentence_transformer.encode(sentences, convert_to_tensor=True),
     )
     encodings_np: np.ndarray = encodings.detach().cpu().numpy()
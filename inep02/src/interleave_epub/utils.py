@@ -18,6 +18,7 @@ def get_package_fol(
         "align_cache",
         "epub_template",
         "output_cache_fol",
+        "session_cache",
     ]
 ) -> Path:
     """Get the requested folder."""
@@ -35,6 +36,9 @@ def get_package_fol(
     elif which_fol == "output_cache_fol":
         # I'm not 100% sure that this folder should be in *interleave*.constants
         return output_cache_fol
+    elif which_fol == "session_cache":
+        # the manifests and the uploaded books of the browser sessions
+        return root_fol / "session_cache"
 
 
 def validate_index(
@@ -1,5 +1,1072 @@
+import subprocess
+import sys
+
 from interleave_epub import __version__
 
 
 def test_version():
     assert __version__ == "0.1.0"
+
+
+def test_import_app_is_light():
+    """Importing the app must not pull in the heavy libraries, or load the models."""
+    heavy = [
+        "torch",
+        "transformers",
+        "sentence_transformers",
+        "spacy",
+        "sklearn",
+        "pandas",
+        "scipy",
+        "matplotlib",
+    ]
+    code = (
+        "import sys\n"
+        "import threading\n"
+        "import interleave_epub.flask_app\n"
+        "print([t.name for t in threading.enumerate() if t.name == 'warm_up'])\n"
+        f"print([m for m in {heavy!r} if m in sys.modules])\n"
+    )
+    res = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True)
+    assert res.returncode == 0, res.stderr
+    assert res.stdout.strip().splitlines()[-2:] == ["[]", "[]"]
+
+
+def test_render_memory_flat():
+    """Rendering the figures over and over must not leak figures."""
+    import gc
+    from types import SimpleNamespace
+
+    from matplotlib._pylab_helpers import Gcf
+    import numpy as np
+
+    from interleave_epub.flask_app.figures import plot_alignment, plot_similarity
+
+    sent_num = 50
+    ids = list(range(sent_num))
+    al = SimpleNamespace(
+        sim=np.random.default_rng(0).random((sent_num, sent_num)),
+        all_good_ids_src=ids,
+        all_good_ids_dst_max=ids,
+        all_ids_src=ids,
+        all_ids_dst_max=ids,
+        sent_num_src=sent_num,
+        sent_num_dst=sent_num,
+        fit_func=np.poly1d([1, 0]),
+    )
+
+    def count_objects_after(render_num: int) -> int:
+        for _ in range(render_num):
+            plot_similarity(al, figsize=(1, 1))
+            plot_alignment(al, figsize=(1, 1))
+        gc.collect()
+        return len(gc.get_objects())
+
+    # warm up the caches of matplotlib
+    obj_num_start = count_objects_after(20)
+    obj_num_end = count_objects_after(500)
+
+    # a leaked figure keeps thousands of objects alive
+    assert Gcf.get_num_fig_managers() == 0
+    assert obj_num_end - obj_num_start < 1000
+
+
+def test_gale_church_align():
+    """The length alignment pairs similar lengths and keeps the mapping in range."""
+    from interleave_epub.interleave.length_align import (
+        beads_to_src_to_dst_flat,
+        gale_church_align,
+    )
+
+    # the same lengths are paired one to one
+    lens = [120, 40, 300, 80]
+    assert gale_church_align(lens, lens) == [(i, 1, i, 1) for i in range(4)]
+
+    # a paragraph split in two is a 2-1 bead
+    beads = gale_church_align([100, 50, 50, 100], [100, 100, 100])
+    assert beads == [(0, 1, 0, 1), (1, 2, 1, 1), (3, 1, 2, 1)]
+    assert beads_to_src_to_dst_flat(beads, 4, 3) == {0: 0, 1: 1, 2: 1, 3: 2}
+
+    # the trailing src items without a dst item go to the last dst item
+    beads = gale_church_align([100] * 8, [100] * 2)
+    assert sum(di for _, di, _, _ in beads) == 8
+    assert sum(dj for _, _, _, dj in beads) == 2
+    src_to_dst_flat = beads_to_src_to_dst_flat(beads, 8, 2)
+    assert list(src_to_dst_flat) == list(range(8))
+    assert all(0 <= par_dst_id < 2 for par_dst_id in src_to_dst_flat.values())
+    assert src_to_dst_flat[7] == 1
+    assert list(src_to_dst_flat.values()) == sorted(src_to_dst_flat.values())
+
+
+def test_png_response_not_modified():
+    """A PNG the browser already has is answered with an empty 304."""
+    from flask import Flask
+
+    from interleave_epub.flask_app.utils import png_response
+
+    app = Flask(__name__)
+
+    @app.route("/png")
+    def png():
+        return png_response(b"fake png", "v1")
+
+    client = app.test_client()
+    res = client.get("/png")
+    assert res.status_code == 200
+    assert res.data == b"fake png"
+    assert res.headers["ETag"] == '"v1"'
+
+    res = client.get("/png", headers={"If-None-Match": '"v1"'})
+    assert res.status_code == 304
+    assert res.data == b""
+
+    # a stale image is sent again
+    res = client.get("/png", headers={"If-None-Match": '"v0"'})
+    assert res.status_code == 200
+    assert res.data == b"fake png"
+
+
+def test_align_journal_replay(tmp_path):
+    """Replaying the journal gives the same state as a snapshot of it."""
+    from interleave_epub.interleave.align_journal import (
+        AlignJournal,
+        write_align_snapshot,
+    )
+
+    snapshot_path = tmp_path / "info_align_0_0.json"
+    write_align_snapshot(
+        snapshot_path, {"better_par_src_to_dst_flat": {i: i for i in range(4)}}
+    )
+    journal = AlignJournal(snapshot_path)
+    align_info = journal.load()
+    par_src_to_dst_flat = align_info["better_par_src_to_dst_flat"]
+    fixed_src_par_ids = align_info["fixed_src_par_ids"]
+
+    journal.pick(par_src_to_dst_flat, fixed_src_par_ids, [(1, 2)])
+    journal.pick(par_src_to_dst_flat, fixed_src_par_ids, [(2, 3), (3, 3)])
+    assert journal.undo(par_src_to_dst_flat, fixed_src_par_ids)
+    assert journal.redo(par_src_to_dst_flat, fixed_src_par_ids)
+    assert journal.undo(par_src_to_dst_flat, fixed_src_par_ids)
+    assert par_src_to_dst_flat == {0: 0, 1: 2, 2: 2, 3: 3}
+    assert fixed_src_par_ids == [1]
+    # a crash in the middle of a write leaves a truncated line
+    with journal.journal_path.open("a") as journal_file:
+        journal_file.write('{"op": "pi')
+
+    # reload from the journal
+    journal_replay = AlignJournal(snapshot_path)
+    align_info_replay = journal_replay.load()
+    assert align_info_replay["better_par_src_to_dst_flat"] == par_src_to_dst_flat
+    assert align_info_replay["fixed_src_par_ids"] == fixed_src_par_ids
+    assert journal_replay.undo_stack == journal.undo_stack
+    assert journal_replay.redo_stack == journal.redo_stack
+
+    # fold the journal in a snapshot and reload from it
+    journal_replay.write_snapshot(align_info_replay)
+    assert not journal_replay.journal_path.exists()
+    journal_snapshot = AlignJournal(snapshot_path)
+    align_info_snapshot = journal_snapshot.load()
+    assert (
+        align_info_snapshot["better_par_src_to_dst_flat"]
+        == align_info_replay["better_par_src_to_dst_flat"]
+    )
+    assert (
+        align_info_snapshot["fixed_src_par_ids"]
+        == align_info_replay["fixed_src_par_ids"]
+    )
+    assert journal_snapshot.undo_stack == journal_replay.undo_stack
+    assert journal_snapshot.redo_stack == journal_replay.redo_stack
+
+    # the undone pick can still be redone after the reload
+    par_src_to_dst_flat = align_info_snapshot["better_par_src_to_dst_flat"]
+    fixed_src_par_ids = align_info_snapshot["fixed_src_par_ids"]
+    assert journal_snapshot.redo(par_src_to_dst_flat, fixed_src_par_ids)
+    assert par_src_to_dst_flat == {0: 0, 1: 2, 2: 3, 3: 3}
+    assert sorted(fixed_src_par_ids) == [1, 2, 3]
+    assert not journal_snapshot.redo(par_src_to_dst_flat, fixed_src_par_ids)
+
+
+def test_epub_mimetype_first(tmp_path):
+    """The epub starts with the uncompressed mimetype, readers check that."""
+    import io
+    from zipfile import ZIP_STORED, ZipFile
+
+    from interleave_epub.epub.epub_builder import EpubBuilder
+    from interleave_epub.utils import get_package_fol
+
+    (tmp_path / "ch_0001.xhtml").write_text("<html><body><p>A</p></body></html>")
+    epub_out = io.BytesIO()
+    EpubBuilder(
+        composed_folder=tmp_path,
+        template_epub_folder=get_package_fol("epub_template"),
+        epub_out_folder=tmp_path,
+        tot_chapter_num=1,
+        author_name_full="Author",
+        book_name_full="Title",
+        lang_alpha2_tag="fr",
+    ).do_build(epub_out)
+
+    epub_out.seek(0)
+    with ZipFile(epub_out) as epub_zip:
+        first_info = epub_zip.infolist()[0]
+        assert first_info.filename == "mimetype"
+        assert first_info.compress_type == ZIP_STORED
+        assert epub_zip.read("mimetype") == b"application/epub+zip"
+        assert "ch_0001.xhtml" in epub_zip.namelist()
+
+
+def test_pyramid_band_similarity(tmp_path):
+    """The pyramid stores only the corridor, and the engine aligns on it."""
+    import numpy as np
+
+    from interleave_epub.interleave.engine import (
+        ChapterFeatures,
+        SimilaritySource,
+        build_engine,
+    )
+    from interleave_epub.interleave.pyramid import BandSimilarity, pyramid_similarity
+    from interleave_epub.interleave.similarity import (
+        load_similarity,
+        save_similarity,
+        similarity_cache_path,
+    )
+
+    rng = np.random.default_rng(0)
+    sent_num = 300
+    enc_src = rng.normal(size=(sent_num, 32)).astype(np.float32)
+    # the dst chapter drifts: it starts with 20 extra sentences
+    enc_extra = rng.normal(size=(20, 32)).astype(np.float32)
+    enc_noise = rng.normal(size=enc_src.shape).astype(np.float32) * 0.3
+    enc_dst = np.concatenate([enc_extra, enc_src + enc_noise])
+
+    sim = pyramid_similarity(enc_src, enc_dst, block_size=16)
+    assert isinstance(sim, BandSimilarity)
+    assert sim.shape == (sent_num, sent_num + 20)
+    assert sim.values.size < sim.shape[0] * sim.shape[1] / 2
+
+    # inside the band the values are the cosine similarity
+    enc_src_n = enc_src / np.linalg.norm(enc_src, axis=1, keepdims=True)
+    enc_dst_n = enc_dst / np.linalg.norm(enc_dst, axis=1, keepdims=True)
+    sim_dense = sim.toarray()
+    lo = int(sim.band_lo[3])
+    hi = int(sim.band_hi[3])
+    assert np.allclose(sim_dense[48:64, lo:hi], enc_src_n[48:64] @ enc_dst_n[lo:hi].T)
+    assert np.all(sim_dense[48:64, :lo] == 0)
+    assert np.allclose(sim[50, lo - 2 : lo + 2], sim_dense[50, lo - 2 : lo + 2])
+
+    # the cache keeps the corridor
+    sim_path = similarity_cache_path(tmp_path, "pyramid", "0_0")
+    save_similarity(sim_path, sim)
+    sim_loaded = load_similarity(sim_path)
+    assert isinstance(sim_loaded, BandSimilarity)
+    assert np.array_equal(sim_loaded.block_path, sim.block_path)
+    assert np.array_equal(sim_loaded.toarray(), sim_dense)
+
+    def features(sent_num: int) -> ChapterFeatures:
+        return ChapterFeatures(
+            sents_text=[""] * sent_num,
+            sents_len=[10] * sent_num,
+            sents_par_id=list(range(sent_num)),
+            par_num=sent_num,
+        )
+
+    engine = build_engine("pyramid", block_size=16)
+    result = engine.align(
+        features(sent_num), features(sent_num + 20), SimilaritySource(sim_loaded)
+    )
+    true_dst = np.arange(sent_num) + 20
+    assert np.mean(np.array(result.ids_dst_max) == true_dst) > 0.95
+
+
+def build_bare_aligner(tmp_path, par_src_to_dst_flat, par_num_dst, viz_win_size=3):
+    """Build an aligner with only the paragraph matching, no chapters or models."""
+    from types import SimpleNamespace
+
+    from interleave_epub.interleave.align import Aligner
+    from interleave_epub.interleave.align_journal import AlignJournal
+
+    al = Aligner.__new__(Aligner)
+    al.ch_dst = SimpleNamespace(paragraphs=[None] * par_num_dst)
+    al.viz_win_size = viz_win_size
+    al.better_par_src_to_dst_flat = dict(par_src_to_dst_flat)
+    al.fixed_src_par_ids = []
+    al.auto_accepted_src_par_ids = []
+    al.journal = AlignJournal(tmp_path / "info_align_0_0.json")
+    al.bump_state_version()
+    al.find_next_par_to_fix()
+    return al
+
+
+def test_accept_window_skips_unmatched(tmp_path):
+    """Accepting the window leaves the src paragraphs without a guess to fix."""
+    # paragraph 3 has no match, the window around the fix covers it
+    al = build_bare_aligner(tmp_path, {0: 0, 1: 1, 2: 2, 3: -1, 4: 0, 5: 5}, 6)
+    assert al.curr_fix_src_par_id == 2
+
+    al.accept_window_guesses()
+    assert al.better_par_src_to_dst_flat[3] == -1
+    assert sorted(al.fixed_src_par_ids) == [0, 1, 2, 4]
+
+    # the batch is a single event
+    assert al.undo_pick()
+    assert al.fixed_src_par_ids == []
+
+
+def test_align_snapshot_crash_keeps_journal(tmp_path, monkeypatch):
+    """A crash while writing a snapshot leaves the old snapshot and its journal."""
+    import os
+
+    import pytest
+
+    from interleave_epub.interleave.align_journal import AlignJournal
+
+    snapshot_path = tmp_path / "info_align_0_0.json"
+    journal = AlignJournal(snapshot_path)
+    journal.write_snapshot({"better_par_src_to_dst_flat": {0: 0, 1: 1, 2: 2}})
+    align_info = journal.load()
+    par_src_to_dst_flat = align_info["better_par_src_to_dst_flat"]
+    fixed_src_par_ids = align_info["fixed_src_par_ids"]
+    journal.pick(par_src_to_dst_flat, fixed_src_par_ids, [(1, 2)])
+    snapshot_text = snapshot_path.read_text()
+
+    def crash(src, dst):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(os, "replace", crash)
+    with pytest.raises(OSError):
+        journal.write_snapshot(align_info)
+    monkeypatch.undo()
+    # the picks after the crash go to the same journal
+    journal.pick(par_src_to_dst_flat, fixed_src_par_ids, [(2, 1)])
+
+    # the old snapshot is untouched and the journal still has the picks
+    assert snapshot_path.read_text() == snapshot_text
+    assert journal.journal_path.exists()
+    assert sorted(p.name for p in tmp_path.iterdir()) == [
+        "info_align_0_0.json",
+        "info_align_0_0.jsonl",
+    ]
+    align_info_reload = AlignJournal(snapshot_path).load()
+    assert align_info_reload["better_par_src_to_dst_flat"] == {0: 0, 1: 2, 2: 1}
+    assert align_info_reload["fixed_src_par_ids"] == [1, 2]
+
+
+def test_lexical_similarity_band():
+    """The lexical vectors are sparse and the similarity stays in the band."""
+    import numpy as np
+
+    from interleave_epub.interleave.engine import ChapterFeatures, build_engine
+    from interleave_epub.interleave.lexical import LEX_NUM_FEATURES, lexical_encode
+    from interleave_epub.interleave.similarity import compute_similarity
+
+    sents_src = [f"Marie a {i} chats et {i + 1} chiens." for i in range(60)]
+    sents_dst = [f"Marie has {i} cats and {i + 1} dogs." for i in range(60)]
+
+    enc_src = lexical_encode(sents_src)
+    assert enc_src.shape == (60, LEX_NUM_FEATURES)
+    # a short sentence has a few dozen features out of the whole space
+    assert enc_src.getnnz(axis=1).max() < 100
+    assert np.allclose(np.asarray(enc_src.multiply(enc_src).sum(axis=1)).ravel(), 1)
+
+    win_len = 5
+    feat_src = ChapterFeatures(sents_src, [8] * 60, list(range(60)), 60)
+    feat_dst = ChapterFeatures(sents_dst, [8] * 60, list(range(60)), 60)
+    sim = compute_similarity(
+        build_engine("greedy_triangle"),
+        "lexical",
+        feat_src,
+        feat_dst,
+        sents_src,
+        sents_dst,
+        encode=None,
+        win_len=win_len,
+    )
+    assert sim.shape == (60, 60)
+
+    # nothing is computed outside of the band of win_len * 2
+    ids = np.arange(60)
+    dist = np.abs(ids[:, None] - ids[None, :])
+    assert np.all(sim[dist > win_len * 2] == 0)
+    assert np.all(sim[dist <= win_len * 2] > 0)
+    # the shared numbers and name point to the right sentence
+    assert np.array_equal(sim.argmax(axis=1), ids)
+
+
+class FakeTensor:
+    """The few methods of a torch tensor that ``sentence_encode_np`` calls."""
+
+    def __init__(self, array):
+        self.array = array
+
+    def detach(self):
+        return self
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class OneHotEncoder:
+    """A sentence transformer that encodes ``"sent <i>"`` as the i-th unit vector."""
+
+    def __init__(self, dim: int):
+        self.dim = dim
+
+    def encode(self, sentences, convert_to_tensor=False):
+        import numpy as np
+
+        enc = np.zeros((len(sentences), self.dim), dtype=np.float32)
+        for row, text in enumerate(sentences):
+            enc[row, int(text.split()[-1])] = 1
+        return FakeTensor(enc)
+
+
+def build_anchor_aligner(sents_len_src: list[int]):
+    """Build an aligner with only what the anchor similarity reads."""
+    from types import SimpleNamespace
+
+    from interleave_epub.interleave.align import Aligner
+
+    sent_num = len(sents_len_src)
+    sents_text = [f"sent {i}" for i in range(sent_num)]
+    translated_ids: list[int] = []
+    al = Aligner.__new__(Aligner)
+    al.sent_which_align = {"src": "trad", "dst": "orig"}
+    al.ch_src = SimpleNamespace(
+        sents_len={"trad": sents_len_src},
+        sents_num={"trad": sent_num},
+        translate_sents=translated_ids.extend,
+    )
+    al.ch_dst = SimpleNamespace(sents_num={"orig": sent_num})
+    al.sents_text_src_align = sents_text
+    al.sents_text_dst_align = sents_text
+    al.lt_sent_tra = "en"
+    al.sent_transformer = {"en": OneHotEncoder(sent_num)}
+    return al, translated_ids
+
+
+def test_anchor_similarity_translates_anchors():
+    """Only the anchors are translated, the other rows get a spike."""
+    import numpy as np
+
+    # the sentences 5 and 6 are short, never anchors
+    sents_len_src = [10] * 100
+    sents_len_src[5] = sents_len_src[6] = 2
+    al, translated_ids = build_anchor_aligner(sents_len_src)
+    al.compute_anchor_similarity(anchor_step=8)
+
+    ids_anchor = [i for i in range(100) if sents_len_src[i] > 4][::8]
+    assert sorted(translated_ids) == ids_anchor
+    assert np.array_equal(np.flatnonzero(al.sim_is_computed), ids_anchor)
+    # each row that was not translated has a single spike,
+    # interpolated between the anchors
+    assert np.all((al.sim > 0).sum(axis=1) == 1)
+    ids_inner = np.arange(ids_anchor[-1] + 1)
+    assert np.array_equal(al.sim[ids_inner].argmax(axis=1), ids_inner)
+
+
+def test_anchor_similarity_few_anchors():
+    """With less than two anchors, all the sentences are translated."""
+    import numpy as np
+
+    sents_len_src = [2] * 30
+    sents_len_src[10] = 10
+    al, translated_ids = build_anchor_aligner(sents_len_src)
+    al.compute_anchor_similarity(anchor_step=8)
+
+    assert sorted(translated_ids) == list(range(30))
+    assert al.sim_is_computed.all()
+    assert np.array_equal(al.sim, np.eye(30))
+
+
+def hash_encode(texts: list[str]):
+    """Encode each text as a random vector seeded by the text, equal texts match."""
+    from zlib import crc32
+
+    import numpy as np
+
+    return np.array(
+        [np.random.default_rng(crc32(text.encode())).normal(size=16) for text in texts]
+    )
+
+
+def test_paragraph_engine_mapping():
+    """The paragraph engine maps every src paragraph, in order, skipping extras."""
+    import numpy as np
+    from sklearn.metrics.pairwise import cosine_similarity
+
+    from interleave_epub.interleave.engine import (
+        ChapterFeatures,
+        SimilaritySource,
+        build_engine,
+    )
+
+    def features(par_names: list[str]) -> ChapterFeatures:
+        sents_text = [f"{name} sent {k}" for name in par_names for k in range(2)]
+        return ChapterFeatures(
+            sents_text=sents_text,
+            sents_len=[10] * len(sents_text),
+            sents_par_id=[par_id for par_id in range(len(par_names)) for _ in range(2)],
+            par_num=len(par_names),
+        )
+
+    # the dst chapter has an extra paragraph after the fifth one
+    names_src = [f"par {i}" for i in range(12)]
+    names_dst = names_src[:5] + ["extra"] + names_src[5:]
+    feat_src = features(names_src)
+    feat_dst = features(names_dst)
+    sim_par = cosine_similarity(
+        hash_encode(feat_src.pars_text), hash_encode(feat_dst.pars_text)
+    )
+    true_dst = [i if i < 5 else i + 1 for i in range(12)]
+
+    # with a low margin all the paragraphs are sure,
+    # with a high one they are all matched again with their sentences
+    for min_margin in [0.05, 10.0]:
+        engine = build_engine("paragraph", min_margin=min_margin)
+        result = engine.align(
+            feat_src, feat_dst, SimilaritySource(sim_par, encode=hash_encode)
+        )
+        par_src_to_dst_flat = result.par_src_to_dst_flat
+        assert list(par_src_to_dst_flat) == list(range(12))
+        assert list(par_src_to_dst_flat.values()) == true_dst
+        assert result.num_src == 12
+        assert result.num_dst == 13
+        assert all(0 <= c <= 1 for c in result.par_confidence.values())
+
+
+def test_undo_after_done(tmp_path):
+    """Undoing the last pick brings back the paragraph to fix."""
+    al = build_bare_aligner(tmp_path, {0: 0, 1: 1, 2: 3, 3: 2}, 4)
+    assert al.curr_fix_src_par_id == 2
+    al.pick_dst_par(2)
+    assert al.done_aligning
+
+    assert al.undo_pick()
+    assert not al.done_aligning
+    assert al.curr_fix_src_par_id == 2
+
+
+def test_auto_accept_confident_paragraphs(tmp_path):
+    """The out of order paragraphs above the threshold are not asked to the user."""
+    import numpy as np
+
+    from interleave_epub.interleave.engine import AlignResult, paragraph_confidence
+
+    # a sure match on the line has full confidence, a filled in one has none
+    par_confidence = paragraph_confidence(
+        {0: 0, 1: 1, 2: 2},
+        {0: 1.0, 2: 0.5},
+        [0, 0, 1, 2],
+        np.array([0.2, 0.3, 0.2, 0.0]),
+        np.array([0.0, 0.0, 0.0, 10.0]),
+        win_len=20,
+    )
+    assert par_confidence[0] == 1
+    assert par_confidence[1] == 0
+    assert par_confidence[2] == (0.5 + 0 + 0.5) / 3
+
+    al = build_bare_aligner(tmp_path, {}, 6)
+    al.auto_accept_th = 0.8
+    # paragraphs 1, 2 and 3 are out of order, only 3 is unsure
+    par_src_to_dst_flat = {0: 0, 1: 3, 2: 2, 3: 1, 4: 4, 5: 5}
+    par_confidence = {0: 0.9, 1: 0.95, 2: 0.9, 3: 0.5, 4: 0.1, 5: 0.8}
+    al.set_result(
+        AlignResult(
+            num_src=6,
+            num_dst=6,
+            ids_dst_max=list(par_src_to_dst_flat.values()),
+            good_ids_src=list(range(6)),
+            good_ids_dst_max=list(par_src_to_dst_flat.values()),
+            fit_coeff=np.array([1.0, 0.0]),
+            par_src_to_dst_flat=par_src_to_dst_flat,
+            par_confidence=par_confidence,
+        )
+    )
+    assert sorted(al.auto_accepted_src_par_ids) == [0, 1, 2, 5]
+
+    # only the unsure paragraph is asked
+    al.find_next_par_to_fix()
+    assert not al.done_aligning
+    assert al.curr_fix_src_par_id == 3
+    al.pick_dst_par(3)
+    assert al.done_aligning
+
+    # without a threshold every paragraph is asked
+    al.auto_accept_th = None
+    al.set_result(al.align_result)
+    assert al.auto_accepted_src_par_ids == []
+
+
+def test_rerank_ambiguous_rows():
+    """Only the rows with close candidates are scored again, and can change."""
+    import numpy as np
+
+    from interleave_epub.interleave.rerank import (
+        rerank_ambiguous_rows,
+        token_overlap_scorer,
+    )
+
+    texts_src = ["the cat sleeps", "a long walk in the rain"]
+    texts_dst = ["the dog barks", "the cat sleeps here", "a long walk in the rain"]
+    sim = np.array(
+        [
+            # the wrong dst sentence is barely ahead
+            [0.50, 0.49, 0.10],
+            # the right one is clearly ahead
+            [0.10, 0.45, 0.90],
+        ]
+    )
+    sim_before = sim.copy()
+
+    ids_reranked, ids_sure = rerank_ambiguous_rows(
+        sim, texts_src, texts_dst, token_overlap_scorer, win_len=2
+    )
+    assert ids_reranked == [0]
+    assert ids_sure == [0]
+    assert sim[0].argmax() == 1
+    assert np.array_equal(sim[1], sim_before[1])
+
+
+def test_align_pair_writes_snapshot(tmp_path):
+    """A chapter pair aligned by a worker is reloaded like one aligned on screen."""
+    from interleave_epub.interleave.align_journal import load_align_info
+    from interleave_epub.interleave.batch_align import (
+        AlignSettings,
+        PairJob,
+        align_pair,
+    )
+    from interleave_epub.interleave.engine import ChapterFeatures
+    from interleave_epub.interleave.similarity import (
+        load_similarity,
+        similarity_cache_path,
+    )
+
+    sents_src = [f"Marie a {i} chats et {i + 1} chiens." for i in range(40)]
+    sents_dst = [f"Marie has {i} cats and {i + 1} dogs." for i in range(40)]
+    sents_par_id = [i // 2 for i in range(40)]
+    job = PairJob(
+        "0_0",
+        ChapterFeatures(sents_src, [8] * 40, sents_par_id, 20),
+        ChapterFeatures(sents_dst, [8] * 40, sents_par_id, 20),
+        sents_src,
+        sents_dst,
+    )
+    # the lexical similarity needs no model in the worker
+    settings = AlignSettings(sent_model_name="unused", sim_method="lexical")
+
+    ch_id_pair_str, _ = align_pair(job, settings, tmp_path)
+    assert ch_id_pair_str == "0_0"
+
+    sim = load_similarity(similarity_cache_path(tmp_path, "greedy_triangle", "0_0"))
+    assert sim.shape == (40, 40)
+    align_info = load_align_info(tmp_path / "info_align_0_0.json")
+    assert align_info["better_par_src_to_dst_flat"] == {i: i for i in range(20)}
+    assert align_info["fixed_src_par_ids"] == []
+    assert align_info["all_ids_dst_max"] == list(range(40))
+
+
+def test_prefetch_pop_once():
+    """A prefetched aligner is handed out once, then built again."""
+    from interleave_epub.interleave.prefetch import AlignerPrefetcher
+
+    aligner = object()
+    prefetcher = AlignerPrefetcher()
+    prefetcher.prefetch({"0_0": lambda on_stage: aligner})
+    assert prefetcher.pop("0_0") is aligner
+    assert prefetcher.pop("0_0") is None
+    # a pair never prefetched
+    assert prefetcher.pop("1_1") is None
+
+
+def test_prefetch_dropped_after_clear():
+    """A running prefetch stops at its next stage once the targets are cleared."""
+    from threading import Event
+
+    import pytest
+
+    from interleave_epub.interleave.prefetch import AlignerPrefetcher, PrefetchDropped
+
+    started = Event()
+    resume = Event()
+
+    def build_aligner(on_stage):
+        on_stage("encode")
+        started.set()
+        resume.wait(timeout=10)
+        on_stage("align")
+        return object()
+
+    prefetcher = AlignerPrefetcher()
+    prefetcher.prefetch({"0_0": build_aligner})
+    assert started.wait(timeout=10)
+    future = prefetcher.futures["0_0"]
+    prefetcher.check_wanted("0_0", "similarity")
+
+    prefetcher.clear()
+    with pytest.raises(PrefetchDropped):
+        prefetcher.check_wanted("0_0", "similarity")
+    resume.set()
+    assert isinstance(future.exception(timeout=10), PrefetchDropped)
+    assert prefetcher.pop("0_0") is None
+
+
+def wait_finished(job, timeout: float = 10) -> None:
+    """Wait for a job to be done, failed or cancelled."""
+    from time import monotonic, sleep
+
+    t_end = monotonic() + timeout
+    while not job.is_finished:
+        assert monotonic() < t_end, f"Job {job.name} still {job.status}."
+        sleep(0.01)
+
+
+def test_jobs_run_one_at_a_time():
+    """The jobs of a session run in order on a single worker thread."""
+    from threading import Lock, current_thread
+    from time import sleep
+
+    from interleave_epub.flask_app.jobs import JobManager
+
+    jobs = JobManager()
+    lock = Lock()
+    running = []
+    max_running = []
+    thread_names = set()
+
+    def work(job, fail=False):
+        with lock:
+            running.append(job.name)
+            max_running.append(len(running))
+            thread_names.add(current_thread().name)
+        job.set_stage("first")
+        job.set_progress(1, 2)
+        sleep(0.02)
+        job.set_stage("second")
+        with lock:
+            running.remove(job.name)
+        if fail:
+            raise RuntimeError("broken")
+
+    submitted = [jobs.submit(f"job {i}", work) for i in range(4)]
+    job_failed = jobs.submit("job failed", work, fail=True)
+    for job in submitted + [job_failed]:
+        wait_finished(job)
+
+    assert max(max_running) == 1
+    assert len(thread_names) == 1
+    for job in submitted:
+        assert job.status == "done"
+        assert job.progress == 1.0
+        assert list(job.stage_timings) == ["first", "second"]
+    assert job_failed.status == "failed"
+    assert "broken" in job_failed.error
+    assert jobs.get(job_failed.job_id) is job_failed
+    assert jobs.get_unfinished() is None
+
+
+def test_jobs_superseded_in_group():
+    """A newer job in the same group stops the running one at its next stage."""
+    from threading import Event
+
+    from interleave_epub.flask_app.jobs import JobManager
+
+    jobs = JobManager()
+    started = Event()
+    resume = Event()
+    stages_done = []
+
+    def align(name, job):
+        job.set_stage("encode")
+        started.set()
+        resume.wait(timeout=10)
+        job.set_stage("align")
+        stages_done.append(name)
+
+    job_old = jobs.submit("old", align, "old", group="align")
+    assert started.wait(timeout=10)
+    # the pending job is superseded too, it never starts
+    job_pending = jobs.submit("pending", align, "pending", group="align")
+    job_new = jobs.submit("new", align, "new", group="align")
+    job_other = jobs.submit("other", lambda job: None, group="other")
+    assert job_old.cancel_event.is_set()
+    assert not job_new.cancel_event.is_set()
+    resume.set()
+
+    for job in [job_old, job_pending, job_new, job_other]:
+        wait_finished(job)
+    assert job_old.status == "cancelled"
+    assert job_old.stage == "encode"
+    assert "encode" in job_old.stage_timings
+    assert job_pending.status == "cancelled"
+    assert job_pending.stage == ""
+    assert job_new.status == "done"
+    assert job_other.status == "done"
+    assert stages_done == ["new"]
+
+
+def test_session_store_eviction(tmp_path):
+    """Over budget, the old aligners go first, then the old sessions."""
+    import numpy as np
+
+    from interleave_epub.flask_app.figures import tile_cache
+    from interleave_epub.flask_app.sessions import SessionStore
+
+    store = SessionStore(memory_budget_mb=1)
+
+    def add_aligner(ses, ch_id_pair_str, sim_shape):
+        ch_fol = tmp_path / ses.session_id / ch_id_pair_str
+        ch_fol.mkdir(parents=True)
+        al = build_bare_aligner(ch_fol, {0: 0}, 1)
+        al.all_ids_dst_max = []
+        al.sim = np.zeros(sim_shape, dtype=np.float32)
+        ses.ii.aligners[ch_id_pair_str] = al
+        ses.ii.ch_id_pair_str = ch_id_pair_str
+        return al
+
+    # two sessions of 600kB each, the current aligner is the first one
+    ses_a = store.get("a")
+    add_aligner(ses_a, "1_1", (250, 300))
+    add_aligner(ses_a, "0_0", (250, 300))
+    ses_b = store.get("b")
+    add_aligner(ses_b, "1_1", (250, 300))
+    al_b = add_aligner(ses_b, "0_0", (250, 300))
+    assert ses_b.ii.memory_size() == 600_000
+
+    # the heatmap tiles are counted, without the similarity shared with the aligner
+    tiles = tile_cache.get_tiles(al_b)
+    size_tiles = tiles.nbytes - al_b.sim.nbytes
+    assert size_tiles > 0
+    assert ses_b.ii.memory_size() == 600_000 + size_tiles
+
+    # over budget: the old aligner of the oldest session is evicted
+    assert store.get("b") is ses_b
+    assert list(ses_a.ii.aligners) == ["0_0"]
+    assert list(ses_b.ii.aligners) == ["1_1", "0_0"]
+    assert store.memory_size() <= store.memory_budget
+    assert store.memory_size() == 900_000 + size_tiles
+
+    # still over budget without the old aligners: the oldest session is dropped
+    ses_c = store.get("c")
+    add_aligner(ses_c, "0_0", (250, 400))
+    store.get("c")
+    assert list(store.sessions) == ["b", "c"]
+    assert list(ses_b.ii.aligners) == ["0_0"]
+    assert store.memory_size() == 700_000 + size_tiles
+
+    # a recently used session moves to the end
+    store.get("b")
+    assert list(store.sessions) == ["c", "b"]
+
+
+def build_flask_client(tmp_path, monkeypatch):
+    """Get a test client of the app, with its sessions kept in a temp folder.
+
+    Returns:
+        The client and the session of its cookie.
+    """
+    monkeypatch.setenv("INTERLEAVE_SECRET_KEY", "test")
+
+    from interleave_epub.flask_app import app, routes
+    from interleave_epub.flask_app.sessions import SessionStore
+
+    store = SessionStore(memory_budget_mb=1024, session_cache_fol=tmp_path)
+    monkeypatch.setattr(routes, "sessions", store)
+    client = app.test_client()
+    with client.session_transaction() as cookie_session:
+        cookie_session["session_id"] = "test"
+    return client, store.get("test")
+
+
+def test_heatmap_tile_etag(tmp_path, monkeypatch):
+    """A tile is sent once, then the browser revalidates it with its ETag."""
+    import numpy as np
+
+    client, ses = build_flask_client(tmp_path, monkeypatch)
+    al = build_bare_aligner(tmp_path, {0: 0}, 1)
+    al.sim = np.random.default_rng(0).random((300, 300), dtype=np.float32)
+    al.sim_version = 7
+    ses.ii.aligners["0_0"] = al
+
+    url = "/heatmap/0_0?level=0&src=1&dst=0&v=7"
+    response = client.get(url)
+    assert response.status_code == 200
+    assert response.mimetype == "image/png"
+    assert response.data.startswith(b"\x89PNG")
+    assert "max-age=3600" in response.headers["Cache-Control"]
+    etag = response.headers["ETag"]
+
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    assert response.data == b""
+
+    # a new similarity is a new tile, an old link must revalidate it
+    al.sim_version = 8
+    response = client.get(url, headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    assert response.headers["ETag"] != etag
+    assert response.headers["Cache-Control"] == "private, no-cache"
+
+    # outside of the pyramid
+    response = client.get("/heatmap/0_0?level=0&src=2&dst=0&v=8")
+    assert response.status_code == 404
+    assert "Bad tile" in response.get_json()["error"]
+    assert client.get("/heatmap/1_1?level=0&src=0&dst=0").status_code == 404
+
+
+def test_api_align_bad_action(tmp_path, monkeypatch):
+    """A bad action on the JSON API is a 400 with the error, the state is kept."""
+    client, ses = build_flask_client(tmp_path, monkeypatch)
+
+    # no books loaded, there is no aligner to pick with
+    response = client.post("/api/align", json={"dst_pick": 3})
+    assert response.status_code == 400
+    assert response.get_json()["error"].startswith("Bad action: KeyError")
+
+    al = build_bare_aligner(tmp_path, {0: 0, 1: 2, 2: 1}, 3)
+    ses.ii.aligners[ses.ii.ch_id_pair_str] = al
+    mapping = dict(al.better_par_src_to_dst_flat)
+    for action, error in [
+        ({"dst_pick": "three"}, "ValueError"),
+        ({"dst_picks": 3}, "TypeError"),
+        ({"dst_picks": [[1]]}, "ValueError"),
+    ]:
+        response = client.post("/api/align", json=action)
+        assert response.status_code == 400
+        assert response.is_json
+        assert response.get_json()["error"].startswith(f"Bad action: {error}")
+    assert al.better_par_src_to_dst_flat == mapping
+    assert al.fixed_src_par_ids == []
+
+
+def test_session_manifest_round_trip(tmp_path, monkeypatch):
+    """A session restored from its manifest is on the same chapters and fixes."""
+    from interleave_epub.flask_app.sessions import Session
+    from interleave_epub.interleave.align_journal import AlignJournal
+    from interleave_epub.interleave.interactive import InterleaverInteractive
+
+    # the books are only referenced by path, parsing them is not tested here
+    def add_book(self, ep_path, which_ep, ep_name="", ep_author="", progress=None):
+        self.epubs[which_ep] = ep_path
+        self.book_files[which_ep] = {
+            "path": str(ep_path),
+            "name": ep_name,
+            "author": ep_author,
+        }
+        self.has_both_epubs = len(self.epubs) == 2
+
+    monkeypatch.setattr(InterleaverInteractive, "load_nlp", lambda self: None)
+    monkeypatch.setattr(InterleaverInteractive, "add_book", add_book)
+
+    manifest_path = tmp_path / "manifest_a.json"
+    ses = Session("a", manifest_path=manifest_path)
+    ses.ii.set_lang_tag("fr", "src")
+    ses.ii.set_lang_tag("en", "dst")
+    for which_ep in ["src", "dst"]:
+        book_path = tmp_path / f"{which_ep}.epub"
+        book_path.write_bytes(b"")
+        ses.ii.add_book(book_path, which_ep, f"Book {which_ep}", "Author")
+    ses.ii.ch_curr_id, ses.ii.ch_first_id, ses.ii.ch_delta_id = 2, 1, 1
+    ses.ii.update_chapter_id_info()
+    assert ses.ii.ch_id_pair_str == "3_4"
+
+    # a fix of the user goes in the align cache of the pair
+    snapshot_path = tmp_path / f"info_align_{ses.ii.ch_id_pair_str}.json"
+    al = build_bare_aligner(tmp_path, {0: 0, 1: 2, 2: 1}, 3)
+    al.journal = AlignJournal(snapshot_path)
+    al.all_ids_dst_max = []
+    al.save_align_state()
+    al.pick_dst_pars([(1, 1), (2, 2)])
+    ses.save_manifest()
+    ses.close()
+
+    ses_new = Session("a", manifest_path=manifest_path)
+    ses_new.load_manifest()
+    assert ses_new.can_restore
+    ses_new.ii.restore_manifest(ses_new.manifest)
+    assert not ses_new.can_restore
+    assert ses_new.ii.ch_id_pair_str == "3_4"
+    assert ses_new.ii.sd_to_lt == {"src": "fr", "dst": "en"}
+    assert ses_new.ii.book_files == ses.ii.book_files
+    assert ses_new.ii.to_manifest() == ses.manifest
+    ses_new.close()
+
+    align_info = AlignJournal(snapshot_path).load()
+    assert align_info["better_par_src_to_dst_flat"] == {0: 0, 1: 1, 2: 2}
+    assert sorted(align_info["fixed_src_par_ids"]) == [1, 2]
+
+    # a missing book is not restored
+    (tmp_path / "dst.epub").unlink()
+    ses_missing = Session("a", manifest_path=manifest_path)
+    ses_missing.load_manifest()
+    assert not ses_missing.can_restore
+    ses_missing.close()
+
+
+def test_composed_chapter_reused(tmp_path):
+    """A chapter with the same alignment is kept, a new alignment composes it again."""
+    from types import SimpleNamespace
+
+    from bs4 import BeautifulSoup
+
+    from interleave_epub.interleave.align_journal import write_align_snapshot
+    from interleave_epub.interleave.build_chap import (
+        ComposedChapterCache,
+        interleave_chap,
+    )
+    from interleave_epub.utils import get_package_fol
+
+    def build_chapter(texts):
+        soup = BeautifulSoup("".join(f"<p>{t}</p>" for t in texts), "html.parser")
+        paragraphs = [
+            SimpleNamespace(p_tag=p_tag, get_text=p_tag.get_text)
+            for p_tag in soup.find_all("p")
+        ]
+        return SimpleNamespace(paragraphs=paragraphs)
+
+    ch_src = build_chapter(["Un.", "Deux.", "Trois."])
+    ch_dst = build_chapter(["One.", "Two.", "Three."])
+    par_matching_path = tmp_path / "info_align_0_0.json"
+    output_fol = tmp_path / "output"
+    output_fol.mkdir()
+
+    def compose(par_src_to_dst_flat):
+        write_align_snapshot(
+            par_matching_path, {"better_par_src_to_dst_flat": par_src_to_dst_flat}
+        )
+        # a new cache for each save, as the hashes are read from the last one
+        composed_cache = ComposedChapterCache(output_fol)
+        is_composed = interleave_chap(
+            ch_src,
+            ch_dst,
+            0,
+            par_matching_path,
+            output_fol,
+            get_package_fol("epub_template"),
+            "Title",
+            "Author",
+            "fr-en",
+            "fr",
+            "en",
+            composed_cache,
+        )
+        composed_cache.save()
+        return is_composed
+
+    composed_ch_path = output_fol / "ch_0000.xhtml"
+    assert compose({0: 0, 1: 1, 2: 2})
+    composed_text = composed_ch_path.read_text()
+    assert compose({0: 0, 1: 1, 2: 2}) is False
+    assert composed_ch_path.read_text() == composed_text
+
+    # the alignment changed
+    assert compose({0: 0, 1: 2, 2: 2})
+    assert composed_ch_path.read_text() != composed_text
+    assert compose({0: 0, 1: 2, 2: 2}) is False
+
+    # an edited output is not trusted
+    composed_ch_path.write_text("edited")
+    assert compose({0: 0, 1: 2, 2: 2})
+    assert composed_ch_path.read_text() != "edited"